@@ -0,0 +1,7 @@
+"""Scan benchmarks on generated lakes.
+
+- benchmarks.run: cold, warm and incremental scans of one backend, with JSON results and a baseline comparison
+- benchmarks.backends: the same scans on each storage backend, side by side
+- benchmarks.compare: compare saved results with a baseline
+- benchmarks.lake: the reproducible synthetic lake generator
+"""
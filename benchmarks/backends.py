@@ -0,0 +1,56 @@
+"""Compare scan throughput of the storage backends on the same generated lake:
+
+    python -m benchmarks.backends --backends sqlite mongo --files 20000
+
+Each backend runs benchmarks.run in its own process, as the backend is picked
+when db_handler is imported; options other than the backends are passed on
+to it, so every process generates the same lake.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.run import BACKENDS, BACKEND_MONGO, BACKEND_SQLITE
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def benchmark_backend(backend: str, options: list) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        output = os.path.join(workdir, "results.json")
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", "--backend", backend, "--output", output, *options],
+            cwd=REPO_DIR, capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            stderr = completed.stderr.strip()
+            raise RuntimeError(stderr.splitlines()[-1] if stderr else f"exited with code {completed.returncode}")
+        with open(output) as f:
+            return json.load(f)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare scan throughput of the storage backends")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=[BACKEND_SQLITE, BACKEND_MONGO])
+    args, options = parser.parse_known_args(argv)
+
+    failures = 0
+    print(f"{'backend':<8} {'scan':<14} {'files':>8} {'seconds':>9} {'files/s':>10} {'round trips':>12}")
+    for backend in args.backends:
+        try:
+            results = benchmark_backend(backend, options)
+        except Exception as e:
+            failures += 1
+            print(f"{backend:<8} failed: {e}")
+            continue
+        for scan in results["scans"]:
+            print(f"{backend:<8} {scan['scan']:<14} {scan['files']:>8} {scan['seconds']:>9.3f} "
+                  f"{scan['files_per_second']:>10.1f} {scan['db_round_trips']:>12}")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
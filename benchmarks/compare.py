@@ -0,0 +1,92 @@
+"""Compare benchmark results with a saved baseline:
+
+    python -m benchmarks.compare results.json baseline.json --tolerance 0.1
+
+Exits non-zero when a metric of any scan is worse than the baseline by more
+than the tolerance.
+"""
+import sys
+import json
+import argparse
+
+from typing import List
+
+# Compared metrics, and whether a higher value is better
+METRICS = {
+    "files_per_second": True,
+    "bytes_per_second": True,
+    "db_round_trips": False,
+    "peak_rss_bytes": False,
+}
+
+
+def setup_differences(results: dict, baseline: dict) -> List[str]:
+    """What differs between the setups of two runs, which makes their numbers hard to compare"""
+    differences = []
+    if results["backend"] != baseline["backend"]:
+        differences.append("backend")
+    if results["lake"]["spec"] != baseline["lake"]["spec"]:
+        differences.append("lake spec")
+    return differences
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> List[dict]:
+    """One row per scan and metric present in both runs, flagged when worse than tolerance allows"""
+    baseline_scans = {scan["scan"]: scan for scan in baseline["scans"]}
+    rows = []
+    for scan in results["scans"]:
+        reference = baseline_scans.get(scan["scan"])
+        if reference is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            current, previous = scan.get(metric), reference.get(metric)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            regression = change < -tolerance if higher_is_better else change > tolerance
+            rows.append({
+                "scan": scan["scan"],
+                "metric": metric,
+                "baseline": previous,
+                "current": current,
+                "change": round(change, 4),
+                "regression": regression
+            })
+    return rows
+
+
+def format_comparison(rows: List[dict]) -> str:
+    lines = [f"{'scan':<14} {'metric':<18} {'baseline':>14} {'current':>14} {'change':>8}"]
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(f"{row['scan']:<14} {row['metric']:<18} {row['baseline']:>14,.1f} {row['current']:>14,.1f} "
+                     f"{row['change']:>+8.1%}{flag}")
+    return "\n".join(lines)
+
+
+def report(results: dict, baseline: dict, tolerance: float) -> int:
+    """Print the comparison and return 1 if any metric regressed, else 0"""
+    differences = setup_differences(results, baseline)
+    if differences:
+        print(f"Warning: not the same {' and '.join(differences)} as the baseline; the comparison may not be meaningful")
+    rows = compare(results, baseline, tolerance)
+    print(format_comparison(rows))
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare benchmark results with a saved baseline")
+    parser.add_argument("results")
+    parser.add_argument("baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative change before a regression")
+    args = parser.parse_args(argv)
+
+    with open(args.results) as f:
+        results = json.load(f)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    return report(results, baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import math
+import random
+
+from typing import List, NamedTuple, Tuple
+
+SIZE_FIXED = "fixed"
+SIZE_UNIFORM = "uniform"         # Between 1 byte and twice the mean
+SIZE_LOGNORMAL = "lognormal"     # Many small files and a long tail of large ones, like most real lakes
+SIZE_DISTRIBUTIONS = (SIZE_FIXED, SIZE_UNIFORM, SIZE_LOGNORMAL)
+
+# Content is a block derived from the content id, repeated up to the file size
+CONTENT_BLOCK_SIZE = 4096
+
+
+class LakeSpec(NamedTuple):
+    """Shape of a synthetic lake; the same spec always produces the same files"""
+    files: int = 10000
+    depth: int = 3                       # Directory levels below the root
+    fanout: int = 6                      # Subdirectories per directory
+    mean_size: int = 16384               # Bytes
+    size_distribution: str = SIZE_LOGNORMAL
+    duplicate_ratio: float = 0.1         # Files whose content is a copy of an earlier file
+    pdf_ratio: float = 0.05              # Files written as .pdf, which go through (stubbed) OCR
+    churn: float = 0.05                  # Fraction of the files modified, deleted and added (a third each) per churn round
+    seed: int = 0
+
+
+def _content(content_id: int, size: int, pdf: bool) -> bytes:
+    block = random.Random(content_id).randbytes(min(size, CONTENT_BLOCK_SIZE))
+    data = (block * (size // len(block) + 1))[:size]
+    if pdf:
+        return b"%PDF-1.4\n" + data + b"\n%%EOF\n"
+    return data
+
+
+def _file_size(spec: LakeSpec, rng: random.Random) -> int:
+    if spec.size_distribution == SIZE_FIXED:
+        return max(1, spec.mean_size)
+    if spec.size_distribution == SIZE_UNIFORM:
+        return rng.randint(1, max(1, 2 * spec.mean_size))
+    if spec.size_distribution == SIZE_LOGNORMAL:
+        sigma = 1.0
+        return max(1, int(rng.lognormvariate(math.log(max(1, spec.mean_size)) - sigma ** 2 / 2, sigma)))
+    raise ValueError(f"Unknown size distribution: {spec.size_distribution}")
+
+
+def leaf_directories(root: str, spec: LakeSpec) -> List[str]:
+    directories = [root]
+    for level in range(spec.depth):
+        directories = [os.path.join(parent, f"l{level}_{i}") for parent in directories for i in range(spec.fanout)]
+    return directories
+
+
+class LakeWriter:
+    """Writes files of a lake, handing out content ids so duplicates share their bytes"""
+
+    def __init__(self, spec: LakeSpec, rng: random.Random, first_content_id: int):
+        self.spec = spec
+        self.rng = rng
+        self.next_content_id = first_content_id
+        self.contents: List[Tuple[int, int, bool]] = [] # (content id, size, pdf) of every distinct content written
+        self.stats = {"files": 0, "bytes": 0, "pdfs": 0, "duplicates": 0}
+
+    def _new_content(self, pdf: bool) -> Tuple[int, int, bool]:
+        content = (self.next_content_id, _file_size(self.spec, self.rng), pdf)
+        self.next_content_id += 1
+        self.contents.append(content)
+        return content
+
+    def write(self, stem: str) -> None:
+        """Write a new file at stem plus .bin or .pdf"""
+        if self.contents and self.rng.random() < self.spec.duplicate_ratio:
+            content = self.rng.choice(self.contents)
+            self.stats["duplicates"] += 1
+        else:
+            content = self._new_content(self.rng.random() < self.spec.pdf_ratio)
+        self._write(f"{stem}.pdf" if content[2] else f"{stem}.bin", content)
+
+    def rewrite(self, path: str) -> None:
+        """Replace an existing file with new content of the same type"""
+        self._write(path, self._new_content(path.endswith(".pdf")))
+
+    def _write(self, path: str, content: Tuple[int, int, bool]) -> None:
+        data = _content(*content)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.stats["files"] += 1
+        self.stats["bytes"] += len(data)
+        self.stats["pdfs"] += content[2]
+
+
+def generate(root: str, spec: LakeSpec) -> dict:
+    """Write the lake described by spec under root and return its file, byte, PDF and duplicate counts"""
+    rng = random.Random(spec.seed)
+    directories = leaf_directories(root, spec)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    writer = LakeWriter(spec, rng, first_content_id=spec.seed * 10 ** 9)
+    for i in range(spec.files):
+        writer.write(os.path.join(rng.choice(directories), f"f{i}"))
+    return {**writer.stats, "directories": len(directories)}
+
+
+def list_files(root: str) -> List[str]:
+    files = []
+    for directory, subdirectories, names in os.walk(root):
+        subdirectories.sort()
+        files.extend(os.path.join(directory, name) for name in sorted(names))
+    return files
+
+
+def apply_churn(root: str, spec: LakeSpec, round_number: int) -> dict:
+    """Modify, delete and add spec.churn of the files, the same ones for the same spec and round"""
+    rng = random.Random(f"{spec.seed}:{round_number}")
+    files = list_files(root)
+    changed = rng.sample(files, min(len(files), int(len(files) * spec.churn)))
+    third = len(changed) // 3
+    modified, deleted = changed[:third], changed[third:2 * third]
+
+    writer = LakeWriter(spec, rng, first_content_id=(spec.seed * 10 ** 9) + (round_number + 1) * 10 ** 8)
+    for path in modified:
+        writer.rewrite(path)
+    for path in deleted:
+        os.remove(path)
+    directories = leaf_directories(root, spec)
+    for i in range(len(changed) - 2 * third):
+        writer.write(os.path.join(rng.choice(directories), f"churn{round_number}_{i}"))
+    return {"modified": len(modified), "deleted": len(deleted), "added": len(changed) - 2 * third}
+
+
+def lake_size(root: str) -> Tuple[int, int]:
+    """Number of files and total bytes under root"""
+    files = list_files(root)
+    return len(files), sum(os.path.getsize(path) for path in files)
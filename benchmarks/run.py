@@ -0,0 +1,211 @@
+"""End-to-end scan benchmark on a generated lake:
+
+    python -m benchmarks.run --files 20000 --backend memory --output results.json --baseline baseline.json
+
+Runs a cold scan (empty database and OUTPUT_DIR), a warm rescan of the
+unchanged lake and one incremental scan per churn round, with docling
+replaced by benchmarks.stub_ocr. Settings not set here (DIR_SNAPSHOT_MODE,
+OUTPUT_STORE, SCAN_PIPELINE, ...) come from the environment as usual.
+"""
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+
+from datetime import datetime, timezone
+from benchmarks import compare, lake
+
+BACKEND_MEMORY = "memory"  # SQLite in memory
+BACKEND_SQLITE = "sqlite"  # SQLite file in the work directory
+BACKEND_MONGO = "mongo"    # Throwaway database on MONGO_URI, e.g. a local mongod
+BACKENDS = (BACKEND_MEMORY, BACKEND_SQLITE, BACKEND_MONGO)
+
+# Settings recorded with the results, as they change what a scan does
+RECORDED_SETTINGS = (
+    "SCAN_PIPELINE", "SCAN_PRELOAD_INDEX", "DIR_SNAPSHOT_MODE", "OUTPUT_STORE", "OUTPUT_NAMING",
+    "OUTPUT_SYNC_MODE", "SCAN_DIFF_MODE", "COPY_METHODS", "BULK_WRITE_BATCH_SIZE", "CLASSIFY_CONCURRENCY", "PROCESS_CONCURRENCY",
+)
+
+
+class RoundTripCounter:
+    """Counts requests to the database: commands sent to MongoDB, calls into the SQLite thread"""
+
+    def __init__(self):
+        self.count = 0
+
+    def watch(self, handler) -> None:
+        if hasattr(handler, "_run"):
+            run = handler._run
+
+            async def counted_run(*args):
+                self.count += 1
+                return await run(*args)
+
+            handler._run = counted_run
+        else:
+            from pymongo import monitoring
+
+            counter = self
+
+            class Listener(monitoring.CommandListener):
+                def started(self, event):
+                    counter.count += 1
+
+                def succeeded(self, event):
+                    pass
+
+                def failed(self, event):
+                    pass
+
+            # Applies to clients created afterwards, so before initialize()
+            monitoring.register(Listener())
+
+
+def _configure(args, workdir: str) -> None:
+    """Point the settings at the work directory; must run before config is imported"""
+    os.environ.update({
+        "STORAGE_BACKEND": "mongo" if args.backend == BACKEND_MONGO else "sqlite",
+        "SQLITE_PATH": ":memory:" if args.backend == BACKEND_MEMORY else os.path.join(workdir, "benchmark.db"),
+        "DB_NAME": f"{os.getenv('DB_NAME', 'file_tracker_db')}_benchmark_{os.getpid()}",
+        "SOURCE_DATA_LAKE_DIR": os.path.join(workdir, "lake"),
+        "OUTPUT_DIR": os.path.join(workdir, "output"),
+        "PDF_PROCESSING_ENABLED": "true",
+        "OCR_MODE": "worker_pool",
+        "OCR_CONVERTER_FACTORY": "benchmarks.stub_ocr:factory",
+        "OCR_OUTPUT_DIR": os.path.join(workdir, "ocr"),
+        "POST_PROCESS_SCRIPT_PATH": "",
+    })
+
+
+async def _scan(name: str, counter: RoundTripCounter) -> dict:
+    import config
+    import metrics
+    from files_processing import process_directory
+
+    files, size = lake.lake_size(config.SOURCE_DATA_LAKE_DIR)
+    round_trips = counter.count
+    metrics.reset_peak_rss()
+    start = time.perf_counter()
+    # The scan prints a few lines per file
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = await process_directory(config.SOURCE_DATA_LAKE_DIR)
+    seconds = time.perf_counter() - start
+    return {
+        "scan": name,
+        "files": files,
+        "bytes": size,
+        "seconds": round(seconds, 3),
+        "files_per_second": round(files / seconds, 1),
+        "bytes_per_second": round(size / seconds, 1),
+        "db_round_trips": counter.count - round_trips,
+        "peak_rss_bytes": metrics.peak_rss_bytes(),
+        "counts": report.counts,
+        "stages": report.summary.get("stages")
+    }
+
+
+async def run_benchmark(args, spec: lake.LakeSpec, workdir: str) -> dict:
+    _configure(args, workdir)
+    import config
+    from db_handler import db_handler
+    from ocr_scheduler import ocr_scheduler
+    from post_processing import post_processor
+
+    logging.disable(logging.INFO)
+    lake_stats = lake.generate(config.SOURCE_DATA_LAKE_DIR, spec)
+    os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+
+    counter = RoundTripCounter()
+    counter.watch(db_handler)
+    await db_handler.initialize()
+    scans, churn = [], []
+    try:
+        await db_handler.bootstrap()
+        scans.append(await _scan("cold", counter))
+        scans.append(await _scan("warm", counter))
+        for round_number in range(1, args.churn_rounds + 1):
+            churn.append(lake.apply_churn(config.SOURCE_DATA_LAKE_DIR, spec, round_number))
+            name = "incremental" if args.churn_rounds == 1 else f"incremental_{round_number}"
+            scans.append(await _scan(name, counter))
+    finally:
+        await ocr_scheduler.close()
+        await post_processor.close()
+        if args.backend == BACKEND_MONGO:
+            await db_handler.database.client.drop_database(db_handler.database.name)
+        await db_handler.close()
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "backend": args.backend,
+        "lake": {"spec": spec._asdict(), "stats": lake_stats, "churn": churn},
+        "settings": {name: getattr(config, name) for name in RECORDED_SETTINGS},
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "scans": scans
+    }
+
+
+def format_results(results: dict) -> str:
+    lines = [f"{'scan':<14} {'files':>8} {'seconds':>9} {'files/s':>10} {'MB/s':>8} {'round trips':>12} {'peak RSS MB':>12}"]
+    for scan in results["scans"]:
+        lines.append(f"{scan['scan']:<14} {scan['files']:>8} {scan['seconds']:>9.3f} {scan['files_per_second']:>10.1f} "
+                     f"{scan['bytes_per_second'] / 1024 ** 2:>8.1f} {scan['db_round_trips']:>12} "
+                     f"{scan['peak_rss_bytes'] / 1024 ** 2:>12.1f}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    defaults = lake.LakeSpec()
+    parser = argparse.ArgumentParser(description="End-to-end scan benchmark on a generated lake")
+    parser.add_argument("--backend", choices=BACKENDS, default=BACKEND_MEMORY)
+    parser.add_argument("--files", type=int, default=defaults.files)
+    parser.add_argument("--depth", type=int, default=defaults.depth, help="Directory levels below the root")
+    parser.add_argument("--fanout", type=int, default=defaults.fanout, help="Subdirectories per directory")
+    parser.add_argument("--mean-size", type=int, default=defaults.mean_size, help="Mean file size in bytes")
+    parser.add_argument("--size-distribution", choices=lake.SIZE_DISTRIBUTIONS, default=defaults.size_distribution)
+    parser.add_argument("--duplicate-ratio", type=float, default=defaults.duplicate_ratio)
+    parser.add_argument("--pdf-ratio", type=float, default=defaults.pdf_ratio)
+    parser.add_argument("--churn", type=float, default=defaults.churn, help="Fraction of the files changed per round")
+    parser.add_argument("--churn-rounds", type=int, default=1, help="Incremental scans, each after a churn round")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--workdir", help="Where the lake, outputs and database go (a temporary directory if unset)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with the results saved in this file")
+    parser.add_argument("--save-baseline", help="Also save the results to this file as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative change before a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    spec = lake.LakeSpec(
+        files=args.files, depth=args.depth, fanout=args.fanout, mean_size=args.mean_size,
+        size_distribution=args.size_distribution, duplicate_ratio=args.duplicate_ratio,
+        pdf_ratio=args.pdf_ratio, churn=args.churn, seed=args.seed
+    )
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = asyncio.run(run_benchmark(args, spec, workdir))
+
+    print(format_results(results))
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if baseline is None:
+        return 0
+    return compare.report(results, baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
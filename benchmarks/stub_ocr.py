@@ -0,0 +1,30 @@
+"""Stand-in for the docling converter, loaded by the OCR worker through
+OCR_CONVERTER_FACTORY=benchmarks.stub_ocr:factory. It reads the PDF and
+returns a one-line markdown document, so benchmarks measure the scan and not
+the model.
+"""
+import os
+
+
+class _Document:
+    def __init__(self, text: str):
+        self._text = text
+
+    def export_to_markdown(self) -> str:
+        return self._text
+
+
+class _Result:
+    def __init__(self, document: _Document):
+        self.document = document
+
+
+class StubConverter:
+    def convert(self, pdf_path: str) -> _Result:
+        with open(pdf_path, "rb") as f:
+            size = len(f.read())
+        return _Result(_Document(f"# {os.path.basename(pdf_path)}\n\n{size} bytes\n"))
+
+
+def factory() -> StubConverter:
+    return StubConverter()
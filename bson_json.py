@@ -0,0 +1,47 @@
+import json
+import uuid
+import base64
+
+from datetime import datetime
+from bson import ObjectId, Decimal128
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _default(value):
+    """JSON value for the BSON types json cannot encode natively"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (Decimal128, uuid.UUID)):
+        return str(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError(f"Cannot encode {type(value).__name__} as JSON")
+
+
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps(document) -> bytes:
+    """Encode a document read from MongoDB as JSON in one pass, with orjson when it is installed.
+
+    ObjectIds become their hex string and datetimes ISO 8601 strings.
+    """
+    if orjson is not None:
+        return orjson.dumps(document, default=_default)
+    return _encoder.encode(document).encode()
+
+
+async def iter_ndjson(documents, first=None):
+    """Encode the documents of an async cursor as NDJSON lines, optionally after ``first``"""
+    if first is not None:
+        yield dumps(first) + b"\n"
+    async for document in documents:
+        yield dumps(document) + b"\n"
@@ -0,0 +1,165 @@
+import os
+import time
+import errno
+import config
+import logging
+import threading
+import copy_engine
+
+from typing import List, Optional, Tuple
+from db_handler import db_handler
+from utils import generate_unique_output_path, get_file_hash, remove_files_in_batches
+
+logger = logging.getLogger(__name__)
+
+# Values of OUTPUT_STORE
+STORE_COPY = "copy" # Every file gets its own copy in OUTPUT_DIR
+STORE_CAS = "cas"   # Identical files share one blob in OUTPUT_DIR/.cas
+
+# Values of CAS_LINK_MODE
+LINK_HARDLINK = "hardlink" # OUTPUT_DIR gets a hardlink to the blob under the usual output name
+LINK_MANIFEST = "manifest" # The file record's output_path is the blob itself
+
+METHOD_DEDUP = "dedup" # Reported copy method when an existing blob was reused
+
+CAS_DIR_NAME = ".cas"
+DIGEST_ALGORITHM = "blake2b"
+
+
+def enabled() -> bool:
+    return config.OUTPUT_STORE == STORE_CAS
+
+
+def cas_root() -> str:
+    return os.path.join(config.OUTPUT_DIR, CAS_DIR_NAME)
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(cas_root(), digest[:2], digest[2:4], digest)
+
+
+def _store_blob(source: str, size: int) -> Tuple[str, str, Optional[copy_engine.CopyResult]]:
+    """Hash source and copy it into the store unless its blob exists. Returns (digest, blob path, copy or None)."""
+    digest = get_file_hash(source, DIGEST_ALGORITHM)
+    path = blob_path(digest)
+    if os.path.exists(path):
+        return digest, path, None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        copy_result = copy_engine.copy_file(source, temporary_path, size)
+        try:
+            # Publish atomically; whoever links first wins a race on identical content
+            os.link(temporary_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        try:
+            os.unlink(temporary_path)
+        except FileNotFoundError:
+            pass
+    return digest, path, copy_result
+
+
+def _link_output(path: str, output_path: str, size: int) -> None:
+    try:
+        os.link(path, output_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        # Hardlinks unavailable or the blob has too many: fall back to a copy
+        copy_engine.copy_file(path, output_path, size)
+
+
+def _replace_link(path: str, output_path: str, size: int) -> None:
+    """Link the blob to a temporary name next to output_path, then move it over the old output"""
+    directory, name = os.path.split(output_path)
+    temporary_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        _link_output(path, temporary_path, size)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        try:
+            os.unlink(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def materialize(source: str, size: int, previous_output: Optional[str] = None,
+                naming: Optional[str] = None) -> Tuple[str, copy_engine.CopyResult, str]:
+    """Make the output for a source file through the blob store. Blocking.
+
+    Returns (output path, copy result, digest). The copy result's method is
+    METHOD_DEDUP when the content was already stored. With hardlinks, a
+    ``previous_output`` the caller may reuse is relinked to the new blob in
+    place, so the superseded blob loses its last link and can be collected.
+    ``naming`` overrides OUTPUT_NAMING for a new output name.
+    """
+    start_time = time.monotonic()
+    digest, path, copy_result = _store_blob(source, size)
+    if config.CAS_LINK_MODE == LINK_MANIFEST:
+        output_path = path
+    elif previous_output is not None:
+        output_path = previous_output
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        _replace_link(path, output_path, size)
+    else:
+        output_path = generate_unique_output_path(source, config.OUTPUT_DIR, naming=naming)
+        _link_output(path, output_path, size)
+
+    if copy_result is None:
+        return output_path, copy_engine.CopyResult(METHOD_DEDUP, size, time.monotonic() - start_time), digest
+    return output_path, copy_result._replace(duration_seconds=time.monotonic() - start_time), digest
+
+
+async def add_reference(file_data: dict) -> None:
+    """Count the persisted record as a reference to its blob"""
+    digest = file_data["blob_digest"]
+    await db_handler.set_blob_reference(
+        file_data["file_path"], digest, {"path": blob_path(digest), "size": file_data["size"]}
+    )
+
+
+async def release_references(file_paths: List[str]) -> None:
+    await db_handler.release_blob_references(file_paths)
+
+
+async def collect_garbage() -> dict:
+    """Delete blobs no source file refers to any more"""
+    blobs = await db_handler.get_unreferenced_blobs()
+    removed = await remove_files_in_batches([blob["path"] for blob in blobs], config.OUTPUT_SYNC_DELETE_BATCH_SIZE)
+    await db_handler.delete_unreferenced_blobs([blob["_id"] for blob in blobs])
+    if blobs:
+        logger.info(f"Collected {len(blobs)} unreferenced blobs")
+    return {"blobs_collected": len(blobs), "bytes_collected": sum(blob.get("size", 0) for blob in blobs),
+            "blob_files_removed": removed}
+
+
+class DedupStats:
+    """ScanReport observer counting stored and deduplicated blobs from the copies section"""
+
+    def __init__(self):
+        self.blobs_stored = self.bytes_stored = 0
+        self.blobs_reused = self.bytes_deduplicated = 0
+
+    def __call__(self, section: str, entry: dict) -> None:
+        if section != "copies":
+            return
+        if entry["method"] == METHOD_DEDUP:
+            self.blobs_reused += 1
+            self.bytes_deduplicated += entry["size"]
+        else:
+            self.blobs_stored += 1
+            self.bytes_stored += entry["size"]
+
+    def summary(self, garbage: dict) -> dict:
+        """Dedup statistics for the scan report"""
+        return {
+            "blobs_stored": self.blobs_stored,
+            "bytes_stored": self.bytes_stored,
+            "blobs_reused": self.blobs_reused,
+            "bytes_deduplicated": self.bytes_deduplicated,
+            **garbage
+        }
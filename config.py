@@ -12,19 +12,105 @@ else:
 # FOLDERS
 SOURCE_DATA_LAKE_DIR = os.getenv("SOURCE_DATA_LAKE_DIR")
 OUTPUT_DIR = os.getenv("OUTPUT_DIR") # For non-PDFs
+OUTPUT_NAMING = os.getenv("OUTPUT_NAMING", "sequential").lower() # "sequential", "path_hash" or "content_hash"
+OUTPUT_STORE = os.getenv("OUTPUT_STORE", "copy").lower() # "copy" (one copy per file) or "cas" (deduplicated blobs under OUTPUT_DIR/.cas)
+CAS_LINK_MODE = os.getenv("CAS_LINK_MODE", "hardlink").lower() # "hardlink" (output name linked to the blob) or "manifest" (record points at the blob)
+COPY_METHODS = [method.strip() for method in os.getenv("COPY_METHODS", "reflink,copy_file_range,sendfile,copy").split(",") if method.strip()] # Tried in order: reflink, hardlink, copy_file_range, sendfile, copy
+OUTPUT_SYNC_MODE = os.getenv("OUTPUT_SYNC_MODE", "clean").lower() # "incremental" (reconcile outputs) or "clean" (empty OUTPUT_DIR before each scan)
+OUTPUT_SYNC_DELETE_BATCH_SIZE = int(os.getenv("OUTPUT_SYNC_DELETE_BATCH_SIZE", "256")) # Orphaned outputs removed per parallel batch
+COPY_CHUNK_SIZE = int(os.getenv("COPY_CHUNK_SIZE", str(256 * 1024 ** 2))) # Bytes per copy_file_range/sendfile call
 
 # Database configuration
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo") # "mongo" or "sqlite" (embedded, no server needed)
+SQLITE_PATH = os.getenv("SQLITE_PATH", "file_tracker.db") # Database file of the sqlite backend
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME = os.getenv("DB_NAME", "file_tracker_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "processed_files")
 RESULTS_COLLECTION = os.getenv("RESULTS_COLLECTION", "results")
+SCHEMA_BOOTSTRAP = os.getenv("SCHEMA_BOOTSTRAP", "true").lower() == "true" # Run migrations and create indexes at startup
+VERIFY_QUERY_PLANS = os.getenv("VERIFY_QUERY_PLANS", "false").lower() == "true" # Refuse to start if a hot query is not an index scan
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", "1000")) # Scan report entries inserted per batch
+SCAN_HISTORY_PAGE_SIZE = int(os.getenv("SCAN_HISTORY_PAGE_SIZE", "50")) # Scans or entries per page when no limit is given
+SCAN_HISTORY_MAX_PAGE_SIZE = int(os.getenv("SCAN_HISTORY_MAX_PAGE_SIZE", "1000")) # Largest page a client may request
+
+# Scan state loading
+SCAN_PRELOAD_INDEX = os.getenv("SCAN_PRELOAD_INDEX", "true").lower() == "true" # Load all file records once per scan
+INDEX_LOAD_BATCH_SIZE = int(os.getenv("INDEX_LOAD_BATCH_SIZE", "10000")) # Cursor batch size for the preload
+PATH_LOOKUP_CHUNK_SIZE = int(os.getenv("PATH_LOOKUP_CHUNK_SIZE", "1000")) # Paths per $in query when not preloading
+SCAN_DIFF_MODE = os.getenv("SCAN_DIFF_MODE", "memory").lower() # "memory" or "external": sorted merge of the walk with the records, spilling to disk
+SCAN_DIFF_RUN_SIZE = int(os.getenv("SCAN_DIFF_RUN_SIZE", "200000")) # Walk entries sorted in memory before a run is spilled
+SCAN_SPILL_DIR = os.getenv("SCAN_SPILL_DIR", "") # Directory of the spilled runs (system temp directory if empty)
+
+# Write-behind batching of file record writes
+BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", "1000")) # Operations per bulk_write
+BULK_WRITE_FLUSH_INTERVAL = float(os.getenv("BULK_WRITE_FLUSH_INTERVAL", "2.0")) # Max seconds an operation waits before a flush
+
+# Scan concurrency
+SCAN_PIPELINE = os.getenv("SCAN_PIPELINE", "true").lower() == "true" # Staged concurrent pipeline instead of the serial loop
+FS_WORKER_THREADS = int(os.getenv("FS_WORKER_THREADS", "8")) # Threads for blocking filesystem calls
+CLASSIFY_CONCURRENCY = int(os.getenv("CLASSIFY_CONCURRENCY", "16")) # Concurrent stat/classify workers
+PROCESS_CONCURRENCY = int(os.getenv("PROCESS_CONCURRENCY", "4")) # Concurrent copy/OCR workers
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "1000")) # Max items waiting between two stages
+WALKER_THREADS = int(os.getenv("WALKER_THREADS", "8")) # Threads listing directories in parallel
+WALKER_MAX_IN_FLIGHT = int(os.getenv("WALKER_MAX_IN_FLIGHT", "16")) # Directories being listed at once
+DIR_SNAPSHOT_MODE = os.getenv("DIR_SNAPSHOT_MODE", "off").lower() # "off" or "incremental": skip directories unchanged since the last scan
+
+# Scan jobs
+SCAN_CHECKPOINT_INTERVAL = float(os.getenv("SCAN_CHECKPOINT_INTERVAL", "30")) # Seconds between checkpoints of a running scan (0 = none)
+SCAN_RESUME_ON_START = os.getenv("SCAN_RESUME_ON_START", "true").lower() == "true" # Resume a scan interrupted by a restart
+SCAN_LEASE_SECONDS = float(os.getenv("SCAN_LEASE_SECONDS", "60")) # Lease on the scan lock and on a claimed work unit, renewed every third of it
+SCAN_PARTITION_DEPTH = int(os.getenv("SCAN_PARTITION_DEPTH", "0")) # Split scans into work units at this directory depth, claimed by every worker (0 = one worker scans the tree)
+WORK_UNIT_POLL_INTERVAL = float(os.getenv("WORK_UNIT_POLL_INTERVAL", "2")) # Seconds between looks for work units to claim
+WORK_UNIT_MAX_ATTEMPTS = int(os.getenv("WORK_UNIT_MAX_ATTEMPTS", "3")) # Claims of a work unit before it is given up
+
+# Watch mode
+WATCH_ENABLED = os.getenv("WATCH_ENABLED", "false").lower() == "true" # Process changes reported by inotify as they happen
+WATCH_DEBOUNCE_SECONDS = float(os.getenv("WATCH_DEBOUNCE_SECONDS", "2.0")) # Quiet period before a burst of events is applied
+WATCH_MAX_DELAY_SECONDS = float(os.getenv("WATCH_MAX_DELAY_SECONDS", "30")) # Apply events at the latest this long after the first one
+WATCH_RESCAN_ON_START = os.getenv("WATCH_RESCAN_ON_START", "true").lower() == "true" # Rescan the source tree when watching starts
+WATCH_LEASE_RETRY_SECONDS = float(os.getenv("WATCH_LEASE_RETRY_SECONDS", "5")) # Wait before trying again to apply changes while a scan holds the lease
+WATCH_MAX_QUEUES = int(os.getenv("WATCH_MAX_QUEUES", "32")) # inotify queues, one per top-level directory; an overflow rescans only that directory
+
+# Change detection
+FINGERPRINT_ON_PROCESS = os.getenv("FINGERPRINT_ON_PROCESS", "true").lower() == "true" # Store a content fingerprint when a file is processed
+HASH_ALGORITHM = os.getenv("HASH_ALGORITHM", "blake2b") # Any hashlib name, or xxh3_64/xxh3_128 with xxhash installed
+HASH_WORKER_THREADS = int(os.getenv("HASH_WORKER_THREADS", "4")) # Threads hashing files or chunks of files
+FINGERPRINT_PARALLEL_THRESHOLD = int(os.getenv("FINGERPRINT_PARALLEL_THRESHOLD", str(256 * 1024 ** 2))) # Hash larger files in parallel chunks
+FINGERPRINT_CHUNK_SIZE = int(os.getenv("FINGERPRINT_CHUNK_SIZE", str(64 * 1024 ** 2))) # Chunk size for parallel hashing
+FINGERPRINT_SAMPLE_THRESHOLD = int(os.getenv("FINGERPRINT_SAMPLE_THRESHOLD", "0")) # Only sample files at least this large (0 = never)
+FINGERPRINT_SAMPLE_COUNT = int(os.getenv("FINGERPRINT_SAMPLE_COUNT", "16")) # Samples read from a sampled file
+FINGERPRINT_SAMPLE_SIZE = int(os.getenv("FINGERPRINT_SAMPLE_SIZE", str(1024 ** 2))) # Bytes per sample
+
+# PDF OCR
+PDF_PROCESSING_ENABLED = os.getenv("PDF_PROCESSING_ENABLED", "false").lower() == "true"
+OCR_SLOTS = int(os.getenv("OCR_SLOTS", str(max(1, (os.cpu_count() or 2) // 2)))) # Parallel docling processes
+OCR_TIMEOUT_SECONDS = float(os.getenv("OCR_TIMEOUT_SECONDS", "900")) # Wall-clock limit per attempt, then kill
+OCR_MAX_RETRIES = int(os.getenv("OCR_MAX_RETRIES", "1")) # Extra attempts after a failure or timeout
+OCR_ORDER = os.getenv("OCR_ORDER", "largest") # "largest" (largest PDF first) or "fifo"
+OCR_MAX_PENDING = int(os.getenv("OCR_MAX_PENDING", "64")) # PDFs a scan hands to the scheduler at once
+OCR_OUTPUT_DIR = os.getenv("OCR_OUTPUT_DIR") # Where docling writes its output (current directory if unset)
+OCR_MODE = os.getenv("OCR_MODE", "subprocess") # "subprocess" (docling CLI per PDF) or "worker_pool" (warm workers)
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "4")) # PDFs per request to a warm worker
+OCR_WORKER_MAX_DOCUMENTS = int(os.getenv("OCR_WORKER_MAX_DOCUMENTS", "200")) # Recycle a warm worker after this many PDFs
+OCR_CONVERTER_FACTORY = os.getenv("OCR_CONVERTER_FACTORY") # "module:function" building the converter, docling's if unset
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR") # Content-addressed OCR result cache, disabled if unset
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", str(10 * 1024 ** 3))) # Disk budget, least recently used evicted first
+
+# Instrumentation
+SCAN_PROFILE_INTERVAL = float(os.getenv("SCAN_PROFILE_INTERVAL", "0")) # Seconds between stack samples during a scan, saved under summary.profile (0 = off)
 
 
 POST_PROCESS_SCRIPT_PATH = os.getenv("POST_PROCESS_SCRIPT_PATH") # I did not change it yet in .env
+POST_PROCESS_MODE = os.getenv("POST_PROCESS_MODE", "subprocess") # "subprocess" (interpreter per PDF), "plugin" (entry point on a process pool) or "worker" (long-lived script over stdin/stdout)
+POST_PROCESS_ENTRY_POINT = os.getenv("POST_PROCESS_ENTRY_POINT", "post_process") # Function the plugin mode calls with a PDF path
+POST_PROCESS_WORKERS = int(os.getenv("POST_PROCESS_WORKERS", "2")) # Parallel post-processing slots, each with its own process
+POST_PROCESS_BATCH_SIZE = int(os.getenv("POST_PROCESS_BATCH_SIZE", "8")) # PDFs handed to a plugin or worker process at once
+POST_PROCESS_TIMEOUT_SECONDS = float(os.getenv("POST_PROCESS_TIMEOUT_SECONDS", "300")) # Limit per PDF (per PDF in a batch), then kill
 
 STATUS_PROCESSED = "processed"
 STATUS_DELETED = "deleted"
 STATUS_UPDATED = "updated"
 STATUS_REPROCESSED = "reprocessed"
+STATUS_FAILED = "failed" # Post-processing failed; the next scan processes the file again
 PDF_EXTENSION = '.pdf'
 IGNORED_PREFIXES = ('.', '~') # Ignore hidden/temp files
@@ -0,0 +1,144 @@
+import os
+import time
+import errno
+import fcntl
+import config
+import shutil
+import logging
+import metrics
+import threading
+
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+METHOD_REFLINK = "reflink"                 # FICLONE ioctl: shares extents, no data is copied
+METHOD_HARDLINK = "hardlink"               # Output is another name for the source file
+METHOD_COPY_FILE_RANGE = "copy_file_range" # In-kernel copy, may be offloaded by the filesystem
+METHOD_SENDFILE = "sendfile"               # In-kernel copy through the page cache
+METHOD_COPY = "copy"                       # shutil.copy2, always available
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) from <linux/fs.h>
+
+# Errors meaning "this method does not work here", after which the next method is tried
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS, errno.EINVAL,
+    errno.ENOTTY, errno.EPERM, errno.EBADF
+}
+
+# (method, source device, destination device) combinations known not to work
+_unsupported = set()
+_unsupported_lock = threading.Lock()
+
+
+class CopyResult(NamedTuple):
+    method: str
+    size: int # Bytes in the output, which differs from the caller's size if the source changed meanwhile
+    duration_seconds: float
+
+
+# Each method copies the whole source, up to its end at the time of the copy, and returns the bytes
+# copied. ``size`` is the caller's earlier stat of the source, only a hint for the first chunk.
+
+def _reflink(source: str, destination: str, size: int) -> int:
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return os.fstat(dst.fileno()).st_size
+
+
+def _hardlink(source: str, destination: str, size: int) -> int:
+    os.link(source, destination)
+    return os.stat(destination).st_size
+
+
+def _chunk(size: int, copied: int) -> int:
+    """Bytes to ask for next: what is left of the expected size, or a whole chunk past it"""
+    remaining = size - copied
+    return min(remaining, config.COPY_CHUNK_SIZE) if remaining > 0 else config.COPY_CHUNK_SIZE
+
+
+def _copy_file_range(source: str, destination: str, size: int) -> int:
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        total = 0
+        while True:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), _chunk(size, total))
+            if copied == 0:
+                return total
+            total += copied
+
+
+def _sendfile(source: str, destination: str, size: int) -> int:
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        offset = 0
+        while True:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, _chunk(size, offset))
+            if sent == 0:
+                return offset
+            offset += sent
+
+
+def _copy(source: str, destination: str, size: int) -> int:
+    shutil.copy2(source, destination)
+    return os.stat(destination).st_size
+
+
+_METHODS = {
+    METHOD_REFLINK: _reflink,
+    METHOD_HARDLINK: _hardlink,
+    METHOD_COPY_FILE_RANGE: _copy_file_range,
+    METHOD_SENDFILE: _sendfile,
+    METHOD_COPY: _copy
+}
+
+
+def _remove_partial(destination: str) -> None:
+    try:
+        os.unlink(destination)
+    except FileNotFoundError:
+        pass
+
+
+def copy_file(source: str, destination: str, size: int = None) -> CopyResult:
+    """Copy source to destination with the first method of COPY_METHODS that works. Blocking.
+
+    Like shutil.copy2, the whole source is copied, also if it grew since
+    ``size`` was taken, and permission bits and timestamps are preserved. A method
+    that fails as unsupported is skipped for that pair of devices from then on.
+    """
+    if size is None:
+        size = os.path.getsize(source)
+    devices = (os.stat(source).st_dev, os.stat(os.path.dirname(destination) or ".").st_dev)
+
+    for method in config.COPY_METHODS:
+        if method not in _METHODS:
+            raise ValueError(f"Unknown copy method in COPY_METHODS: {method}")
+        if method != METHOD_COPY:
+            with _unsupported_lock:
+                if (method, *devices) in _unsupported:
+                    continue
+
+        start_time = time.monotonic()
+        try:
+            copied = _METHODS[method](source, destination, size)
+            if method not in (METHOD_HARDLINK, METHOD_COPY):
+                shutil.copystat(source, destination)
+        except OSError as e:
+            _remove_partial(destination)
+            if method == METHOD_COPY or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            with _unsupported_lock:
+                _unsupported.add((method, *devices))
+            logger.info(f"Copy method {method} unavailable from device {devices[0]} to {devices[1]}: {e}")
+            continue
+        return _recorded(CopyResult(method, copied, time.monotonic() - start_time))
+
+    # Every configured method was unsupported
+    start_time = time.monotonic()
+    copied = _copy(source, destination, size)
+    return _recorded(CopyResult(METHOD_COPY, copied, time.monotonic() - start_time))
+
+
+def _recorded(result: CopyResult) -> CopyResult:
+    metrics.COPY_SECONDS.labels(result.method).observe(result.duration_seconds)
+    metrics.COPY_BYTES.labels(result.method).inc(result.size)
+    return result
@@ -1,21 +1,177 @@
+import re
+import os
+import time
 import config
+import metrics
+import schema
+import asyncio
 import logging
-from datetime import datetime
-from typing import Dict, Optional
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+from pymongo import InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from storage import (
+    STORAGE_MONGO, STORAGE_SQLITE, UNIT_CLAIMED, UNIT_PENDING, DirectorySnapshot, FileRecord, StorageBackend,
+    add_to_index
+)
 
 logger = logging.getLogger(__name__)
 
-class DatabaseHandler:
-    def __init__(self):
+# Fields needed to decide new/changed/deleted during a scan
+FILE_INDEX_PROJECTION = {
+    "_id": 0, "file_path": 1, "size": 1, "modified": 1, "status": 1, "hash": 1, "mtime_ns": 1, "inode": 1,
+    "output_path": 1
+}
+
+# Scan header fields returned unless the full report is requested
+SCAN_SUMMARY_PROJECTION = {"results": 0}
+
+
+def path_prefix_filter(field: str, root: str) -> dict:
+    """Query matching root itself and every path below it (anchored regex, so it can use an index)"""
+    root = root.rstrip(os.sep)
+    if not root:
+        return {field: {"$regex": f"^{re.escape(os.sep)}"}}
+    return {field: {"$regex": f"^{re.escape(root)}($|{re.escape(os.sep)})"}}
+
+
+class WriteBatcher:
+    """Collects file record writes and flushes them as unordered bulk_write batches.
+
+    A flush happens when BULK_WRITE_BATCH_SIZE operations are queued, when
+    BULK_WRITE_FLUSH_INTERVAL seconds have passed since the last flush, and
+    once more on close(). Per-item failures are collected in ``errors`` in the
+    same shape as scan report errors.
+    """
+
+    def __init__(self, collection, batch_size: int, flush_interval: float):
+        self._collection = collection
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._ops: list = []
+        self._paths: List[str] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._last_flush = time.monotonic()
+        self.errors: List[dict] = []
+        self.round_trips = 0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self) -> None:
+        """Start the background task enforcing the flush interval"""
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        """Stop the interval task and flush whatever is still queued"""
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+            self._timer = None
+        await self.flush()
+
+    async def insert(self, file_data: dict) -> None:
+        """Queue a new file record"""
+        file_data["processed_time"] = datetime.utcnow()
+        await self._add(InsertOne(file_data), file_data["file_path"])
+
+    async def upsert(self, file_data: dict) -> None:
+        """Queue a file record, replacing the fields of any record with the same path"""
+        file_data["processed_time"] = datetime.utcnow()
+        await self._add(
+            UpdateOne({"file_path": file_data["file_path"]}, {"$set": file_data}, upsert=True),
+            file_data["file_path"]
+        )
+
+    async def update_status(self, file_path: str, status: str, metadata: dict = None) -> None:
+        """Queue a status change, same semantics as DatabaseHandler.update_file_status"""
+        update_data = {
+            "status": status,
+            "last_updated": datetime.utcnow()
+        }
+        if metadata:
+            update_data.update(metadata)
+        await self._add(UpdateOne({"file_path": file_path}, {"$set": update_data}), file_path)
+
+    async def update_metadata(self, file_path: str, metadata: dict) -> None:
+        """Queue an update of record fields that leaves the status alone"""
+        await self._add(UpdateOne({"file_path": file_path}, {"$set": metadata}), file_path)
+
+    async def _add(self, operation, file_path: str) -> None:
+        self._ops.append(operation)
+        self._paths.append(file_path)
+        if len(self._ops) >= self._batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Send all queued operations in one unordered bulk_write"""
+        async with self._lock:
+            operations, paths = self._ops, self._paths
+            self._ops, self._paths = [], []
+            self._last_flush = time.monotonic()
+            if not operations:
+                return
+
+            self.round_trips += 1
+            with metrics.DB_SECONDS.labels("write_batch").time():
+                await self._write(operations, paths)
+
+    async def _write(self, operations: list, paths: List[str]) -> None:
+        """Apply one batch of queued operations, collecting per-item failures in ``errors``"""
+        try:
+            result = await self._collection.bulk_write(operations, ordered=False)
+            logger.info(
+                f"Flushed {len(operations)} file writes "
+                f"(inserted: {result.inserted_count}, modified: {result.modified_count}, upserted: {result.upserted_count})"
+            )
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            logger.error(f"Bulk write finished with {len(write_errors)} failed operations")
+            for error in write_errors:
+                self.errors.append({
+                    "path": paths[error["index"]],
+                    "error": f"Database write failed: {error.get('errmsg')}"
+                })
+        except Exception as e:
+            logger.error(f"Bulk write of {len(operations)} operations failed: {e}")
+            for path in paths:
+                self.errors.append({
+                    "path": path,
+                    "error": f"Database write failed: {str(e)}"
+                })
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self._ops and time.monotonic() - self._last_flush >= self._flush_interval:
+                await self.flush()
+
+
+class DatabaseHandler(StorageBackend):
+    """StorageBackend on MongoDB. uri and db_name default to MONGO_URI and DB_NAME."""
+
+    def __init__(self, uri: Optional[str] = None, db_name: Optional[str] = None):
+        self._uri = uri or config.MONGO_URI
+        self._db_name = db_name or config.DB_NAME
         self._client: Optional[AsyncIOMotorClient] = None
         self._db: Optional[AsyncIOMotorDatabase] = None
 
     async def initialize(self) -> None:
         """Initialize database connection and create collection if not exists"""
         try:
-            self._client = AsyncIOMotorClient(config.MONGO_URI)
-            self._db = self._client[config.DB_NAME]
+            self._client = AsyncIOMotorClient(self._uri)
+            self._db = self._client[self._db_name]
             
             # Test connection
             await self._db.command('ping')
@@ -31,12 +187,24 @@ class DatabaseHandler:
             logger.error(f"Failed to initialize MongoDB: {e}")
             raise
 
+    @property
+    def database(self) -> AsyncIOMotorDatabase:
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db
+
     async def close(self) -> None:
         """Close database connection"""
         if self._client:
             self._client.close()
             logger.info("MongoDB connection closed")
 
+    async def bootstrap(self) -> None:
+        await schema.bootstrap(self.database)
+
+    async def explain_hot_queries(self) -> List[dict]:
+        return await schema.explain_hot_queries(self.database)
+
     async def test_connection(self) -> bool:
         """Check if database connection is alive"""
         try:
@@ -53,24 +221,161 @@ class DatabaseHandler:
             raise RuntimeError("Database not initialized. Call initialize() first.")
         return self._db[f"{config.COLLECTION_NAME}_files"]
 
+    @property
+    def _dirs_collection(self):
+        """Get the directory snapshot collection"""
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.COLLECTION_NAME}_dirs"]
+
+    @property
+    def _ocr_cache_collection(self):
+        """Get the OCR result cache collection"""
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.COLLECTION_NAME}_ocr_cache"]
+
+    @property
+    def _blobs_collection(self):
+        """Get the deduplicated output blob collection"""
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.COLLECTION_NAME}_blobs"]
+
+    @property
+    def _blob_refs_collection(self):
+        """Get the source path -> blob reference collection"""
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.COLLECTION_NAME}_blob_refs"]
+
+    @property
+    def _leases_collection(self):
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.COLLECTION_NAME}_leases"]
+
+    @property
+    def _work_units_collection(self):
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.COLLECTION_NAME}_work_units"]
+
+    @property
+    def _results_collection(self):
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[config.RESULTS_COLLECTION]
+
+    @property
+    def _result_entries_collection(self):
+        """Get the per-entry scan report collection"""
+        if self._db is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        return self._db[f"{config.RESULTS_COLLECTION}_entries"]
+
+    async def create_scan_header(self, header: dict) -> None:
+        await self._results_collection.insert_one(header)
+
+    async def update_scan_header(self, scan_id, fields: dict) -> None:
+        await self._results_collection.update_one({"_id": scan_id}, {"$set": fields})
+
+    async def insert_scan_entries(self, entries: List[dict]) -> None:
+        await self._result_entries_collection.insert_many(entries, ordered=False)
+
+    def iter_scan_entries(self, scan_id, section: Optional[str] = None, after: Optional[ObjectId] = None,
+                          limit: int = 0):
+        """Cursor over a scan's report entries in insertion order, optionally of one section.
+
+        ``after`` is the ``_id`` of the last entry of the previous page.
+        """
+        query = {"scan_id": scan_id}
+        if section is not None:
+            query["section"] = section
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return self._result_entries_collection.find(query, {"scan_id": 0}).sort("_id", 1).limit(limit)
+
+    def iter_scan_headers(self, after: Optional[str] = None, limit: int = 0, full: bool = False):
+        """Cursor over scan headers, newest first.
+
+        ``after`` is the id or timestamp of the last scan of the previous page.
+        Documents saved before reports were streamed keep their whole report
+        under ``results``, which is only returned with ``full``.
+        """
+        query = {}
+        if after is not None:
+            query = {"_id": {"$lt": ObjectId(after)}} if ObjectId.is_valid(after) else {"timestamp": {"$lt": after}}
+        projection = None if full else SCAN_SUMMARY_PROJECTION
+        return self._results_collection.find(query, projection).sort("_id", -1).limit(limit)
+
+    async def find_scan_header(self, scan: Optional[str] = None, full: bool = False) -> Optional[dict]:
+        """The scan with the given id or timestamp, or the most recent one"""
+        query = {}
+        if scan is not None:
+            query = {"_id": ObjectId(scan)} if ObjectId.is_valid(scan) else {"timestamp": scan}
+        projection = None if full else SCAN_SUMMARY_PROJECTION
+        return await self._results_collection.find_one(query, projection, sort=[("_id", -1)])
+
+    async def find_scans_with_status(self, status: str) -> List[dict]:
+        cursor = self._results_collection.find({"status": status}, SCAN_SUMMARY_PROJECTION).sort("_id", 1)
+        return await cursor.to_list(length=None)
+
+    async def delete_scan_entries(self, scan_id, after_seq: int, entry_ids: Iterable = ()) -> None:
+        await self._result_entries_collection.delete_many({
+            "scan_id": scan_id,
+            "$or": [{"seq": {"$gt": after_seq}}, {"_id": {"$in": list(entry_ids)}}]
+        })
 
-    async def save_scan_results(self, scan_results: dict):
-        """Save scan results to results collection"""
+    async def delete_unit_entries(self, scan_id, unit_id) -> None:
+        await self._result_entries_collection.delete_many({"scan_id": scan_id, "unit": unit_id})
+
+    async def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        now = datetime.utcnow()
         try:
-            collection = self._db[config.RESULTS_COLLECTION]
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            
-            document = {
-                "timestamp": timestamp,
-                "results": scan_results
-            }
-            
-            result = await collection.insert_one(document)
-            logger.info(f"Successfully saved scan results with ID: {result.inserted_id}")
-            return result
-        except Exception as e:
-            logger.error(f"Failed to save scan results: {e}")
-            raise
+            # When another owner holds it unexpired the filter misses and the upsert hits the unique _id
+            await self._leases_collection.update_one(
+                {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds), "renewed_at": now}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        await self._leases_collection.delete_one({"_id": name, "owner": owner})
+
+    async def insert_work_units(self, units: List[dict]) -> None:
+        if units:
+            await self._work_units_collection.insert_many(units, ordered=False)
+
+    async def claim_work_unit(self, owner: str, seconds: float, max_attempts: int) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self._work_units_collection.find_one_and_update(
+            {
+                "status": {"$in": [UNIT_PENDING, UNIT_CLAIMED]},
+                "lease_expires_at": {"$lt": now},
+                "attempts": {"$lt": max_attempts}
+            },
+            {
+                "$set": {"status": UNIT_CLAIMED, "owner": owner, "lease_expires_at": now + timedelta(seconds=seconds)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def update_work_unit(self, unit_id, owner: Optional[str], fields: dict) -> bool:
+        result = await self._work_units_collection.update_one({"_id": unit_id, "owner": owner}, {"$set": fields})
+        return result.matched_count == 1
+
+    async def find_work_units(self, scan_id) -> List[dict]:
+        cursor = self._work_units_collection.find({"scan_id": scan_id}, {"missing_outputs": 0}).sort("_id", 1)
+        return await cursor.to_list(length=None)
+
+    async def delete_work_units(self, scan_id) -> None:
+        await self._work_units_collection.delete_many({"scan_id": scan_id})
 
     async def get_processed_file(self, file_path: str):
         """Get file record from database"""
@@ -83,21 +388,64 @@ class DatabaseHandler:
         cursor = collection.find({"status": config.STATUS_PROCESSED})
         return await cursor.to_list(length=None)
 
-    async def update_file_status(self, file_path: str, status: str):
-        """Update file status in database"""
-        collection = self._db[f"{config.COLLECTION_NAME}_files"]
-        await collection.update_one(
-            {"file_path": file_path},
-            {"$set": {"status": status, "updated_at": datetime.utcnow()}}
-        )
+    async def load_file_index(self, root: Optional[str] = None, recursive: bool = True) -> Dict[str, FileRecord]:
+        """Load the state of every tracked file (below root, if given) with a single projected cursor"""
+        index: Dict[str, FileRecord] = {}
+        query = {}
+        if root is not None:
+            query = path_prefix_filter("file_path", root) if recursive else {"directory": root.rstrip(os.sep)}
+        cursor = self._files_collection.find(query, FILE_INDEX_PROJECTION).batch_size(config.INDEX_LOAD_BATCH_SIZE)
+        async for doc in cursor:
+            add_to_index(index, doc)
+        logger.info(f"Loaded file index with {len(index)} records")
+        return index
+
+    async def get_files_by_paths(self, file_paths: Iterable[str]) -> Dict[str, FileRecord]:
+        """Get the state of the given files, querying in chunks with $in"""
+        index: Dict[str, FileRecord] = {}
+        paths = list(file_paths)
+        for start in range(0, len(paths), config.PATH_LOOKUP_CHUNK_SIZE):
+            chunk = paths[start:start + config.PATH_LOOKUP_CHUNK_SIZE]
+            cursor = self._files_collection.find({"file_path": {"$in": chunk}}, FILE_INDEX_PROJECTION)
+            async for doc in cursor:
+                add_to_index(index, doc)
+        return index
+
+    def iter_file_index(self, root: str, after: Optional[str] = None, limit: int = 0):
+        """Cursor over the index fields of the tracked files below root, sorted by file_path (served by its unique index).
+
+        ``after`` is the file_path of the last record of the previous page.
+        """
+        query = path_prefix_filter("file_path", root)
+        if after is not None:
+            query = {"$and": [query, {"file_path": {"$gt": after}}]}
+        return self._files_collection.find(query, FILE_INDEX_PROJECTION).sort("file_path", 1).limit(limit)
+
+    def iter_output_records(self):
+        """Cursor over the source path, output path and signature of every record that has an output"""
+        return self._files_collection.find(
+            {"output_path": {"$exists": True}},
+            {"_id": 0, "file_path": 1, "output_path": 1, "status": 1, "size": 1, "mtime_ns": 1, "blob_digest": 1,
+             "output_size": 1}
+        ).batch_size(config.INDEX_LOAD_BATCH_SIZE)
+
+    async def get_processed_file_paths(self, root: Optional[str] = None) -> set:
+        """Get the paths of all files currently marked as processed, optionally only those below root"""
+        query = {"status": config.STATUS_PROCESSED}
+        if root is not None:
+            query.update(path_prefix_filter("file_path", root))
+        cursor = self._files_collection.find(
+            query, {"_id": 0, "file_path": 1}
+        ).batch_size(config.INDEX_LOAD_BATCH_SIZE)
+        return {doc["file_path"] async for doc in cursor}
 
     async def insert_processed_file(self, file_data: dict):
-        """Insert new processed file record"""
+        """Insert a processed file record, or update the record with the same path (file_path is unique)"""
         try:
             collection = self._files_collection
             file_data["processed_time"] = datetime.utcnow()
-            result = await collection.insert_one(file_data)
-            logger.info(f"Successfully inserted document with ID: {result.inserted_id}")
+            result = await collection.update_one({"file_path": file_data["file_path"]}, {"$set": file_data}, upsert=True)
+            logger.info(f"Successfully saved document for {file_data['file_path']}")
             logger.debug(f"Inserted file data: {file_data}")
             return result
         except Exception as e:
@@ -120,6 +468,14 @@ class DatabaseHandler:
             {"$set": update_data}
         )
 
+    def write_batcher(self) -> WriteBatcher:
+        """Create a write-behind batcher for the files collection"""
+        return WriteBatcher(
+            self._files_collection,
+            config.BULK_WRITE_BATCH_SIZE,
+            config.BULK_WRITE_FLUSH_INTERVAL
+        )
+
     async def delete_file_record(self, file_path: str):
         """Delete a file record from database"""
         collection = self._files_collection
@@ -134,4 +490,127 @@ class DatabaseHandler:
         )
         return await cursor.to_list(length=None)
 
-db_handler = DatabaseHandler()
\ No newline at end of file
+    async def get_ocr_cache_entry(self, digest: str) -> Optional[dict]:
+        """Get a cached OCR result and mark it as recently used"""
+        return await self._ocr_cache_collection.find_one_and_update(
+            {"_id": digest},
+            {"$set": {"last_access": datetime.utcnow()}, "$inc": {"hits": 1}}
+        )
+
+    async def save_ocr_cache_entry(self, digest: str, entry: dict) -> None:
+        """Create or update a cached OCR result"""
+        entry["last_access"] = datetime.utcnow()
+        await self._ocr_cache_collection.update_one(
+            {"_id": digest},
+            {"$set": entry, "$setOnInsert": {"created": datetime.utcnow(), "hits": 0}},
+            upsert=True
+        )
+
+    async def delete_ocr_cache_entry(self, digest: str) -> None:
+        """Remove a cached OCR result"""
+        await self._ocr_cache_collection.delete_one({"_id": digest})
+
+    async def get_ocr_cache_size(self) -> int:
+        """Total bytes of cached OCR output"""
+        cursor = self._ocr_cache_collection.aggregate([{"$group": {"_id": None, "total": {"$sum": "$size"}}}])
+        result = await cursor.to_list(length=1)
+        return result[0]["total"] if result else 0
+
+    def iter_ocr_cache_lru(self):
+        """Cached OCR results, least recently used first"""
+        return self._ocr_cache_collection.find(
+            {}, {"_id": 1, "output_location": 1, "size": 1}
+        ).sort("last_access", 1)
+
+    async def load_directory_snapshots(self, root: str) -> Dict[str, DirectorySnapshot]:
+        """Load the snapshots of root and every directory below it"""
+        snapshots: Dict[str, DirectorySnapshot] = {}
+        cursor = self._dirs_collection.find(
+            path_prefix_filter("path", root), {"_id": 0, "scanned_at": 0}
+        ).batch_size(config.INDEX_LOAD_BATCH_SIZE)
+        async for doc in cursor:
+            snapshots[doc["path"]] = DirectorySnapshot(
+                doc["mtime_ns"], doc.get("file_count", 0), doc.get("subdirectories", []), doc["files_digest"],
+                doc["digest"], doc.get("complete", False)
+            )
+        logger.info(f"Loaded {len(snapshots)} directory snapshots below {root}")
+        return snapshots
+
+    async def save_directory_snapshots(self, snapshots: List[dict]) -> None:
+        """Replace directory snapshots in unordered bulk writes"""
+        scanned_at = datetime.utcnow()
+        for start in range(0, len(snapshots), config.BULK_WRITE_BATCH_SIZE):
+            operations = [
+                ReplaceOne({"path": snapshot["path"]}, {**snapshot, "scanned_at": scanned_at}, upsert=True)
+                for snapshot in snapshots[start:start + config.BULK_WRITE_BATCH_SIZE]
+            ]
+            await self._dirs_collection.bulk_write(operations, ordered=False)
+
+    async def delete_directory_snapshots(self, paths: Iterable[str]) -> None:
+        """Drop snapshots of directories that no longer exist"""
+        paths = list(paths)
+        for start in range(0, len(paths), config.PATH_LOOKUP_CHUNK_SIZE):
+            await self._dirs_collection.delete_many(
+                {"path": {"$in": paths[start:start + config.PATH_LOOKUP_CHUNK_SIZE]}}
+            )
+
+    async def set_blob_reference(self, file_path: str, digest: str, blob: dict) -> None:
+        """Point file_path at a blob, moving its reference count over from the blob it used before"""
+        previous = await self._blob_refs_collection.find_one_and_update(
+            {"_id": file_path},
+            {"$set": {"digest": digest, "updated_at": datetime.utcnow()}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        previous_digest = previous["digest"] if previous else None
+        if previous_digest == digest:
+            return
+        operations = [UpdateOne(
+            {"_id": digest},
+            {"$inc": {"refs": 1}, "$setOnInsert": {**blob, "created_at": datetime.utcnow()}},
+            upsert=True
+        )]
+        if previous_digest is not None:
+            operations.append(UpdateOne({"_id": previous_digest}, {"$inc": {"refs": -1}}))
+        await self._blobs_collection.bulk_write(operations, ordered=False)
+
+    async def release_blob_references(self, file_paths: Iterable[str]) -> None:
+        """Drop the blob references of removed source files"""
+        paths = list(file_paths)
+        for start in range(0, len(paths), config.PATH_LOOKUP_CHUNK_SIZE):
+            chunk = {"_id": {"$in": paths[start:start + config.PATH_LOOKUP_CHUNK_SIZE]}}
+            released: Dict[str, int] = {}
+            async for ref in self._blob_refs_collection.find(chunk, {"digest": 1}):
+                released[ref["digest"]] = released.get(ref["digest"], 0) + 1
+            if not released:
+                continue
+            await self._blob_refs_collection.delete_many(chunk)
+            await self._blobs_collection.bulk_write([
+                UpdateOne({"_id": digest}, {"$inc": {"refs": -count}})
+                for digest, count in released.items()
+            ], ordered=False)
+
+    async def get_unreferenced_blobs(self) -> List[dict]:
+        cursor = self._blobs_collection.find({"refs": {"$lte": 0}}, {"_id": 1, "path": 1, "size": 1})
+        return await cursor.to_list(length=None)
+
+    async def delete_unreferenced_blobs(self, digests: List[str]) -> None:
+        for start in range(0, len(digests), config.PATH_LOOKUP_CHUNK_SIZE):
+            await self._blobs_collection.delete_many({
+                "_id": {"$in": digests[start:start + config.PATH_LOOKUP_CHUNK_SIZE]},
+                "refs": {"$lte": 0}
+            })
+
+
+def create_db_handler(backend: Optional[str] = None) -> StorageBackend:
+    """The StorageBackend selected by STORAGE_BACKEND"""
+    backend = backend or config.STORAGE_BACKEND
+    if backend == STORAGE_MONGO:
+        return DatabaseHandler()
+    if backend == STORAGE_SQLITE:
+        from sqlite_handler import SQLiteDatabaseHandler
+        return SQLiteDatabaseHandler()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+db_handler = create_db_handler()
\ No newline at end of file
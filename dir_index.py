@@ -0,0 +1,117 @@
+import os
+import config
+import hashlib
+import logging
+
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Values of DIR_SNAPSHOT_MODE
+SNAPSHOT_MODE_OFF = "off"
+SNAPSHOT_MODE_INCREMENTAL = "incremental"
+
+
+def _new_digest():
+    return hashlib.blake2b(digest_size=20)
+
+
+def files_digest(files) -> str:
+    """Digest of a directory's own files: their names, sizes and mtimes"""
+    digest = _new_digest()
+    for name, size, mtime_ns in sorted((os.path.basename(entry.path), entry.size, entry.mtime_ns) for entry in files):
+        digest.update(f"{name}\0{size}\0{mtime_ns}\n".encode(errors="surrogateescape"))
+    return digest.hexdigest()
+
+
+def tree_digest(own_files_digest: str, children: List[tuple]) -> str:
+    """Merkle digest of a directory: its files digest plus the (name, digest) of each subdirectory"""
+    digest = _new_digest()
+    digest.update(own_files_digest.encode())
+    for name, child_digest in sorted(children):
+        digest.update(f"\n{name}\0{child_digest}".encode(errors="surrogateescape"))
+    return digest.hexdigest()
+
+
+class DirectoryIndexBuilder:
+    """Collects the directories visited by a scan and turns them into snapshot documents.
+
+    A directory's snapshot is ``complete`` when every file listed in it ended
+    the scan skipped or processed, so a later scan may prune it without
+    retrying anything. Pruned directories keep their stored files digest.
+    Settlement is tracked as the scan reports entries (see ``observe``), so
+    only a digest and the still unsettled paths are kept per directory.
+    """
+
+    def __init__(self, root: str, snapshots: Dict[str, object]):
+        self.root = root
+        self.snapshots = snapshots
+        self.directories = {}
+        self._unsettled = {}
+        self._failed = set()
+
+    @staticmethod
+    def _needs_settling(entry) -> bool:
+        if entry.size == 0:
+            return False
+        return config.PDF_PROCESSING_ENABLED or not entry.path.lower().endswith(config.PDF_EXTENSION)
+
+    def add(self, listing) -> None:
+        if listing.mtime_ns is None:
+            return
+        if listing.pruned:
+            snapshot = self.snapshots[listing.path]
+            own_digest, file_count = snapshot.files_digest, snapshot.file_count
+        else:
+            own_digest, file_count = files_digest(listing.files), len(listing.files)
+            unsettled = {entry.path for entry in listing.files if self._needs_settling(entry)}
+            if unsettled:
+                self._unsettled[listing.path] = unsettled
+        self.directories[listing.path] = (
+            listing.mtime_ns, file_count, listing.subdirectories, own_digest, listing.pruned
+        )
+
+    def observe(self, section: str, entry: dict) -> None:
+        """ScanReport observer: settle processed and skipped files, remember directories with errors"""
+        if section in ("processed_files", "skipped_files"):
+            unsettled = self._unsettled.get(os.path.dirname(entry["path"]))
+            if unsettled is not None:
+                unsettled.discard(entry["path"])
+        elif section == "errors":
+            self._failed.add(os.path.dirname(entry["path"]))
+
+    def finalize(self):
+        """Build the snapshot documents and a summary from the visited directories"""
+        digests = {}
+        documents = []
+        listed = pruned = 0
+        # Deepest directories first, so every child digest exists before its parent's
+        for path in sorted(self.directories, key=lambda item: item.count(os.sep), reverse=True):
+            mtime_ns, file_count, subdirectories, own_digest, was_pruned = self.directories[path]
+            if was_pruned:
+                pruned += 1
+            else:
+                listed += 1
+            names = [os.path.basename(subdirectory) for subdirectory in subdirectories]
+            children = [(name, digests.get(subdirectory, "")) for name, subdirectory in zip(names, subdirectories)]
+            digests[path] = tree_digest(own_digest, children)
+            documents.append({
+                "path": path,
+                "mtime_ns": mtime_ns,
+                "file_count": file_count,
+                "subdirectories": names,
+                "files_digest": own_digest,
+                "digest": digests[path],
+                "complete": was_pruned or (path not in self._failed and not self._unsettled.get(path))
+            })
+
+        summary = {
+            "root_digest": digests.get(self.root),
+            "directories_listed": listed,
+            "directories_pruned": pruned
+        }
+        return documents, summary
+
+    def stale_paths(self) -> set:
+        """Stored snapshots below the root that this scan did not reach"""
+        return set(self.snapshots) - set(self.directories)
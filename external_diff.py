@@ -0,0 +1,228 @@
+"""Diff of the source tree against the tracked files in bounded memory (SCAN_DIFF_MODE=external).
+
+The in-memory diff holds every path found on disk and every tracked record
+below the scanned directory at once, which does not fit for tens of
+millions of files. Here the walk is sorted by path in runs of
+SCAN_DIFF_RUN_SIZE entries, spilled to SCAN_SPILL_DIR when there is more
+than one, and the merged runs are joined with the tracked records paged
+from the database in file_path order. In that single pass every path is
+new, tracked (the classifier then finds it unchanged or changed) or
+deleted; deleted paths are spilled as well until the scan applies them.
+"""
+import heapq
+import pickle
+import utils
+import config
+import walker
+import logging
+import tempfile
+
+from itertools import islice
+from typing import AsyncIterator, Iterator, List, Optional
+from contextlib import aclosing
+from db_handler import db_handler
+from storage import add_to_index
+
+logger = logging.getLogger(__name__)
+
+# Values of SCAN_DIFF_MODE
+DIFF_MODE_MEMORY = "memory"
+DIFF_MODE_EXTERNAL = "external"
+
+# Items pickled together in a spill file
+_SPILL_CHUNK = 1024
+
+
+class _SpillFile:
+    """Items written to an anonymous temporary file in pickled chunks and read back in the same order. Blocking."""
+
+    def __init__(self, directory: str):
+        self._file = tempfile.TemporaryFile(prefix="scan-spill-", dir=directory or None)
+        self.items = 0
+        self.bytes = 0
+
+    def write(self, items: list) -> None:
+        for start in range(0, len(items), _SPILL_CHUNK):
+            pickle.dump(items[start:start + _SPILL_CHUNK], self._file, pickle.HIGHEST_PROTOCOL)
+        self.items += len(items)
+        self.bytes = self._file.tell()
+
+    def __iter__(self) -> Iterator:
+        # Each run is read by one iterator at a time
+        self._file.flush()
+        self._file.seek(0)
+        while True:
+            try:
+                chunk = pickle.load(self._file)
+            except EOFError:
+                return
+            yield from chunk
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ExternalSorter:
+    """Sorts walker entries by path: runs of run_size entries are sorted and spilled, then merged"""
+
+    def __init__(self, run_size: int, directory: str):
+        self.run_size = max(1, run_size)
+        self.directory = directory
+        self._buffer: List[tuple] = []
+        self._runs: List[_SpillFile] = []
+
+    async def add(self, entries) -> None:
+        self._buffer.extend(tuple(entry) for entry in entries)
+        if len(self._buffer) >= self.run_size:
+            buffer, self._buffer = self._buffer, []
+            self._runs.append(await utils.run_blocking(self._spill, buffer))
+
+    def _spill(self, buffer: List[tuple]) -> _SpillFile:
+        buffer.sort()
+        run = _SpillFile(self.directory)
+        run.write(buffer)
+        return run
+
+    async def batches(self, size: int) -> AsyncIterator[List[walker.WalkEntry]]:
+        """Every entry added, in path order, in batches of size"""
+        await utils.run_blocking(self._buffer.sort)
+        merged = heapq.merge(*self._runs, self._buffer) if self._runs else iter(self._buffer)
+        while True:
+            batch = await utils.run_blocking(lambda: [walker.WalkEntry(*item) for item in islice(merged, size)])
+            if not batch:
+                return
+            yield batch
+
+    def summary(self) -> dict:
+        return {
+            "runs": len(self._runs),
+            "spilled_entries": sum(run.items for run in self._runs),
+            "spilled_bytes": sum(run.bytes for run in self._runs)
+        }
+
+    def close(self) -> None:
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._buffer = []
+
+
+class TrackedRecords(dict):
+    """Records of the entries in flight in the pipeline, handed to the classifier once and then dropped"""
+
+    def get(self, path, default=None):
+        return self.pop(path, default)
+
+
+class SortedDiff:
+    """One scan's walk merged with the tracked files below its directory, in path order.
+
+    collect() sorts the walk; entries() then yields it in batches like
+    walker.walk(), with the record of each tracked entry in ``records``, and
+    finds the deleted files as it goes. Records the scan writes meanwhile are
+    all at or before the merge position, so paging resumes after it.
+    """
+
+    def __init__(self, root: str, report):
+        self.root = root
+        self.report = report
+        self.records = TrackedRecords()
+        self._sorter = ExternalSorter(config.SCAN_DIFF_RUN_SIZE, config.SCAN_SPILL_DIR)
+        self._page: List[dict] = []
+        self._page_index = 0
+        self._pages_done = False
+        self._last_record: Optional[str] = None
+        self._position: Optional[str] = None
+        self._deleted: List[str] = []
+        self._deleted_run: Optional[_SpillFile] = None
+        self.counts = {"new": 0, "tracked": 0, "deleted": 0}
+
+    async def collect(self, entries) -> None:
+        """Sort the walker's batches, until the walk ends or the scan is cancelled"""
+        async with aclosing(entries):
+            async for files in entries:
+                if self.report.cancelled:
+                    return
+                self.report.files_discovered += len(files)
+                await self._sorter.add(files)
+        self.report.walk_finished = True
+
+    async def _next_record(self) -> Optional[dict]:
+        if self._page_index == len(self._page):
+            if self._pages_done:
+                return None
+            after = max((path for path in (self._last_record, self._position) if path is not None), default=None)
+            limit = config.INDEX_LOAD_BATCH_SIZE
+            self._page = await db_handler.iter_file_index(self.root, after=after, limit=limit).to_list(None)
+            self._page_index = 0
+            self._pages_done = len(self._page) < limit
+            if not self._page:
+                return None
+        record = self._page[self._page_index]
+        self._page_index += 1
+        self._last_record = record["file_path"]
+        return record
+
+    async def _tracked_only(self, record: dict) -> None:
+        if record.get("status") != config.STATUS_PROCESSED:
+            return
+        self._deleted.append(record["file_path"])
+        self.counts["deleted"] += 1
+        if len(self._deleted) >= config.INDEX_LOAD_BATCH_SIZE:
+            if self._deleted_run is None:
+                self._deleted_run = _SpillFile(config.SCAN_SPILL_DIR)
+            deleted, self._deleted = self._deleted, []
+            await utils.run_blocking(self._deleted_run.write, deleted)
+
+    async def entries(self) -> AsyncIterator[List[walker.WalkEntry]]:
+        """The sorted walk in batches, leaving out files finished before a resume, until the scan is cancelled"""
+        completed_paths = self.report.completed_paths
+        record = await self._next_record()
+        async for batch in self._sorter.batches(config.INDEX_LOAD_BATCH_SIZE):
+            if self.report.cancelled:
+                return
+            pending = []
+            for entry in batch:
+                while record is not None and record["file_path"] < entry.path:
+                    await self._tracked_only(record)
+                    record = await self._next_record()
+                tracked = record is not None and record["file_path"] == entry.path
+                if tracked:
+                    record_for_entry, record = record, await self._next_record()
+                self._position = entry.path
+                self.counts["tracked" if tracked else "new"] += 1
+                if entry.path in completed_paths:
+                    continue
+                if tracked:
+                    add_to_index(self.records, record_for_entry)
+                pending.append(entry)
+            if pending:
+                yield pending
+        while record is not None:
+            await self._tracked_only(record)
+            record = await self._next_record()
+
+    async def deleted_paths(self) -> AsyncIterator[List[str]]:
+        """Tracked files not found on disk, in chunks; complete once entries() is exhausted"""
+        if self._deleted_run is not None:
+            paths = iter(self._deleted_run)
+            while True:
+                chunk = await utils.run_blocking(lambda: list(islice(paths, config.INDEX_LOAD_BATCH_SIZE)))
+                if not chunk:
+                    break
+                yield chunk
+        if self._deleted:
+            yield self._deleted
+
+    def summary(self) -> dict:
+        summary = {"mode": DIFF_MODE_EXTERNAL, **self.counts, **self._sorter.summary()}
+        if self._deleted_run is not None:
+            summary["spilled_entries"] += self._deleted_run.items
+            summary["spilled_bytes"] += self._deleted_run.bytes
+        return summary
+
+    def close(self) -> None:
+        self._sorter.close()
+        if self._deleted_run is not None:
+            self._deleted_run.close()
+            self._deleted_run = None
@@ -1,211 +1,980 @@
 import os
-import sys
-import time
 import utils
+import asyncio
 import config 
-import shutil
+import threading
+import walker
 import logging
-import subprocess
+import metrics
+import cas_store
+import copy_engine
+import output_sync
+import dir_index
+import fingerprint
+import external_diff
 
+from time import perf_counter
 from datetime import datetime
+from contextlib import aclosing
 from db_handler import db_handler
 from utils import generate_unique_output_path
+from scan_report import ScanReport, UnitReport, STATUS_CANCELLED, STATUS_COMPLETED, STATUS_FAILED
+from ocr_cache import (
+    ocr_cache, file_digest, job_output_dir, discard_job_output, ocr_output_dir, ocr_output_path, publish_output,
+    OCR_OUTPUT_EXTENSION
+)
+from ocr_scheduler import ocr_scheduler, OCR_SUCCEEDED, OCR_CACHED
+from post_processing import post_processor, POST_PROCESS_SUCCEEDED
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Outcomes of classifying a file found on disk
+ACTION_PROCESS = "process"
+ACTION_SKIP = "skip"
 
-def run_post_processing(original_pdf_path):
-    if not config.POST_PROCESS_SCRIPT_PATH:
-        print("  (No post-processing script configured in .env)")
-        return True # Indicate success if no script defined
+# Sentinel closing a pipeline stage queue
+_STAGE_DONE = object()
 
-    if not os.path.exists(config.POST_PROCESS_SCRIPT_PATH):
-        print(f"  [!] Error: Post-processing script not found at: {config.POST_PROCESS_SCRIPT_PATH}")
-        return False
+# Held while a scan or a batch of watched changes updates the tracked state
+_scan_lock = asyncio.Lock()
 
-    print(f"  Running post-processing script: {config.POST_PROCESS_SCRIPT_PATH} for {original_pdf_path}")
-    try:
-        # Example: Pass the original PDF path to the script
-        post_process_command = [sys.executable, config.POST_PROCESS_SCRIPT_PATH, "--input-pdf", original_pdf_path]
 
-        print(f"    Command: {' '.join(post_process_command)}")
-        result = subprocess.run(post_process_command, capture_output=True, text=True, check=True)
-        print(f"    Post-processing script stdout:\n{result.stdout}")
-        if result.stderr:
-             print(f"    Post-processing script stderr:\n{result.stderr}")
-        print(f"  [✓] Post-processing completed successfully.")
-        return True
+async def process_pdf_file(original_file_path, report=None, batcher=None, signature=None, previous_output=None,
+                           naming=None):
+    """OCR a PDF and post-process it; returns its absolute path, or None if OCR failed.
 
-    except FileNotFoundError:
-         print(f"  [X] CRITICAL ERROR: Python interpreter or post-process script not found.")
-         return False
-    except subprocess.CalledProcessError as e:
-        print(f"  [!] Error during post-processing script execution (Return Code: {e.returncode}).")
-        print(f"    Stdout: {e.stdout}")
-        print(f"    Stderr: {e.stderr}")
-        return False
-    except Exception as e:
-        print(f"  [X] An unexpected Python error occurred during post-processing: {e}")
-        return False
+    A PDF that got through OCR is recorded like a copied file, along with its
+    post-processing result. ``signature`` is the walker entry if the caller
+    already stat'ed the file. Docling writes into a directory of its own, and
+    the markdown is then published to OCR_OUTPUT_DIR under a name allocated
+    like a copy's (see utils.generate_unique_output_path), which becomes the
+    record's output. ``previous_output`` is the output of the PDF's record,
+    which a changed PDF's new output replaces in place. ``naming`` overrides
+    OUTPUT_NAMING.
+    """
+    if not config.PDF_PROCESSING_ENABLED:
+        return None
+    job_dir = job_output_dir()
+    try:
+        return await _process_pdf_file(original_file_path, job_dir, report, batcher, signature, previous_output, naming)
+    finally:
+        await utils.run_blocking(discard_job_output, job_dir)
 
 
-async def process_pdf_file(original_file_path):
-    return None
+async def _process_pdf_file(original_file_path, job_dir, report, batcher, signature, previous_output, naming):
     absolute_pdf_path = os.path.abspath(original_file_path)
     print(f"  Processing PDF: {os.path.basename(absolute_pdf_path)}")
 
-    command_to_run = ["docling", "--pipeline", "vlm", "--vlm-model", "smoldocling", absolute_pdf_path]
-    print(f"    Running OCR command: {' '.join(command_to_run)}")
-
-    start_time = time.time()
-    ocr_success = False
+    digest = None
+    cached_entry = None
     try:
-        result = subprocess.run(command_to_run, capture_output=False, text=True)
-        duration = time.time() - start_time
-        if result.returncode == 0:
-            print(f"    [✓] Docling OCR successfully processed in {duration:.2f} seconds.")
-            ocr_success = True
+        file_size = await utils.run_blocking(os.path.getsize, absolute_pdf_path)
+        output_dir = ocr_output_dir()
+        output_path = await utils.run_blocking(_reusable_output, original_file_path, previous_output, output_dir, naming)
+        if output_path is None:
+            output_path = await utils.run_blocking(
+                generate_unique_output_path, original_file_path, output_dir, OCR_OUTPUT_EXTENSION, naming
+            )
+        if ocr_cache.enabled:
+            digest = await utils.run_blocking(file_digest, absolute_pdf_path)
+            cached_entry = await ocr_cache.lookup(digest, output_path)
+
+        if cached_entry is not None:
+            ocr_job = {
+                "path": absolute_pdf_path,
+                "size": file_size,
+                "status": OCR_CACHED,
+                "attempts": 0,
+                "queued_seconds": 0.0,
+                "duration_seconds": 0.0,
+                "returncode": None,
+                "error": None
+            }
         else:
-            print(f"    [!] Error processing with docling. Code: {result.returncode}. Took {duration:.2f}s")
-            ocr_success = False
+            ocr_job = await ocr_scheduler.submit(absolute_pdf_path, file_size, job_dir)
+        ocr_job["digest"] = digest
     except Exception as e:
-        duration = time.time() - start_time
         print(f"\n    [X] Unexpected Python error during docling execution for {absolute_pdf_path}: {e}")
         return None
 
-    post_process_success = False
-    if ocr_success:
-        post_process_success = run_post_processing(absolute_pdf_path)
+    if report is not None:
+        await report.add("ocr_jobs", ocr_job)
+
+    ocr_success = ocr_job["status"] in (OCR_SUCCEEDED, OCR_CACHED)
+    duration = ocr_job["duration_seconds"]
+    if cached_entry is not None:
+        print(f"    [✓] Reused cached OCR output for identical content ({digest[:12]}).")
+    elif ocr_success:
+        print(f"    [✓] Docling OCR successfully processed in {duration:.2f} seconds.")
     else:
+        print(f"    [!] Error processing with docling ({ocr_job['status']}, code: {ocr_job['returncode']}). "
+              f"Took {duration:.2f}s over {ocr_job['attempts']} attempt(s)")
+
+    if not ocr_success:
         print("    Skipping post-processing due to OCR error.")
+        print(f"  [!] PDF processing failed for: {os.path.basename(absolute_pdf_path)}")
+        return None
+
+    job_output_path = ocr_output_path(absolute_pdf_path, job_dir)
+    output_size = cached_entry and cached_entry.get("size")
+    if cached_entry is None:
+        try:
+            output_size = await utils.run_blocking(publish_output, job_output_path, output_path)
+        except FileNotFoundError:
+            logger.warning(f"Docling left no output at {job_output_path} for {absolute_pdf_path}")
+            output_path = None
 
-    if ocr_success: # and post_process_success:
-         print(f"  [✓] PDF processed successfully: {os.path.basename(absolute_pdf_path)}")
-         return absolute_pdf_path # Return original path
+    post_process = await post_processor.submit(absolute_pdf_path)
+    post_process_success = post_process is None or post_process["status"] == POST_PROCESS_SUCCEEDED
+    if post_process is not None:
+        if report is not None:
+            await report.add("post_processing", post_process)
+        if post_process_success:
+            print(f"    [✓] Post-processing completed in {post_process['duration_seconds']:.2f} seconds.")
+        else:
+            print(f"    [!] Post-processing {post_process['status']}: {post_process['error']}")
+    if digest is not None:
+        try:
+            if cached_entry is not None:
+                await ocr_cache.record_post_processing(digest, post_process_success)
+            else:
+                await ocr_cache.store(digest, absolute_pdf_path, job_output_path, post_process_success)
+        except Exception as e:
+            logger.error(f"Failed to update OCR cache for {absolute_pdf_path}: {e}")
+
+    try:
+        await _persist_pdf_file(original_file_path, signature, post_process, batcher, output_path, output_size)
+    except Exception as e:
+        logger.error(f"Failed to record PDF {absolute_pdf_path}: {e}", exc_info=True)
+
+    if post_process_success:
+        print(f"  [✓] PDF processed successfully: {os.path.basename(absolute_pdf_path)}")
+    else:
+        print(f"  [!] PDF post-processing failed for: {os.path.basename(absolute_pdf_path)}")
+    return absolute_pdf_path # Return original path
+
+
+async def _persist_pdf_file(pdf_path, signature, post_process, batcher=None, output_path=None, output_size=None):
+    """Record an OCR'd PDF; a failed post-processing leaves it STATUS_FAILED so the next scan retries it.
+
+    The published markdown is its output; ``output_size`` is kept apart from
+    the PDF's own size, for output sync to check the markdown against.
+    """
+    if signature is None:
+        signature = await utils.run_blocking(fingerprint.stat_signature, pdf_path)
+    failed = post_process is not None and post_process["status"] != POST_PROCESS_SUCCEEDED
+    file_data = {
+        "directory": os.path.dirname(pdf_path),
+        "file_path": pdf_path,
+        "status": config.STATUS_FAILED if failed else config.STATUS_PROCESSED,
+        "size": signature.size,
+        "modified": signature.mtime_ns / 1e9,
+        "mtime_ns": signature.mtime_ns,
+        "inode": signature.inode,
+        "processed_date": datetime.utcnow(),
+        "post_processing": None if post_process is None else {
+            key: value for key, value in post_process.items() if key != "path"
+        }
+    }
+    if output_path is not None:
+        file_data.update(output_path=output_path, output_size=output_size)
+    if batcher is not None:
+        await batcher.upsert(file_data)
     else:
-         print(f"  [!] PDF processing failed or post-processing failed for: {os.path.basename(absolute_pdf_path)}")
-         return None
+        await db_handler.insert_processed_file(file_data)
+
+
+def _reusable_output(original_file_path, previous_output, output_dir=None, naming=None):
+    """The output a changed file had, if its new output can replace it under the same name in output_dir (OUTPUT_DIR)"""
+    if not previous_output or (naming or config.OUTPUT_NAMING) == utils.NAMING_CONTENT_HASH:
+        # Content hash names change with the content
+        return None
+    if os.path.dirname(previous_output) != os.path.normpath(output_dir or config.OUTPUT_DIR):
+        return None
+    if not utils.output_names.reuse(previous_output, original_file_path):
+        return None
+    return previous_output
 
 
-async def process_other_file(original_file_path):
+def _replace_output(original_file_path, output_file_path, size):
+    """Copy to a temporary file next to the output, then move it over the old output. Blocking."""
+    directory, name = os.path.split(output_file_path)
+    temporary_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
     try:
-        if not os.path.exists(original_file_path):
+        copy_result = copy_engine.copy_file(original_file_path, temporary_path, size)
+        os.replace(temporary_path, output_file_path)
+    except BaseException:
+        try:
+            os.unlink(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return copy_result
+
+
+def _copy_other_file(original_file_path, signature=None, previous_output=None, naming=None):
+    """Copy a non-PDF file into OUTPUT_DIR and build its record. Blocking, runs on the FS thread pool.
+
+    ``signature`` is the file's (size, mtime_ns, inode) if the caller already stat'ed it.
+    ``previous_output`` is the output of the file's record, which a changed
+    file's new copy replaces in place; only files without one get a new name,
+    following ``naming`` (OUTPUT_NAMING if None).
+    Returns (record, CopyResult), or (None, None) if there was nothing to copy.
+    """
+    if signature is None:
+        try:
+            signature = fingerprint.stat_signature(original_file_path)
+        except FileNotFoundError:
             logger.error(f"File not found: {original_file_path}")
-            return None
-            
-        output_file_path = generate_unique_output_path(original_file_path, config.OUTPUT_DIR)
-        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-        
-        # Add file size check
-        file_size = os.path.getsize(original_file_path)
-        if file_size == 0:
-            logger.warning(f"Empty file detected: {original_file_path}")
-            return None
-            
-        shutil.copy2(original_file_path, output_file_path)
-        
-        # Add record to database
-        file_data = {
-            "directory": os.path.dirname(original_file_path),
-            "file_path": original_file_path,
-            "output_path": output_file_path,
-            "status": config.STATUS_PROCESSED,
-            "size": file_size,
-            "modified": os.path.getmtime(original_file_path),
-            "processed_date": datetime.utcnow()
-        }
-        
+            return None, None
+
+    # Add file size check
+    if signature.size == 0:
+        logger.warning(f"Empty file detected: {original_file_path}")
+        return None, None
+
+    blob_digest = None
+    if cas_store.enabled():
+        output_file_path, copy_result, blob_digest = cas_store.materialize(
+            original_file_path, signature.size,
+            _reusable_output(original_file_path, previous_output, naming=naming), naming
+        )
+    else:
+        output_file_path = _reusable_output(original_file_path, previous_output, naming=naming)
+        if output_file_path is not None:
+            os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+            copy_result = _replace_output(original_file_path, output_file_path, signature.size)
+        else:
+            output_file_path = generate_unique_output_path(original_file_path, config.OUTPUT_DIR, naming=naming)
+            os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+            copy_result = copy_engine.copy_file(original_file_path, output_file_path, signature.size)
+
+    return {
+        "directory": os.path.dirname(original_file_path),
+        "file_path": original_file_path,
+        "output_path": output_file_path,
+        "status": config.STATUS_PROCESSED,
+        "size": signature.size,
+        "modified": signature.mtime_ns / 1e9,
+        "mtime_ns": signature.mtime_ns,
+        "inode": signature.inode,
+        "copy_method": copy_result.method,
+        "blob_digest": blob_digest,
+        "processed_date": datetime.utcnow()
+    }, copy_result
+
+
+async def _add_fingerprint(file_data):
+    """Store the content fingerprint with the record, so later scans can tell touched from changed files"""
+    if not config.FINGERPRINT_ON_PROCESS:
+        return
+    if (file_data.get("blob_digest") and config.HASH_ALGORITHM == cas_store.DIGEST_ALGORITHM
+            and fingerprint.default_mode(file_data["size"]) == fingerprint.MODE_FULL):
+        # The blob store already read the whole file with the same hash
+        file_data["hash"] = f"{cas_store.DIGEST_ALGORITHM}:{fingerprint.MODE_FULL}:{file_data['blob_digest']}"
+        return
+    try:
+        file_data["hash"] = await fingerprint.fingerprint_file(file_data["file_path"], file_data["size"])
+    except Exception as e:
+        logger.warning(f"Could not fingerprint {file_data['file_path']}: {e}")
+
+
+async def _persist_other_file(file_data, batcher=None):
+    """Record a copied file in the database"""
+    if file_data.get("blob_digest"):
+        await cas_store.add_reference(file_data)
+    if batcher is not None:
+        # Upsert so a re-appearing file reuses its existing record
+        await batcher.upsert(file_data)
+        logger.info(f"Successfully processed file, database write queued: {file_data['file_path']}")
+    else:
         logger.info(f"Attempting to insert file data into database: {file_data}")
         await db_handler.insert_processed_file(file_data)
-        logger.info(f"Successfully processed and logged file: {original_file_path}")
-        
-        return output_file_path
+        logger.info(f"Successfully processed and logged file: {file_data['file_path']}")
+
+
+async def process_other_file(original_file_path, batcher=None, signature=None, report=None, previous_output=None,
+                             naming=None):
+    try:
+        file_data, copy_result = await utils.run_blocking(
+            _copy_other_file, original_file_path, signature, previous_output, naming
+        )
+        if file_data is None:
+            return None
+
+        if report is not None:
+            await _record_copy(report, file_data, copy_result)
+        await _add_fingerprint(file_data)
+        await _persist_other_file(file_data, batcher)
+        return file_data["output_path"]
         
     except Exception as e:
         logger.error(f"Error processing file {original_file_path}: {str(e)}", exc_info=True)
         return None
 
-async def process_directory(directory_path: str) -> dict:
-    report = {
-        "processed_files": [],
-        "skipped_files": [],
-        "deleted_files": [],
-        "errors": []
+
+async def _classify_file(signature, stored_file, batcher, needs_output=False):
+    """Decide what a scan does with a file and record how long the decision took"""
+    start = perf_counter()
+    action = await _decide_action(signature, stored_file, batcher, needs_output)
+    metrics.CLASSIFY_SECONDS.labels(action).observe(perf_counter() - start)
+    return action
+
+
+async def _decide_action(signature, stored_file, batcher, needs_output=False):
+    """Decide what a scan does with a file that exists on disk: ACTION_PROCESS or ACTION_SKIP.
+
+    ``signature`` is the walker entry for the file. Its (size, mtime_ns, inode)
+    is checked against the stored record first; the file is only read and
+    hashed when that cheap check fails on a same-size file. ``needs_output``
+    forces processing when the file's output went missing.
+    """
+    file_path = signature.path
+
+    if not stored_file:
+        # New file
+        return ACTION_PROCESS
+
+    if stored_file.status == config.STATUS_DELETED:
+        # File was previously deleted but exists now - reprocess it
+        return ACTION_PROCESS
+
+    if stored_file.status == config.STATUS_FAILED:
+        # Post-processing failed last time
+        return ACTION_PROCESS
+
+    if needs_output:
+        return ACTION_PROCESS
+
+    if (stored_file.output_path is None and config.PDF_PROCESSING_ENABLED
+            and file_path.lower().endswith(config.PDF_EXTENSION)):
+        # OCR'd before PDF records had an output: publish it under its own name
+        return ACTION_PROCESS
+
+    if stored_file.size != signature.size:
+        return ACTION_PROCESS
+
+    if (stored_file.mtime_ns, stored_file.inode) == (signature.mtime_ns, signature.inode):
+        # File exists and hasn't changed
+        return ACTION_SKIP
+
+    refreshed_signature = {
+        "modified": signature.mtime_ns / 1e9,
+        "mtime_ns": signature.mtime_ns,
+        "inode": signature.inode
     }
-    
-    try:
-        # Get all current files in directory
-        current_files = set()
-        for root, _, files in os.walk(directory_path):
-            for filename in files:
-                if not filename.startswith(config.IGNORED_PREFIXES):
-                    current_files.add(os.path.join(root, filename))
-
-        # Check for deleted files
-        stored_files = await db_handler.get_all_processed_files()
-        stored_file_paths = {file["file_path"] for file in stored_files}
-        
-        # Find deleted files (files in DB but not in filesystem)
-        deleted_files = stored_file_paths - current_files
-        for deleted_file in deleted_files:
-            await db_handler.update_file_status(deleted_file, config.STATUS_DELETED)
-            report["deleted_files"].append({
-                "path": deleted_file,
-                "reason": "File no longer exists"
-            })
+    if stored_file.hash is None:
+        if stored_file.mtime_ns is None:
+            # Record written before signatures were stored: trust the size as before and start tracking
+            await batcher.update_metadata(file_path, refreshed_signature)
+            return ACTION_SKIP
+        return ACTION_PROCESS
 
-        # Process current files
-        for file_path in current_files:
+    current_hash = await fingerprint.fingerprint_file(file_path, signature.size, like=stored_file.hash)
+    if current_hash == stored_file.hash:
+        # Touched or moved but same content: refresh the signature so it is not hashed again
+        await batcher.update_metadata(file_path, refreshed_signature)
+        return ACTION_SKIP
+    return ACTION_PROCESS
+
+
+async def _record_skipped(report, file_path, reason="File already processed"):
+    await report.add("skipped_files", {
+        "path": file_path,
+        "reason": reason
+    })
+
+
+async def _record_processed(report, file_path, result):
+    if result:
+        await report.add("processed_files", {
+            "path": file_path,
+            "output": result
+        })
+
+
+async def _record_copy(report, file_data, copy_result):
+    duration = copy_result.duration_seconds
+    await report.add("copies", {
+        "path": file_data["file_path"],
+        "output": file_data["output_path"],
+        "method": copy_result.method,
+        "size": copy_result.size,
+        "duration_seconds": round(duration, 3),
+        "throughput_mb_per_second": round(copy_result.size / duration / 1024 ** 2, 1) if duration > 0 else None
+    })
+
+
+async def _record_error(report, file_path, error):
+    await report.add("errors", {
+        "path": file_path,
+        "error": str(error)
+    })
+
+
+async def _process_files_serially(entries, file_index, batcher, report, missing_outputs=frozenset(), naming=None):
+    async for files in entries:
+        for entry in files:
+            if report.cancelled:
+                return
+            file_path = entry.path
             try:
-                # Check if file was previously marked as deleted
-                stored_file = await db_handler.get_processed_file(file_path)
-                current_size = os.path.getsize(file_path)
-                
-                if stored_file:
-                    if stored_file["status"] == config.STATUS_DELETED:
-                        # File was previously deleted but exists now - reprocess it
-                        if file_path.lower().endswith(config.PDF_EXTENSION):
-                            result = await process_pdf_file(file_path)
-                        else:
-                            result = await process_other_file(file_path)
-                            
-                        if result:
-                            report["processed_files"].append({
-                                "path": file_path,
-                                "output": result
-                            })
-                    elif stored_file["size"] == current_size:
-                        # File exists and hasn't changed
-                        report["skipped_files"].append({
-                            "path": file_path,
-                            "reason": "File already processed"
-                        })
-                        continue
-                else:
-                    # New file
+                stored_file = file_index.get(file_path)
+                action = await _classify_file(entry, stored_file, batcher, file_path in missing_outputs)
+                if action == ACTION_SKIP:
+                    await _record_skipped(report, file_path)
+                elif action == ACTION_PROCESS:
                     if file_path.lower().endswith(config.PDF_EXTENSION):
-                        result = await process_pdf_file(file_path)
+                        result = await process_pdf_file(
+                            file_path, report, batcher, entry, stored_file and stored_file.output_path, naming
+                        )
                     else:
-                        result = await process_other_file(file_path)
-                        
-                    if result:
-                        report["processed_files"].append({
-                            "path": file_path,
-                            "output": result
-                        })
-                    
+                        result = await process_other_file(
+                            file_path, batcher, entry, report, stored_file and stored_file.output_path, naming
+                        )
+                    await _record_processed(report, file_path, result)
             except Exception as e:
-                report["errors"].append({
-                    "path": file_path,
-                    "error": str(e)
-                })
+                await _record_error(report, file_path, e)
+
+
+async def _run_stage(handler, inbox, workers, outboxes=()):
+    """Run `workers` consumers of inbox until each receives _STAGE_DONE, then close the (queue, workers) outboxes"""
+    async def consume():
+        while True:
+            item = await inbox.get()
+            if item is _STAGE_DONE:
+                return
+            await handler(item)
+
+    try:
+        await asyncio.gather(*(consume() for _ in range(workers)))
+    finally:
+        for outbox, outbox_workers in outboxes:
+            for _ in range(outbox_workers):
+                await outbox.put(_STAGE_DONE)
+
+
+async def _process_files_concurrently(entries, file_index, batcher, report, missing_outputs=frozenset(), naming=None):
+    """Staged pipeline: discover -> stat/classify -> copy/OCR -> persist.
+
+    Stages are connected by bounded queues, so a slow copy stage holds back
+    classification instead of letting work pile up in memory. PDFs take a
+    separate OCR branch whose OCR_MAX_PENDING workers keep the OCR scheduler
+    supplied without tying up the copy workers.
+    """
+    classify_workers = max(1, config.CLASSIFY_CONCURRENCY)
+    process_workers = max(1, config.PROCESS_CONCURRENCY)
+    ocr_workers = max(1, config.OCR_MAX_PENDING)
+    to_classify = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    to_process = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    to_ocr = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    to_persist = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+
+    async def discover():
+        try:
+            async for files in entries:
+                for entry in files:
+                    await to_classify.put(entry)
+        finally:
+            for _ in range(classify_workers):
+                await to_classify.put(_STAGE_DONE)
+
+    async def classify(entry):
+        if report.cancelled:
+            return
+        file_path = entry.path
+        try:
+            stored_file = file_index.get(file_path)
+            action = await _classify_file(entry, stored_file, batcher, file_path in missing_outputs)
+            if action == ACTION_SKIP:
+                await _record_skipped(report, file_path)
+            elif action == ACTION_PROCESS:
+                if file_path.lower().endswith(config.PDF_EXTENSION):
+                    await to_ocr.put((entry, stored_file and stored_file.output_path))
+                else:
+                    await to_process.put((entry, stored_file and stored_file.output_path))
+        except Exception as e:
+            await _record_error(report, file_path, e)
+
+    async def ocr(item):
+        entry, previous_output = item
+        if report.cancelled:
+            return
+        file_path = entry.path
+        try:
+            result = await process_pdf_file(file_path, report, batcher, entry, previous_output, naming)
+        except Exception as e:
+            await _record_error(report, file_path, e)
+            return
+        await to_persist.put((file_path, result, None))
+
+    async def process(item):
+        entry, previous_output = item
+        if report.cancelled:
+            return
+        file_path = entry.path
+        try:
+            file_data, copy_result = await utils.run_blocking(
+                _copy_other_file, file_path, entry, previous_output, naming
+            )
+        except Exception as e:
+            logger.error(f"Error processing file {file_path}: {str(e)}", exc_info=True)
+            return
+        if file_data is not None:
+            await _record_copy(report, file_data, copy_result)
+            await _add_fingerprint(file_data)
+            await to_persist.put((file_path, file_data["output_path"], file_data))
+
+    async def persist(item):
+        file_path, result, file_data = item
+        try:
+            if file_data is not None:
+                await _persist_other_file(file_data, batcher)
+            await _record_processed(report, file_path, result)
+        except Exception as e:
+            logger.error(f"Error processing file {file_path}: {str(e)}", exc_info=True)
+
+    async def classify_and_process():
+        try:
+            await asyncio.gather(
+                _run_stage(classify, to_classify, classify_workers,
+                           [(to_process, process_workers), (to_ocr, ocr_workers)]),
+                _run_stage(process, to_process, process_workers),
+                _run_stage(ocr, to_ocr, ocr_workers)
+            )
+        finally:
+            await to_persist.put(_STAGE_DONE)
+
+    await asyncio.gather(
+        discover(),
+        classify_and_process(),
+        _run_stage(persist, to_persist, 1)
+    )
+
+
+async def _replay(batches):
+    """Feed already collected walker batches to a pipeline that expects walker.walk()"""
+    for files in batches:
+        yield files
+
+
+async def _list_files(directory, walk_errors):
+    """Like walker.walk(), for the files directly in directory only"""
+    listing, errors = await utils.run_blocking(walker.scan_directory, directory)
+    walk_errors.extend(errors)
+    if listing.files:
+        yield listing.files
+
+
+async def _walk_with_snapshots(directory_path, walk_errors, snapshots, builder, prune, on_pruned):
+    """Like walker.walk(), recording every directory in builder and handing pruned ones to on_pruned"""
+    async for listing in walker.walk_directories(directory_path, walk_errors, snapshots, prune):
+        builder.add(listing)
+        if listing.pruned:
+            await on_pruned(listing.path)
+        elif listing.files:
+            yield listing.files
+
+
+async def _resumable(entries, report, current_files):
+    """Pass walker batches on until the scan is cancelled, counting them and leaving out files finished before a resume.
+
+    Every path found, finished or not, is added to current_files.
+    """
+    async with aclosing(entries):
+        async for files in entries:
+            if report.cancelled:
+                return
+            report.files_discovered += len(files)
+            current_files.update(entry.path for entry in files)
+            if report.completed_paths:
+                files = [entry for entry in files if entry.path not in report.completed_paths]
+            yield files
+    report.walk_finished = True
+
+
+async def _checkpoint_periodically(report, batcher, stopped):
+    """Checkpoint the scan every SCAN_CHECKPOINT_INTERVAL seconds until stopped is set"""
+    while True:
+        try:
+            await asyncio.wait_for(stopped.wait(), config.SCAN_CHECKPOINT_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await report.checkpoint(batcher)
+            await report.poll_cancel()
+        except Exception as e:
+            logger.error(f"Failed to checkpoint scan {report.scan_id}: {e}")
+
+
+def _tracked_files_by_directory(file_index):
+    files_by_directory = {}
+    for path, record in file_index.items():
+        if record.status == config.STATUS_PROCESSED:
+            files_by_directory.setdefault(os.path.dirname(path), []).append(path)
+    return files_by_directory
+
+
+async def _mark_deleted(file_paths, batcher, report):
+    if cas_store.enabled():
+        await cas_store.release_references(list(file_paths))
+    for deleted_file in file_paths:
+        await batcher.update_status(deleted_file, config.STATUS_DELETED)
+        await report.add("deleted_files", {
+            "path": deleted_file,
+            "reason": "File no longer exists"
+        })
+
+
+async def _collect_blobs(report, dedup_stats):
+    """Garbage-collect unreferenced blobs and add the dedup statistics to the report"""
+    if cas_store.enabled():
+        report.summary["dedup"] = dedup_stats.summary(await cas_store.collect_garbage())
+
+
+async def _finish_report(report, batcher, status):
+    # Failed writes only surface once the batcher has flushed
+    for error in batcher.errors:
+        await report.add("errors", error)
+    try:
+        await report.finish(status)
+    except Exception as e:
+        logger.error(f"Failed to save scan report {report.scan_id}: {e}")
+
+
+async def process_directory(directory_path: str, deep_verify: bool = False, sync_outputs: bool = False,
+                            trigger: str = "scan", report: ScanReport = None) -> ScanReport:
+    """Scan directory_path and bring the tracked state in line with it.
+
+    With DIR_SNAPSHOT_MODE=incremental, directories whose mtime matches their
+    snapshot from the last scan are not listed and their tracked files are
+    skipped. ``deep_verify`` lists everything and rebuilds the snapshots.
+    With ``sync_outputs`` and OUTPUT_SYNC_MODE=incremental, OUTPUT_DIR is
+    reconciled first and files whose output is missing are copied again.
+    With SCAN_DIFF_MODE=external, the walk is sorted and merged with the
+    tracked files instead of holding both in memory (see external_diff).
+    The report is streamed to the database as the scan goes and returned once saved.
+
+    A ``report`` created by the caller (a scan job, possibly resumed from a
+    checkpoint) is used instead of a new one. Scans checkpoint every
+    SCAN_CHECKPOINT_INTERVAL seconds; a cancelled scan stops walking, leaves
+    files it did not reach alone and is saved as cancelled.
+    """
+    async with _scan_lock:
+        return await _process_directory(directory_path, deep_verify, sync_outputs, trigger, report)
+
+
+async def _process_directory(directory_path, deep_verify, sync_outputs, trigger, report):
+    if report is None:
+        report = ScanReport(directory_path, trigger, {"deep_verify": deep_verify, "sync_outputs": sync_outputs})
+    dedup_stats = cas_store.DedupStats()
+    report.subscribe(dedup_stats)
+    await report.start()
+    if trigger == "scan":
+        # List the output directories again instead of carrying the names of every earlier scan and watch batch
+        utils.release_output_paths()
+    
+    external = config.SCAN_DIFF_MODE == external_diff.DIFF_MODE_EXTERNAL
+    use_snapshots = config.DIR_SNAPSHOT_MODE == dir_index.SNAPSHOT_MODE_INCREMENTAL
+    if use_snapshots and external:
+        logger.warning("DIR_SNAPSHOT_MODE=incremental needs the tracked files in memory, "
+                       "scanning without snapshots as SCAN_DIFF_MODE=external")
+        use_snapshots = False
+    if use_snapshots and not config.SCAN_PRELOAD_INDEX:
+        logger.warning("DIR_SNAPSHOT_MODE=incremental needs SCAN_PRELOAD_INDEX, scanning without snapshots")
+        use_snapshots = False
+    if use_snapshots and report.resumed:
+        # The snapshots are built from every file's entry, and a resumed scan skips the finished ones
+        logger.info(f"Resumed scan {report.scan_id} lists every directory and leaves the snapshots as they are")
+        use_snapshots = False
+
+    batcher = db_handler.write_batcher()
+    batcher.start()
+    checkpointer = None
+    checkpoints_stopped = asyncio.Event()
+    if trigger == "scan" and config.SCAN_CHECKPOINT_INTERVAL > 0:
+        checkpointer = asyncio.create_task(_checkpoint_periodically(report, batcher, checkpoints_stopped))
+    builder = None
+    diff = None
+    status = STATUS_COMPLETED
+    try:
+        # Load the tracked state once; every decision below runs against this index
+        walk_errors = []
+        current_files = set()
+        missing_outputs = frozenset()
+        if sync_outputs and config.OUTPUT_SYNC_MODE == output_sync.OUTPUT_SYNC_INCREMENTAL:
+            missing_outputs, report.summary["output_sync"] = await output_sync.reconcile_outputs(config.OUTPUT_DIR)
+
+        if external:
+            diff = external_diff.SortedDiff(directory_path, report)
+            await diff.collect(walker.walk(directory_path, walk_errors))
+            entries, file_index = diff.entries(), diff.records
+        elif use_snapshots:
+            file_index = await db_handler.load_file_index(directory_path)
+            snapshots = await db_handler.load_directory_snapshots(directory_path)
+            for file_path in missing_outputs:
+                # List the directory again so the file gets its output back
+                snapshots.pop(os.path.dirname(file_path), None)
+            for file_path, record in file_index.items():
+                if record.status == config.STATUS_FAILED:
+                    # And so a PDF whose post-processing failed is tried again
+                    snapshots.pop(os.path.dirname(file_path), None)
+            builder = dir_index.DirectoryIndexBuilder(directory_path, snapshots)
+            report.subscribe(builder.observe)
+            files_by_directory = _tracked_files_by_directory(file_index)
+
+            async def skip_directory(path):
+                for file_path in files_by_directory.get(path, ()):
+                    report.files_discovered += 1
+                    current_files.add(file_path)
+                    await _record_skipped(report, file_path, "Directory unchanged since last scan")
+
+            entries = _walk_with_snapshots(
+                directory_path, walk_errors, snapshots, builder, not deep_verify, skip_directory
+            )
+        elif config.SCAN_PRELOAD_INDEX:
+            file_index = await db_handler.load_file_index(directory_path)
+            entries = walker.walk(directory_path, walk_errors)
+        else:
+            found = [files async for files in walker.walk(directory_path, walk_errors)]
+            file_index = await db_handler.get_files_by_paths(entry.path for files in found for entry in files)
+            entries = _replay(found)
+        if diff is None:
+            if config.SCAN_PRELOAD_INDEX:
+                report.files_expected = sum(
+                    1 for record in file_index.values() if record.status == config.STATUS_PROCESSED
+                )
+            entries = _resumable(entries, report, current_files)
+
+        # Process current files as the walker finds them
+        if config.SCAN_PIPELINE:
+            await _process_files_concurrently(entries, file_index, batcher, report, missing_outputs)
+        else:
+            await _process_files_serially(entries, file_index, batcher, report, missing_outputs)
+        for error in walk_errors:
+            await report.add("errors", error)
+
+        if report.cancelled:
+            # Files the scan did not reach are neither deleted nor snapshotted
+            status = STATUS_CANCELLED
+            logger.info(f"Scan {report.scan_id} cancelled after {report.files_done} files")
+        elif diff is not None:
+            async for file_paths in diff.deleted_paths():
+                await _mark_deleted(file_paths, batcher, report)
+            await _collect_blobs(report, dedup_stats)
+        else:
+            # Both the index and the query only cover files below the scanned directory
+            if config.SCAN_PRELOAD_INDEX:
+                stored_file_paths = {
+                    path for path, record in file_index.items()
+                    if record.status == config.STATUS_PROCESSED
+                }
+            else:
+                stored_file_paths = await db_handler.get_processed_file_paths(directory_path)
+
+            # Find deleted files (files in DB but not in filesystem)
+            await _mark_deleted(stored_file_paths - current_files, batcher, report)
+
+            if builder is not None:
+                documents, report.summary["directory_index"] = builder.finalize()
+                report.summary["directory_index"]["deep_verify"] = deep_verify
+                await db_handler.save_directory_snapshots(documents)
+                await db_handler.delete_directory_snapshots(builder.stale_paths())
+
+            await _collect_blobs(report, dedup_stats)
                     
+    except asyncio.CancelledError:
+        # The server is shutting down: keep what is done so the scan resumes from here
+        checkpoints_stopped.set()
+        if checkpointer is not None:
+            await checkpointer
+            await report.checkpoint(batcher)
+        report.abandon()
+        raise
     except Exception as e:
-        report["errors"].append({
+        status = STATUS_FAILED
+        await report.add("errors", {
             "path": directory_path,
             "error": f"Directory processing error: {str(e)}"
         })
-        
-    return report
\ No newline at end of file
+    finally:
+        checkpoints_stopped.set()
+        if checkpointer is not None:
+            await checkpointer
+        await batcher.close()
+        if diff is not None:
+            report.summary["diff"] = diff.summary()
+            diff.close()
+
+    await _finish_report(report, batcher, status)
+    return report
+
+
+def _stat_entry(file_path):
+    """Walker entry for a single regular file, or None if it is gone or not a file. Blocking."""
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    if not os.path.isfile(file_path):
+        return None
+    return walker.WalkEntry(file_path, st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def changes_root(file_paths, deleted_directories=()) -> str:
+    """The directory a report of changes to these paths is filed under"""
+    changed_paths = list(file_paths) + list(deleted_directories)
+    return os.path.commonpath(changed_paths) if changed_paths else ""
+
+
+async def process_changes(file_paths, deleted_directories=(), trigger: str = "watch",
+                          report: ScanReport = None) -> ScanReport:
+    """Bring the tracked state of individual paths up to date, as reported by the watcher.
+
+    Paths that still exist go through the same classify/process steps as a
+    scan; paths that are gone are marked deleted. Every file tracked below a
+    directory in ``deleted_directories`` is marked deleted as well. A
+    ``report`` created by the caller is used instead of a new one.
+    """
+    async with _scan_lock:
+        file_paths = sorted(set(file_paths))
+        common_path = changes_root(file_paths, deleted_directories)
+        if report is None:
+            report = ScanReport(common_path, trigger)
+        dedup_stats = cas_store.DedupStats()
+        report.subscribe(dedup_stats)
+        await report.start()
+
+        batcher = db_handler.write_batcher()
+        batcher.start()
+        status = STATUS_COMPLETED
+        try:
+            gone = set()
+            for directory in deleted_directories:
+                gone.update(await db_handler.get_processed_file_paths(directory))
+
+            file_index = await db_handler.get_files_by_paths(file_paths)
+            entries = []
+            for file_path in file_paths:
+                entry = await utils.run_blocking(_stat_entry, file_path)
+                if entry is not None:
+                    entries.append(entry)
+                elif file_path in file_index and file_index[file_path].status == config.STATUS_PROCESSED:
+                    gone.add(file_path)
+            await _mark_deleted(sorted(gone), batcher, report)
+
+            await _process_files_serially(_replay([entries]), file_index, batcher, report)
+            if report.cancelled:
+                status = STATUS_CANCELLED
+            else:
+                await _collect_blobs(report, dedup_stats)
+        except Exception as e:
+            status = STATUS_FAILED
+            await report.add("errors", {
+                "path": common_path,
+                "error": f"Change processing error: {str(e)}"
+            })
+        finally:
+            await batcher.close()
+
+        await _finish_report(report, batcher, status)
+        return report
+
+
+async def process_work_unit(report: UnitReport, missing_outputs=frozenset(), naming: str = None) -> UnitReport:
+    """Scan one work unit of a partitioned scan, for the worker holding it.
+
+    The unit's files go through the same classify/process steps as a scan and
+    its tracked files that are gone are marked deleted. The tracked state is
+    always preloaded, as it is bounded by the unit. Output sync, directory
+    snapshots and blob garbage collection need the whole tree and are left to
+    the coordinating scan. New outputs are named following ``naming`` instead
+    of OUTPUT_NAMING.
+    """
+    async with _scan_lock:
+        await report.start()
+        # Other workers add outputs too: list OUTPUT_DIR again instead of trusting the names seen so far
+        utils.release_output_paths()
+        batcher = db_handler.write_batcher()
+        batcher.start()
+        status = STATUS_COMPLETED
+        try:
+            walk_errors = []
+            current_files = set()
+            file_index = await db_handler.load_file_index(report.directory, recursive=report.recursive)
+            stored_file_paths = {
+                path for path, record in file_index.items()
+                if record.status == config.STATUS_PROCESSED
+            }
+            report.files_expected = len(stored_file_paths)
+            if report.recursive:
+                entries = walker.walk(report.directory, walk_errors)
+            else:
+                entries = _list_files(report.directory, walk_errors)
+            entries = _resumable(entries, report, current_files)
+
+            if config.SCAN_PIPELINE:
+                await _process_files_concurrently(entries, file_index, batcher, report, missing_outputs, naming)
+            else:
+                await _process_files_serially(entries, file_index, batcher, report, missing_outputs, naming)
+            for error in walk_errors:
+                await report.add("errors", error)
+
+            if report.cancelled:
+                status = STATUS_CANCELLED
+            else:
+                await _mark_deleted(stored_file_paths - current_files, batcher, report)
+        except asyncio.CancelledError:
+            report.abandon()
+            raise
+        except Exception as e:
+            status = STATUS_FAILED
+            await report.add("errors", {
+                "path": report.directory,
+                "error": f"Work unit error: {str(e)}"
+            })
+        finally:
+            await batcher.close()
+
+        await _finish_report(report, batcher, status)
+        return report
+
+
+async def finish_partitioned_scan(report: ScanReport, units, is_covered) -> ScanReport:
+    """Last steps of a partitioned scan once every work unit has finished.
+
+    Units find the deleted files below their own directories; tracked files
+    for which ``is_covered`` finds no unit were in directories that are gone,
+    and are marked deleted here. Then unreferenced blobs are collected.
+    """
+    async with _scan_lock:
+        batcher = db_handler.write_batcher()
+        batcher.start()
+        status = STATUS_CANCELLED if report.cancelled else STATUS_COMPLETED
+        try:
+            for unit in units:
+                if unit.get("error"):
+                    await report.add("errors", {"path": unit["path"], "error": unit["error"]})
+            if not report.cancelled:
+                # Streamed in path order, so only the uncovered paths are held
+                uncovered = [
+                    record["file_path"] async for record in db_handler.iter_file_index(report.directory)
+                    if record.get("status") == config.STATUS_PROCESSED and not is_covered(record["file_path"])
+                ]
+                await _mark_deleted(uncovered, batcher, report)
+                if cas_store.enabled():
+                    report.summary["dedup"] = await cas_store.collect_garbage()
+        except Exception as e:
+            status = STATUS_FAILED
+            await report.add("errors", {
+                "path": report.directory,
+                "error": f"Directory processing error: {str(e)}"
+            })
+        finally:
+            await batcher.close()
+
+        await _finish_report(report, batcher, status)
+        return report
@@ -0,0 +1,161 @@
+import os
+import config
+import asyncio
+import hashlib
+import logging
+import metrics
+import threading
+
+from time import perf_counter
+from typing import NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Fingerprints are stored as "<algorithm>:<mode>:<hexdigest>"
+MODE_FULL = "full"
+MODE_TREE = "tree"     # "tree-<chunk bytes>": digest of per-chunk digests, chunks hashed in parallel
+MODE_SAMPLE = "sample" # "sample-<count>x<bytes>": digest of evenly spaced samples plus the file size
+
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+
+class StatSignature(NamedTuple):
+    """Cheap first-tier fingerprint, taken from a single stat"""
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+def stat_signature(file_path: str) -> StatSignature:
+    st = os.stat(file_path)
+    return StatSignature(st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def new_hasher(algorithm: str):
+    """Create a hasher for a hashlib algorithm name, or xxh3_64/xxh3_128 when xxhash is installed"""
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError(f"Hash algorithm {algorithm} needs the xxhash package")
+        return getattr(xxhash, algorithm)()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.new(algorithm)
+
+
+def _get_hash_executor() -> ThreadPoolExecutor:
+    global _hash_executor
+    with _hash_executor_lock:
+        if _hash_executor is None:
+            _hash_executor = ThreadPoolExecutor(
+                max_workers=max(1, config.HASH_WORKER_THREADS),
+                thread_name_prefix="hash-worker"
+            )
+    return _hash_executor
+
+
+def _hash_range(file_path: str, algorithm: str, offset: int, length: int) -> bytes:
+    hasher = new_hasher(algorithm)
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        end = offset + length
+        while offset < end:
+            buf = os.pread(fd, min(READ_CHUNK_SIZE, end - offset), offset)
+            if not buf:
+                break
+            hasher.update(buf)
+            offset += len(buf)
+    finally:
+        os.close(fd)
+    return hasher.digest()
+
+
+def hash_stream(file_path: str, algorithm: str) -> str:
+    """Streamed digest of the whole file. Blocking."""
+    hasher = new_hasher(algorithm)
+    with open(file_path, 'rb') as f:
+        for buf in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def _sample_offsets(size: int, count: int, sample_size: int) -> list:
+    """Evenly spaced sample offsets, always including the head and the tail of the file"""
+    step = (size - sample_size) // (count - 1) if count > 1 else 0
+    return [i * step for i in range(count)]
+
+
+def default_mode(size: int) -> str:
+    if config.FINGERPRINT_SAMPLE_THRESHOLD and size >= config.FINGERPRINT_SAMPLE_THRESHOLD:
+        return f"{MODE_SAMPLE}-{config.FINGERPRINT_SAMPLE_COUNT}x{config.FINGERPRINT_SAMPLE_SIZE}"
+    if size >= config.FINGERPRINT_PARALLEL_THRESHOLD:
+        return f"{MODE_TREE}-{config.FINGERPRINT_CHUNK_SIZE}"
+    return MODE_FULL
+
+
+def parse_fingerprint(fingerprint: Optional[str]):
+    """Split a stored fingerprint into (algorithm, mode, hexdigest), or None if it is not one"""
+    if not fingerprint or fingerprint.count(":") != 2:
+        return None
+    return tuple(fingerprint.split(":"))
+
+
+async def fingerprint_file(file_path: str, size: int, like: Optional[str] = None) -> str:
+    """Compute a content fingerprint on the hash thread pool.
+
+    Small files are streamed whole. Files above FINGERPRINT_PARALLEL_THRESHOLD
+    are split into FINGERPRINT_CHUNK_SIZE chunks hashed in parallel, and files
+    above FINGERPRINT_SAMPLE_THRESHOLD (if set) are only sampled. Pass a stored
+    fingerprint as ``like`` to compute a comparable value with the same scheme.
+    """
+    algorithm, mode = config.HASH_ALGORITHM, default_mode(size)
+    parsed = parse_fingerprint(like)
+    if parsed is not None:
+        algorithm, mode = parsed[0], parsed[1]
+
+    kind = mode.partition("-")[0]
+    start = perf_counter()
+    result = await _fingerprint(file_path, size, algorithm, mode)
+    metrics.HASH_SECONDS.labels(kind).observe(perf_counter() - start)
+    metrics.HASH_BYTES.labels(kind).inc(size)
+    return result
+
+
+async def _fingerprint(file_path: str, size: int, algorithm: str, mode: str) -> str:
+    loop = asyncio.get_running_loop()
+    executor = _get_hash_executor()
+
+    if mode == MODE_FULL:
+        digest = await loop.run_in_executor(executor, hash_stream, file_path, algorithm)
+        return f"{algorithm}:{mode}:{digest}"
+
+    kind, _, params = mode.partition("-")
+    if kind == MODE_TREE:
+        chunk_size = int(params)
+        ranges = [(offset, chunk_size) for offset in range(0, max(size, 1), chunk_size)]
+    elif kind == MODE_SAMPLE:
+        count, sample_size = (int(value) for value in params.split("x"))
+        if size <= count * sample_size:
+            ranges = [(0, size)]
+        else:
+            ranges = [(offset, sample_size) for offset in _sample_offsets(size, count, sample_size)]
+    else:
+        raise ValueError(f"Unknown fingerprint mode: {mode}")
+
+    parts = await asyncio.gather(*(
+        loop.run_in_executor(executor, _hash_range, file_path, algorithm, offset, length)
+        for offset, length in ranges
+    ))
+    combined = new_hasher(algorithm)
+    combined.update(str(size).encode())
+    for part in parts:
+        combined.update(part)
+    return f"{algorithm}:{mode}:{combined.hexdigest()}"
@@ -0,0 +1,77 @@
+import os
+import config
+import socket
+import asyncio
+import logging
+
+from typing import Callable, Optional
+from datetime import datetime, timedelta
+from db_handler import db_handler
+
+logger = logging.getLogger(__name__)
+
+# Identifies this worker process as the holder of leases and work units
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def deadline() -> datetime:
+    """When a lease taken or renewed now expires"""
+    return datetime.utcnow() + timedelta(seconds=config.SCAN_LEASE_SECONDS)
+
+
+class Lease:
+    """A named lock in the database, shared by every worker process and node.
+
+    It expires SCAN_LEASE_SECONDS after it was last renewed, so a worker
+    that dies does not keep it; while held it is renewed every third of that.
+    Clocks of the nodes must agree to well within SCAN_LEASE_SECONDS. If a
+    renewal finds it taken over by another worker, renewing stops, ``lost``
+    is set and ``on_lost`` is called, so the holder can stop what it guards.
+    """
+
+    def __init__(self, name: str, on_lost: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.on_lost = on_lost
+        self.lost = False
+        self._renewal: Optional[asyncio.Task] = None
+        # Taking and giving up the lease are atomic within this process
+        self._lock = asyncio.Lock()
+
+    @property
+    def held(self) -> bool:
+        return self._renewal is not None
+
+    async def acquire(self) -> bool:
+        """Take the lease; False while another worker, or another task of this one, holds it"""
+        async with self._lock:
+            if self.held:
+                return False
+            if not await db_handler.acquire_lease(self.name, OWNER, config.SCAN_LEASE_SECONDS):
+                return False
+            self.lost = False
+            self._renewal = asyncio.create_task(self._renew())
+            return True
+
+    async def _renew(self) -> None:
+        while True:
+            await asyncio.sleep(config.SCAN_LEASE_SECONDS / 3)
+            try:
+                if not await db_handler.acquire_lease(self.name, OWNER, config.SCAN_LEASE_SECONDS):
+                    logger.error(f"Lease {self.name} expired and was taken over by another worker")
+                    self.lost = True
+                    if self.on_lost is not None:
+                        self.on_lost()
+                    return
+            except Exception as e:
+                logger.error(f"Could not renew lease {self.name}: {e}")
+
+    async def release(self) -> None:
+        async with self._lock:
+            if self._renewal is not None:
+                self._renewal.cancel()
+                await asyncio.gather(self._renewal, return_exceptions=True)
+                self._renewal = None
+            try:
+                await db_handler.release_lease(self.name, OWNER)
+            except Exception as e:
+                logger.error(f"Could not release lease {self.name}: {e}")
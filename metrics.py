@@ -0,0 +1,338 @@
+"""In-process counters and latency histograms, exposed in the Prometheus text format.
+
+Every metric keeps its values in memory per label combination; recording is
+a dict lookup, a bisect and a locked add, cheap enough to leave on for every
+file of every scan. GET /metrics renders them all.
+"""
+import os
+import sys
+import bisect
+import functools
+import threading
+
+from time import perf_counter
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+PREFIX = "file_tracker_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cached stat to a long OCR job
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The series of one combination of label values, created on first use"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _labels_text(self, values: tuple, extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = [*zip(self.labelnames, values), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(child.render(self, values))
+        return lines
+
+
+class _CounterSeries:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def render(self, metric: _Metric, values: tuple) -> List[str]:
+        return [f"{metric.name}_total{metric._labels_text(values)} {_number(self.value)}"]
+
+
+class Counter(_Metric):
+    """A value that only goes up; rendered as <name>_total"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterSeries()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+
+class _GaugeSeries(_CounterSeries):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def render(self, metric: _Metric, values: tuple) -> List[str]:
+        return [f"{metric.name}{metric._labels_text(values)} {_number(self.value)}"]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down"""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeSeries()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def render(self, metric: _Metric, values: tuple) -> List[str]:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+            cumulative += bucket_count
+            le = bound if bound == "+Inf" else _number(bound)
+            lines.append(f"{metric.name}_bucket{metric._labels_text(values, [('le', le)])} {cumulative}")
+        lines.append(f"{metric.name}_sum{metric._labels_text(values)} {_number(total)}")
+        lines.append(f"{metric.name}_count{metric._labels_text(values)} {count}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets, with their sum and count"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def totals(self) -> Tuple[int, float]:
+        """Observations and their sum over every label combination"""
+        with self._lock:
+            children = list(self._children.values())
+        return sum(child.count for child in children), sum(child.sum for child in children)
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Scans
+SCANS = Counter("scans", "Scans and watch batches finished", ["trigger", "status"])
+SCANS_RUNNING = Gauge("scans_running", "Scans and watch batches in progress")
+SCAN_SECONDS = Histogram("scan_duration_seconds", "Wall-clock duration of a scan", ["trigger"])
+SCAN_ENTRIES = Counter("scan_entries", "Scan report entries by section", ["section"])
+
+# Stages; with concurrent workers their seconds add up to more than the scan's duration
+WALK_SECONDS = Histogram("walk_directory_seconds", "Listing and stat'ing one directory", ["pruned"])
+CLASSIFY_SECONDS = Histogram("classify_seconds", "Deciding whether a file must be processed", ["action"])
+HASH_SECONDS = Histogram("hash_seconds", "Fingerprinting one file", ["mode"])
+HASH_BYTES = Counter("hash_bytes", "Bytes of files fingerprinted (whole files, also when sampled)", ["mode"])
+COPY_SECONDS = Histogram("copy_seconds", "Copying one file to OUTPUT_DIR", ["method"])
+COPY_BYTES = Counter("copy_bytes", "Bytes copied to OUTPUT_DIR", ["method"])
+OCR_SECONDS = Histogram("ocr_seconds", "OCR of one PDF over all its attempts", ["status"])
+OCR_QUEUE_SECONDS = Histogram("ocr_queue_seconds", "Time a PDF waited for an OCR slot")
+POST_PROCESS_SECONDS = Histogram("post_process_seconds", "Post-processing of one PDF", ["mode", "status"])
+DB_SECONDS = Histogram("db_operation_seconds", "Database operation latency", ["operation"])
+DB_ERRORS = Counter("db_operation_errors", "Database operations that raised", ["operation"])
+FS_WAIT_SECONDS = Histogram("fs_pool_wait_seconds", "Time a blocking call waited for a filesystem thread")
+
+# Stages reported in each scan's summary.stages
+STAGES = {
+    "walk": WALK_SECONDS,
+    "classify": CLASSIFY_SECONDS,
+    "hash": HASH_SECONDS,
+    "copy": COPY_SECONDS,
+    "ocr": OCR_SECONDS,
+    "post_process": POST_PROCESS_SECONDS,
+    "db": DB_SECONDS,
+    "fs_pool_wait": FS_WAIT_SECONDS,
+}
+
+
+def stage_totals() -> Dict[str, Tuple[int, float]]:
+    return {stage: histogram.totals() for stage, histogram in STAGES.items()}
+
+
+def stage_summary(before: Dict[str, Tuple[int, float]]) -> Dict[str, dict]:
+    """Observations and busy seconds per stage since ``before`` (from stage_totals()).
+
+    The metrics are process-wide, so a watch batch running at the same time
+    as a scan is counted in both.
+    """
+    summary = {}
+    for stage, (count, seconds) in stage_totals().items():
+        start_count, start_seconds = before.get(stage, (0, 0.0))
+        summary[stage] = {"count": count - start_count, "seconds": round(seconds - start_seconds, 3)}
+    return summary
+
+
+def reset_peak_rss() -> None:
+    """Restart the peak RSS measurement (Linux); elsewhere the process-wide peak is reported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident memory of the process since the last reset_peak_rss()"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def timed_db_operation(operation: str, function):
+    """Wrap a coroutine function of a storage backend to record its latency and errors"""
+    latency, errors = DB_SECONDS.labels(operation), DB_ERRORS.labels(operation)
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(perf_counter() - start)
+
+    return wrapper
+
+
+# Leaf frames of threads that are waiting for work rather than doing it
+_IDLE_FRAMES = {
+    ("thread.py", "_worker"),
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("connection.py", "_recv"),
+}
+
+
+class StackSampler:
+    """Samples the running function of every thread on a daemon thread while a scan runs.
+
+    The profile lists the functions most often on top of a busy thread's
+    stack, grouped by thread pool (MainThread is the event loop).
+    """
+
+    def __init__(self, interval: float, top: int = 25):
+        self.interval = interval
+        self.top = top
+        self.samples = 0
+        self._tally = _Tally()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="scan-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                if ident == own or (filename, code.co_name) in _IDLE_FRAMES:
+                    continue
+                group = names.get(ident, "unknown").split("_")[0]
+                self._tally[(group, f"{code.co_name} ({filename}:{code.co_firstlineno})")] += 1
+            self.samples += 1
+
+    def stop(self) -> dict:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return {
+            "interval_seconds": self.interval,
+            "samples": self.samples,
+            "top": [
+                {"thread": group, "function": function, "samples": count}
+                for (group, function), count in self._tally.most_common(self.top)
+            ]
+        }
@@ -0,0 +1,144 @@
+import os
+import uuid
+import config
+import shutil
+import asyncio
+import logging
+
+from typing import Optional
+from utils import run_blocking, get_file_hash
+from db_handler import db_handler
+
+logger = logging.getLogger(__name__)
+
+DIGEST_ALGORITHM = "sha256"
+
+
+def file_digest(file_path: str) -> str:
+    """Strong content digest used as the cache key. Blocking."""
+    return get_file_hash(file_path, DIGEST_ALGORITHM)
+
+
+# Directory below OCR_OUTPUT_DIR holding the private output directory of each OCR job
+JOBS_DIR_NAME = ".ocr-jobs"
+
+# Extension of the markdown docling writes and the scan publishes
+OCR_OUTPUT_EXTENSION = ".md"
+
+
+def ocr_output_dir() -> str:
+    """Where OCR output is published, one markdown file per PDF"""
+    return os.path.normpath(config.OCR_OUTPUT_DIR or os.getcwd())
+
+
+def ocr_output_path(pdf_path: str, output_dir: str) -> str:
+    """Where docling leaves the markdown for a PDF converted into output_dir"""
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return os.path.join(output_dir, f"{stem}{OCR_OUTPUT_EXTENSION}")
+
+
+def job_output_dir() -> str:
+    """A new directory for one OCR job to write into, so concurrent jobs never write to the same file"""
+    return os.path.join(ocr_output_dir(), JOBS_DIR_NAME, uuid.uuid4().hex)
+
+
+def discard_job_output(output_dir: str) -> None:
+    """Remove an OCR job's directory once its output is published and cached. Blocking."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def publish_output(source: str, destination: str) -> int:
+    """Copy OCR output to its published path through a temporary file, atomically, and return its size. Blocking."""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temporary_path = f"{destination}.{uuid.uuid4().hex}.tmp"
+    try:
+        shutil.copyfile(source, temporary_path)
+        os.replace(temporary_path, destination)
+    except BaseException:
+        _remove_file(temporary_path)
+        raise
+    return os.path.getsize(destination)
+
+
+def _cache_path(digest: str) -> str:
+    return os.path.join(config.OCR_CACHE_DIR, digest[:2], f"{digest}.md")
+
+
+def _copy_file(source: str, destination: str) -> int:
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copyfile(source, destination)
+    return os.path.getsize(destination)
+
+
+def _remove_file(file_path: str) -> None:
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+
+class OcrResultCache:
+    """Content-addressed cache of OCR output, so identical PDFs are only OCR'd once.
+
+    Entries are keyed by the PDF's SHA-256 digest. The output lives under
+    OCR_CACHE_DIR and its location, size and post-processing status are kept in
+    the ``{COLLECTION_NAME}_ocr_cache`` collection. When the cache grows past
+    OCR_CACHE_MAX_BYTES the least recently used entries are evicted.
+    """
+
+    def __init__(self):
+        self._eviction_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(config.OCR_CACHE_DIR)
+
+    async def lookup(self, digest: str, output_path: str) -> Optional[dict]:
+        """Return the cached entry for digest and publish its output at output_path, or None on a miss"""
+        entry = await db_handler.get_ocr_cache_entry(digest)
+        if entry is None:
+            return None
+        try:
+            await run_blocking(publish_output, entry["output_location"], output_path)
+        except FileNotFoundError:
+            logger.warning(f"Cached OCR output missing for {digest}, dropping entry")
+            await db_handler.delete_ocr_cache_entry(digest)
+            return None
+        return entry
+
+    async def store(self, digest: str, pdf_path: str, output_path: str, post_process_success: bool) -> None:
+        """Copy fresh OCR output for pdf_path, from its job's own output_path, into the cache"""
+        cached_path = _cache_path(digest)
+        try:
+            size = await run_blocking(_copy_file, output_path, cached_path)
+        except FileNotFoundError:
+            logger.warning(f"No OCR output found at {output_path}, not caching {pdf_path}")
+            return
+
+        await db_handler.save_ocr_cache_entry(digest, {
+            "output_location": cached_path,
+            "size": size,
+            "source_path": pdf_path,
+            "post_process_success": post_process_success
+        })
+        await self.evict()
+
+    async def record_post_processing(self, digest: str, post_process_success: bool) -> None:
+        await db_handler.save_ocr_cache_entry(digest, {"post_process_success": post_process_success})
+
+    async def evict(self) -> None:
+        """Drop least recently used entries until the cache fits OCR_CACHE_MAX_BYTES"""
+        async with self._eviction_lock:
+            total = await db_handler.get_ocr_cache_size()
+            if total <= config.OCR_CACHE_MAX_BYTES:
+                return
+            async for entry in db_handler.iter_ocr_cache_lru():
+                if total <= config.OCR_CACHE_MAX_BYTES:
+                    break
+                await run_blocking(_remove_file, entry["output_location"])
+                await db_handler.delete_ocr_cache_entry(entry["_id"])
+                total -= entry.get("size", 0)
+                logger.info(f"Evicted OCR cache entry {entry['_id']}")
+
+
+ocr_cache = OcrResultCache()
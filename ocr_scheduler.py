@@ -0,0 +1,247 @@
+import os
+import time
+import config
+import signal
+import metrics
+import asyncio
+import logging
+import itertools
+
+from typing import Optional
+from ocr_workers import WarmOcrRunner
+
+logger = logging.getLogger(__name__)
+
+OCR_SUCCEEDED = "succeeded"
+OCR_FAILED = "failed"
+OCR_TIMED_OUT = "timed_out"
+OCR_CACHED = "cached" # Output reused from the OCR result cache, docling not run
+
+ORDER_LARGEST_FIRST = "largest"
+ORDER_FIFO = "fifo"
+
+OCR_MODE_SUBPROCESS = "subprocess"
+OCR_MODE_WORKER_POOL = "worker_pool"
+
+# Keep only the end of docling's stderr in job results
+STDERR_TAIL_CHARS = 2000
+
+
+class OcrJob:
+    """A queued OCR request and the future its submitter awaits"""
+
+    def __init__(self, pdf_path: str, size: int, output_dir: Optional[str], future: asyncio.Future):
+        self.pdf_path = pdf_path
+        self.size = size
+        self.output_dir = output_dir
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class OcrScheduler:
+    """Runs docling OCR jobs on a fixed number of slots.
+
+    Jobs wait in a priority queue (largest file first, or FIFO) until one of
+    ``slots`` workers picks them up. Depending on OCR_MODE a slot either starts
+    a docling CLI process per PDF or hands small batches to its own warm worker
+    process (see ocr_workers). Each attempt is killed when it exceeds
+    ``timeout`` seconds per PDF and failed attempts are retried up to
+    ``max_retries`` times. Every job resolves to a result dict that can go
+    straight into the scan report.
+    """
+
+    def __init__(self, slots: int, timeout: float, max_retries: int, order: str):
+        self.slots = max(1, slots)
+        self.timeout = timeout
+        self.max_retries = max(0, max_retries)
+        self.order = order
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers = []
+        self._loop = None
+        self._sequence = itertools.count()
+
+    def _ensure_started(self) -> None:
+        """Start the workers on the running loop, restarting them if the loop changed"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.slots)]
+        logger.info(f"Started OCR scheduler with {self.slots} slots ({self.order} ordering)")
+
+    async def close(self) -> None:
+        """Stop the workers; queued jobs are cancelled"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                job.future.cancel()
+        self._workers = []
+        self._queue = None
+        self._loop = None
+
+    async def submit(self, pdf_path: str, size: Optional[int] = None, output_dir: Optional[str] = None) -> dict:
+        """Queue a PDF for OCR into output_dir (OCR_OUTPUT_DIR if unset) and wait for its result.
+
+        If the caller is cancelled while the job waits, the job is dropped
+        instead of being run for nobody.
+        """
+        self._ensure_started()
+        if size is None:
+            size = os.path.getsize(pdf_path)
+
+        sequence = next(self._sequence)
+        priority = -size if self.order == ORDER_LARGEST_FIRST else sequence
+        job = OcrJob(pdf_path, size, output_dir, self._loop.create_future())
+        await self._queue.put((priority, sequence, job))
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # The workers skip cancelled jobs still in the queue
+            job.future.cancel()
+            raise
+
+    def _make_runner(self):
+        if config.OCR_MODE == OCR_MODE_WORKER_POOL:
+            return WarmOcrRunner(self.timeout)
+        return SubprocessOcrRunner(self.timeout)
+
+    async def _worker(self) -> None:
+        runner = self._make_runner()
+        try:
+            while True:
+                _, _, job = await self._queue.get()
+                if job.future.cancelled():
+                    continue
+                batch = [job]
+                # Fill the batch only with jobs that are already waiting
+                while len(batch) < runner.batch_size and not self._queue.empty():
+                    job = self._queue.get_nowait()[2]
+                    if not job.future.cancelled():
+                        batch.append(job)
+                await self._run_batch(runner, batch)
+        finally:
+            await runner.close()
+
+    async def _run_batch(self, runner, jobs: list) -> None:
+        results = {}
+        start_time = time.monotonic()
+        for job in jobs:
+            results[job] = {
+                "path": job.pdf_path,
+                "size": job.size,
+                "status": OCR_FAILED,
+                "attempts": 0,
+                "queued_seconds": round(start_time - job.queued_at, 3),
+                "duration_seconds": 0.0,
+                "returncode": None,
+                "error": None
+            }
+
+        pending = list(jobs)
+        try:
+            for attempt in range(1, self.max_retries + 2):
+                if not pending:
+                    break
+                if attempt == 1:
+                    outcomes = await runner.run([(job.pdf_path, job.output_dir) for job in pending])
+                else:
+                    # Retry one PDF at a time so a poisoned PDF cannot fail its batch-mates again
+                    outcomes = [(await runner.run([(job.pdf_path, job.output_dir)]))[0] for job in pending]
+                failed = []
+                for job, (status, returncode, error, duration) in zip(pending, outcomes):
+                    results[job].update(attempts=attempt, status=status, returncode=returncode, error=error)
+                    results[job]["duration_seconds"] = round(results[job]["duration_seconds"] + duration, 3)
+                    if status != OCR_SUCCEEDED:
+                        logger.warning(f"OCR attempt {attempt} for {job.pdf_path} {status}: {error}")
+                        failed.append(job)
+                pending = failed
+        except asyncio.CancelledError:
+            for job in jobs:
+                job.future.cancel()
+            raise
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+
+        for job in jobs:
+            metrics.OCR_SECONDS.labels(results[job]["status"]).observe(results[job]["duration_seconds"])
+            metrics.OCR_QUEUE_SECONDS.observe(results[job]["queued_seconds"])
+            if not job.future.done():
+                job.future.set_result(results[job])
+
+
+class SubprocessOcrRunner:
+    """Runs one docling CLI process per PDF"""
+
+    batch_size = 1
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+    async def close(self) -> None:
+        pass
+
+    @staticmethod
+    def build_command(pdf_path: str, output_dir: Optional[str] = None) -> list:
+        command = ["docling", "--pipeline", "vlm", "--vlm-model", "smoldocling", pdf_path]
+        output_dir = output_dir or config.OCR_OUTPUT_DIR
+        if output_dir:
+            command += ["--output", output_dir]
+        return command
+
+    async def run(self, jobs: list) -> list:
+        """Convert (pdf_path, output_dir) pairs one by one"""
+        outcomes = []
+        for pdf_path, output_dir in jobs:
+            command = self.build_command(pdf_path, output_dir)
+            logger.info(f"Running OCR command: {' '.join(command)}")
+            start_time = time.monotonic()
+            status, returncode, error = await self._run_attempt(command)
+            outcomes.append((status, returncode, error, time.monotonic() - start_time))
+        return outcomes
+
+    async def _run_attempt(self, command: list):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True # Own process group, so a kill also reaches docling's children
+            )
+        except Exception as e:
+            return OCR_FAILED, None, f"Could not start docling: {e}"
+
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            await self._kill(process)
+            return OCR_TIMED_OUT, process.returncode, f"Killed after {self.timeout}s"
+        except asyncio.CancelledError:
+            await self._kill(process)
+            raise
+
+        if process.returncode == 0:
+            return OCR_SUCCEEDED, 0, None
+        stderr_text = stderr.decode(errors="replace")[-STDERR_TAIL_CHARS:] if stderr else ""
+        return OCR_FAILED, process.returncode, stderr_text or f"docling exited with code {process.returncode}"
+
+    @staticmethod
+    async def _kill(process) -> None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+ocr_scheduler = OcrScheduler(
+    slots=config.OCR_SLOTS,
+    timeout=config.OCR_TIMEOUT_SECONDS,
+    max_retries=config.OCR_MAX_RETRIES,
+    order=config.OCR_ORDER
+)
@@ -0,0 +1,163 @@
+import os
+import time
+import config
+import asyncio
+import logging
+import importlib
+import multiprocessing
+
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Same values as the OCR_* status constants in ocr_scheduler
+_SUCCEEDED = "succeeded"
+_FAILED = "failed"
+_TIMED_OUT = "timed_out"
+
+
+def default_converter_factory():
+    """Build a docling converter running the SmolDocling VLM pipeline, like `docling --pipeline vlm`"""
+    from docling.datamodel.base_models import InputFormat
+    from docling.pipeline.vlm_pipeline import VlmPipeline
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+    from docling.datamodel.pipeline_options import VlmPipelineOptions, smoldocling_vlm_conversion_options
+
+    pipeline_options = VlmPipelineOptions()
+    pipeline_options.vlm_options = smoldocling_vlm_conversion_options
+    return DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(pipeline_cls=VlmPipeline, pipeline_options=pipeline_options)
+        }
+    )
+
+
+def load_converter_factory(factory_path: Optional[str]):
+    """Resolve a "module:function" path to a converter factory; the docling one when unset"""
+    if not factory_path:
+        return default_converter_factory
+    module_name, _, attribute = factory_path.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def _convert_one(converter, pdf_path: str, output_dir: str) -> tuple:
+    start_time = time.monotonic()
+    try:
+        result = converter.convert(pdf_path)
+        markdown = result.document.export_to_markdown()
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(pdf_path))[0]}.md")
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(markdown)
+        return _SUCCEEDED, 0, None, time.monotonic() - start_time
+    except Exception as e:
+        return _FAILED, None, f"{type(e).__name__}: {e}", time.monotonic() - start_time
+
+
+def _worker_main(connection, factory_path: Optional[str]) -> None:
+    """Worker process loop: load the converter once, then convert batches until told to stop"""
+    converter = load_converter_factory(factory_path)()
+    connection.send("ready")
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        connection.send([_convert_one(converter, pdf_path, output_dir) for pdf_path, output_dir in request])
+
+
+class WarmOcrRunner:
+    """Converts PDFs in a persistent worker process that keeps the docling model loaded.
+
+    The process is started on first use and replaced after
+    OCR_WORKER_MAX_DOCUMENTS documents to cap memory growth, or when a batch
+    exceeds its timeout. Outcomes have the same shape as SubprocessOcrRunner's.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.batch_size = max(1, config.OCR_BATCH_SIZE)
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._connection = None
+        self._documents = 0
+
+    def _start(self) -> None:
+        parent_connection, child_connection = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_worker_main,
+            args=(child_connection, config.OCR_CONVERTER_FACTORY),
+            daemon=True
+        )
+        self._process.start()
+        child_connection.close()
+        self._connection = parent_connection
+        self._documents = 0
+        logger.info(f"Started OCR worker process {self._process.pid}")
+
+    def _stop(self, kill: bool = False) -> None:
+        if self._process is None:
+            return
+        if kill:
+            self._process.kill()
+        else:
+            try:
+                self._connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self._process.join(timeout=10)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._connection.close()
+        logger.info(f"Stopped OCR worker process {self._process.pid}")
+        self._process = None
+        self._connection = None
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._stop)
+
+    def _exchange(self, jobs: list) -> list:
+        self._connection.send(jobs)
+        return self._connection.recv()
+
+    async def _ensure_worker(self) -> None:
+        """Start a worker if none is alive and wait until its converter is loaded"""
+        loop = asyncio.get_running_loop()
+        if self._process is not None and self._process.is_alive():
+            return
+        await loop.run_in_executor(None, self._stop, True)
+        await loop.run_in_executor(None, self._start)
+        await asyncio.wait_for(loop.run_in_executor(None, self._connection.recv), timeout=self.timeout)
+
+    async def run(self, jobs: list) -> list:
+        """Convert (pdf_path, output_dir) pairs in the worker; output_dir falls back to OCR_OUTPUT_DIR"""
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+        default_dir = config.OCR_OUTPUT_DIR or os.getcwd()
+        jobs = [(pdf_path, output_dir or default_dir) for pdf_path, output_dir in jobs]
+        timeout = self.timeout * len(jobs)
+        try:
+            await self._ensure_worker()
+            outcomes = await asyncio.wait_for(
+                loop.run_in_executor(None, self._exchange, jobs),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            await loop.run_in_executor(None, self._stop, True)
+            duration = (time.monotonic() - start_time) / len(jobs)
+            return [(_TIMED_OUT, None, f"OCR worker killed after {timeout}s", duration)] * len(jobs)
+        except (EOFError, OSError) as e:
+            await loop.run_in_executor(None, self._stop, True)
+            duration = (time.monotonic() - start_time) / len(jobs)
+            return [(_FAILED, None, f"OCR worker died: {e!r}", duration)] * len(jobs)
+        except asyncio.CancelledError:
+            self._stop(kill=True)
+            raise
+
+        self._documents += len(jobs)
+        if self._documents >= config.OCR_WORKER_MAX_DOCUMENTS:
+            await loop.run_in_executor(None, self._stop)
+        return outcomes
@@ -0,0 +1,132 @@
+import os
+import time
+import config
+import logging
+import cas_store
+
+from typing import Dict, Tuple
+from db_handler import db_handler
+from utils import run_blocking, output_names, remove_files_in_batches, is_path_below
+from ocr_cache import JOBS_DIR_NAME, OCR_OUTPUT_EXTENSION
+
+logger = logging.getLogger(__name__)
+
+# Values of OUTPUT_SYNC_MODE
+OUTPUT_SYNC_CLEAN = "clean"             # Empty OUTPUT_DIR before every scan
+OUTPUT_SYNC_INCREMENTAL = "incremental" # Reconcile OUTPUT_DIR with the tracked output paths
+
+
+def _list_outputs(output_dir: str) -> Tuple[Dict[str, Tuple[int, int]], set]:
+    """Every file below output_dir with its (size, mtime_ns), and the names directly in output_dir. Blocking."""
+    outputs = {}
+    top_level_names = set()
+    to_scan = [output_dir]
+    while to_scan:
+        directory = to_scan.pop()
+        try:
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    if directory == output_dir:
+                        top_level_names.add(entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name != JOBS_DIR_NAME: # OCR jobs in flight
+                                to_scan.append(entry.path)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            outputs[entry.path] = (st.st_size, st.st_mtime_ns)
+                    except OSError as e:
+                        logger.warning(f"Could not stat output {entry.path}: {e}")
+        except FileNotFoundError:
+            continue
+    return outputs, top_level_names
+
+
+def _list_ocr_outputs(ocr_dir: str) -> Tuple[Dict[str, Tuple[int, int]], set]:
+    """The published markdown files directly in ocr_dir with their (size, mtime_ns), and every name there. Blocking."""
+    outputs = {}
+    names = set()
+    try:
+        with os.scandir(ocr_dir) as iterator:
+            for entry in iterator:
+                names.add(entry.name)
+                try:
+                    if entry.name.endswith(OCR_OUTPUT_EXTENSION) and entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        outputs[entry.path] = (st.st_size, st.st_mtime_ns)
+                except OSError as e:
+                    logger.warning(f"Could not stat OCR output {entry.path}: {e}")
+    except FileNotFoundError:
+        pass
+    return outputs, names
+
+
+async def reconcile_outputs(output_dir: str):
+    """Bring output_dir in line with the tracked output paths instead of emptying it.
+
+    Files no record of an existing source points at are deleted (a failed
+    record still has its output), and so are outputs whose size or mtime no
+    longer match their record (copies keep the source mtime).
+    The OCR markdown published directly in OCR_OUTPUT_DIR, when that is set,
+    is reconciled the same way against its ``output_size``. Returns the source
+    paths whose output is missing or was stale, so the scan can process them
+    again, and a summary for the scan report.
+    """
+    start_time = time.monotonic()
+    await run_blocking(os.makedirs, output_dir, exist_ok=True)
+    on_disk, top_level_names = await run_blocking(_list_outputs, output_dir)
+    output_dir = os.path.normpath(output_dir)
+    ocr_dir = os.path.normpath(config.OCR_OUTPUT_DIR) if config.OCR_OUTPUT_DIR else None
+    if ocr_dir is not None and is_path_below(ocr_dir, output_dir):
+        # Already listed with output_dir
+        ocr_dir = None
+    ocr_names = ()
+    if ocr_dir is not None:
+        ocr_outputs, ocr_names = await run_blocking(_list_ocr_outputs, ocr_dir)
+        on_disk.update(ocr_outputs)
+
+    def managed(path):
+        return is_path_below(path, output_dir) or os.path.dirname(path) == ocr_dir
+
+    referenced = set()
+    missing, stale = set(), []
+    async for record in db_handler.iter_output_records():
+        output_path = record["output_path"]
+        if not output_path or record.get("status") == config.STATUS_DELETED or not managed(output_path):
+            continue
+        referenced.add(output_path)
+        current = on_disk.get(output_path)
+        ocr_output = "output_size" in record
+        if current is None:
+            missing.add(record["file_path"])
+        elif current[0] != record.get("output_size" if ocr_output else "size") or (
+                # Deduplicated outputs carry the mtime of whichever file created the blob, OCR output its own
+                not record.get("blob_digest") and not ocr_output
+                and record.get("mtime_ns") not in (None, current[1])):
+            stale.append(output_path)
+            missing.add(record["file_path"])
+
+    # Like clean_output_folders, leave JSON files alone; blobs are garbage-collected by reference count
+    blob_root = cas_store.cas_root() + os.sep
+    orphans = [
+        path for path in on_disk
+        if path not in referenced and not path.lower().endswith(".json") and not path.startswith(blob_root)
+    ]
+    removed_count = await remove_files_in_batches(orphans + stale, config.OUTPUT_SYNC_DELETE_BATCH_SIZE)
+    # Reuse the listing for output naming instead of listing the directory again
+    removed = set(orphans).union(stale)
+    output_names.seed(output_dir, (
+        name for name in top_level_names if os.path.join(output_dir, name) not in removed
+    ))
+    if ocr_dir is not None:
+        output_names.seed(ocr_dir, (name for name in ocr_names if os.path.join(ocr_dir, name) not in removed))
+    summary = {
+        "orphans_removed": len(orphans),
+        "stale_removed": len(stale),
+        "files_removed": removed_count,
+        "outputs_to_restore": len(missing),
+        "duration_seconds": round(time.monotonic() - start_time, 3)
+    }
+    logger.info(f"Reconciled {output_dir}: {len(orphans)} orphans and {len(stale)} stale outputs removed, "
+                f"{len(missing)} outputs to restore")
+    return missing, summary
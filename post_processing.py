@@ -0,0 +1,437 @@
+"""Post-processing of OCR'd PDFs by the script at POST_PROCESS_SCRIPT_PATH.
+
+POST_PROCESS_MODE picks how the script runs:
+
+- ``subprocess``: ``python <script> --input-pdf <path>``, one interpreter per PDF
+- ``plugin``: the script is imported once in each pool process and its
+  POST_PROCESS_ENTRY_POINT function is called with a PDF path. It returns a
+  dict of results to record (or None) and raises, or returns False, on failure
+- ``worker``: ``python <script> --worker`` runs for as long as the service. It
+  reads one JSON line ``{"paths": [...]}`` per batch from stdin and answers with
+  one JSON line ``{"results": [...]}`` on stdout, one ``{"status": "succeeded"
+  or "failed", "error": ..., "output": ...}`` per path in the same order; its
+  logs go to stderr
+
+PDFs queue for POST_PROCESS_WORKERS slots, each with its own process, and a
+slot takes up to POST_PROCESS_BATCH_SIZE waiting PDFs at once. A batch is
+killed after POST_PROCESS_TIMEOUT_SECONDS per PDF; a batch that times out or
+whose worker dies is run again one PDF at a time, so one bad document does
+not fail the others. Every PDF resolves to a result dict for the scan report
+and the file record.
+"""
+import os
+import sys
+import json
+import time
+import config
+import signal
+import asyncio
+import logging
+import metrics
+import importlib.util
+import multiprocessing
+
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+POST_PROCESS_SUCCEEDED = "succeeded"
+POST_PROCESS_FAILED = "failed"
+POST_PROCESS_TIMED_OUT = "timed_out"
+
+POST_PROCESS_MODE_SUBPROCESS = "subprocess"
+POST_PROCESS_MODE_PLUGIN = "plugin"
+POST_PROCESS_MODE_WORKER = "worker"
+
+# Keep only the end of the script's stdout and stderr in results
+OUTPUT_TAIL_CHARS = 2000
+# Longest answer line read from a worker
+WORKER_LINE_LIMIT = 16 * 1024 * 1024
+
+
+class BatchAborted(Exception):
+    """A whole batch failed: its worker timed out or died before answering"""
+
+    def __init__(self, status: str, error: str):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+def _outcome(status: str, error: Optional[str] = None, output=None, duration: float = 0.0) -> dict:
+    return {"status": status, "error": error, "output": output, "duration_seconds": duration}
+
+
+def load_plugin(script_path: str, entry_point: str):
+    """Import the script as a module and return its entry point function"""
+    spec = importlib.util.spec_from_file_location("post_process_plugin", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, entry_point)
+
+
+def _run_plugin_one(function, pdf_path: str) -> dict:
+    start_time = time.monotonic()
+    try:
+        output = function(pdf_path)
+    except Exception as e:
+        return _outcome(POST_PROCESS_FAILED, f"{type(e).__name__}: {e}", duration=time.monotonic() - start_time)
+    if output is False:
+        return _outcome(POST_PROCESS_FAILED, "Entry point returned False", duration=time.monotonic() - start_time)
+    return _outcome(POST_PROCESS_SUCCEEDED, output=output if output is not True else None,
+                    duration=time.monotonic() - start_time)
+
+
+def _plugin_worker_main(connection, script_path: str, entry_point: str) -> None:
+    """Pool process loop: import the plugin once, then run batches until told to stop"""
+    function = load_plugin(script_path, entry_point)
+    connection.send("ready")
+    while True:
+        try:
+            pdf_paths = connection.recv()
+        except EOFError:
+            return
+        if pdf_paths is None:
+            return
+        connection.send([_run_plugin_one(function, pdf_path) for pdf_path in pdf_paths])
+
+
+class PluginRunner:
+    """Calls the plugin's entry point in a pool process of its own, started on first use and replaced after a timeout"""
+
+    mode = POST_PROCESS_MODE_PLUGIN
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.batch_size = max(1, config.POST_PROCESS_BATCH_SIZE)
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._connection = None
+
+    def _start(self) -> None:
+        parent_connection, child_connection = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_plugin_worker_main,
+            args=(child_connection, config.POST_PROCESS_SCRIPT_PATH, config.POST_PROCESS_ENTRY_POINT),
+            daemon=True
+        )
+        self._process.start()
+        child_connection.close()
+        self._connection = parent_connection
+        logger.info(f"Started post-processing plugin process {self._process.pid}")
+
+    def _stop(self, kill: bool = False) -> None:
+        if self._process is None:
+            return
+        if kill:
+            self._process.kill()
+        else:
+            try:
+                self._connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self._process.join(timeout=10)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._connection.close()
+        logger.info(f"Stopped post-processing plugin process {self._process.pid}")
+        self._process = None
+        self._connection = None
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._stop)
+
+    def _exchange(self, pdf_paths: list) -> list:
+        self._connection.send(pdf_paths)
+        return self._connection.recv()
+
+    async def run(self, pdf_paths: list) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout * len(pdf_paths)
+        try:
+            if self._process is None or not self._process.is_alive():
+                await loop.run_in_executor(None, self._stop, True)
+                await loop.run_in_executor(None, self._start)
+                await asyncio.wait_for(loop.run_in_executor(None, self._connection.recv), timeout=self.timeout)
+            return await asyncio.wait_for(loop.run_in_executor(None, self._exchange, pdf_paths), timeout=timeout)
+        except asyncio.TimeoutError:
+            await loop.run_in_executor(None, self._stop, True)
+            raise BatchAborted(POST_PROCESS_TIMED_OUT, f"Plugin process killed after {timeout}s")
+        except (EOFError, OSError) as e:
+            await loop.run_in_executor(None, self._stop, True)
+            raise BatchAborted(POST_PROCESS_FAILED, f"Plugin process died: {e!r}")
+        except asyncio.CancelledError:
+            self._stop(kill=True)
+            raise
+
+
+class _ProcessRunner:
+    """Base of the runners that start the script as a child process in its own process group"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+    @staticmethod
+    async def _kill(process) -> None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+class SubprocessRunner(_ProcessRunner):
+    """Runs ``python <script> --input-pdf <path>`` once per PDF"""
+
+    mode = POST_PROCESS_MODE_SUBPROCESS
+    batch_size = 1
+
+    async def close(self) -> None:
+        pass
+
+    async def run(self, pdf_paths: list) -> List[dict]:
+        return [await self._run_one(pdf_path) for pdf_path in pdf_paths]
+
+    async def _run_one(self, pdf_path: str) -> dict:
+        command = [sys.executable, config.POST_PROCESS_SCRIPT_PATH, "--input-pdf", pdf_path]
+        start_time = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True # Own process group, so a kill also reaches the script's children
+            )
+        except Exception as e:
+            return _outcome(POST_PROCESS_FAILED, f"Could not start the post-processing script: {e}")
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            await self._kill(process)
+            return _outcome(POST_PROCESS_TIMED_OUT, f"Killed after {self.timeout}s",
+                            duration=time.monotonic() - start_time)
+        except asyncio.CancelledError:
+            await self._kill(process)
+            raise
+
+        duration = time.monotonic() - start_time
+        output = stdout.decode(errors="replace")[-OUTPUT_TAIL_CHARS:] or None
+        if process.returncode == 0:
+            return _outcome(POST_PROCESS_SUCCEEDED, output=output, duration=duration)
+        error = stderr.decode(errors="replace")[-OUTPUT_TAIL_CHARS:] or f"Script exited with code {process.returncode}"
+        return _outcome(POST_PROCESS_FAILED, error, output, duration)
+
+
+class WorkerRunner(_ProcessRunner):
+    """Hands batches of paths to a long-lived ``python <script> --worker`` over stdin/stdout"""
+
+    mode = POST_PROCESS_MODE_WORKER
+
+    def __init__(self, timeout: float):
+        super().__init__(timeout)
+        self.batch_size = max(1, config.POST_PROCESS_BATCH_SIZE)
+        self._process: Optional[asyncio.subprocess.Process] = None
+
+    async def _start(self) -> None:
+        self._process = await asyncio.create_subprocess_exec(
+            sys.executable, config.POST_PROCESS_SCRIPT_PATH, "--worker",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            limit=WORKER_LINE_LIMIT
+        )
+        logger.info(f"Started post-processing worker {self._process.pid}")
+
+    async def _stop(self) -> None:
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        if process.returncode is None:
+            await self._kill(process)
+        logger.info(f"Stopped post-processing worker {process.pid}")
+
+    async def close(self) -> None:
+        if self._process is not None and self._process.returncode is None:
+            # Closing stdin is the worker's signal to exit
+            self._process.stdin.close()
+            try:
+                await asyncio.wait_for(self._process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                pass
+        await self._stop()
+
+    async def _exchange(self, pdf_paths: list) -> list:
+        self._process.stdin.write(json.dumps({"paths": pdf_paths}).encode() + b"\n")
+        await self._process.stdin.drain()
+        line = await self._process.stdout.readline()
+        if not line:
+            raise EOFError(f"worker exited with code {await self._process.wait()}")
+        results = json.loads(line)["results"]
+        if len(results) != len(pdf_paths):
+            raise ValueError(f"{len(results)} results for {len(pdf_paths)} paths")
+        return results
+
+    async def run(self, pdf_paths: list) -> List[dict]:
+        timeout = self.timeout * len(pdf_paths)
+        start_time = time.monotonic()
+        try:
+            if self._process is None or self._process.returncode is not None:
+                await self._stop()
+                await self._start()
+            results = await asyncio.wait_for(self._exchange(pdf_paths), timeout=timeout)
+        except asyncio.TimeoutError:
+            await self._stop()
+            raise BatchAborted(POST_PROCESS_TIMED_OUT, f"Worker killed after {timeout}s")
+        except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+            # Also a malformed answer: the stream can no longer be trusted
+            await self._stop()
+            raise BatchAborted(POST_PROCESS_FAILED, f"Worker failed: {e!r}")
+        except asyncio.CancelledError:
+            await self._stop()
+            raise
+
+        duration = (time.monotonic() - start_time) / len(pdf_paths)
+        return [
+            _outcome(
+                POST_PROCESS_SUCCEEDED if result.get("status") == POST_PROCESS_SUCCEEDED else POST_PROCESS_FAILED,
+                result.get("error"), result.get("output"), duration
+            )
+            for result in results
+        ]
+
+
+class PostProcessJob:
+    """A queued post-processing request and the future its submitter awaits"""
+
+    def __init__(self, pdf_path: str, future: asyncio.Future):
+        self.pdf_path = pdf_path
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class PostProcessor:
+    """Runs the post-processing script on a fixed number of slots, like OcrScheduler runs docling"""
+
+    def __init__(self, slots: int, timeout: float, mode: str):
+        self.slots = max(1, slots)
+        self.timeout = timeout
+        self.mode = mode
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        self._loop = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(config.POST_PROCESS_SCRIPT_PATH)
+
+    def _ensure_started(self) -> None:
+        """Start the slots on the running loop, restarting them if the loop changed"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.slots)]
+        logger.info(f"Started post-processing with {self.slots} {self.mode} slots")
+
+    async def close(self) -> None:
+        """Stop the slots and their processes; queued requests are cancelled"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait().future.cancel()
+        self._workers = []
+        self._queue = None
+        self._loop = None
+
+    async def submit(self, pdf_path: str) -> Optional[dict]:
+        """Post-process a PDF and return its result, or None when no script is configured"""
+        if not self.enabled:
+            return None
+        if not os.path.exists(config.POST_PROCESS_SCRIPT_PATH):
+            return self._result(pdf_path, 0.0, _outcome(
+                POST_PROCESS_FAILED, f"Post-processing script not found at: {config.POST_PROCESS_SCRIPT_PATH}"
+            ))
+        self._ensure_started()
+        job = PostProcessJob(pdf_path, self._loop.create_future())
+        await self._queue.put(job)
+        return await job.future
+
+    def _make_runner(self):
+        if self.mode == POST_PROCESS_MODE_PLUGIN:
+            return PluginRunner(self.timeout)
+        if self.mode == POST_PROCESS_MODE_WORKER:
+            return WorkerRunner(self.timeout)
+        return SubprocessRunner(self.timeout)
+
+    async def _worker(self) -> None:
+        runner = self._make_runner()
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                # Fill the batch only with requests that are already waiting
+                while len(batch) < runner.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                await self._run_batch(runner, batch)
+        finally:
+            await runner.close()
+
+    async def _run_batch(self, runner, jobs: List[PostProcessJob]) -> None:
+        start_time = time.monotonic()
+        try:
+            try:
+                outcomes = await runner.run([job.pdf_path for job in jobs])
+            except BatchAborted as e:
+                if len(jobs) == 1:
+                    outcomes = [_outcome(e.status, e.error, duration=time.monotonic() - start_time)]
+                else:
+                    logger.warning(f"Post-processing batch of {len(jobs)} PDFs {e.status}: {e.error}; "
+                                   f"running them one at a time")
+                    outcomes = [await self._run_alone(runner, job.pdf_path) for job in jobs]
+        except asyncio.CancelledError:
+            for job in jobs:
+                job.future.cancel()
+            raise
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+
+        for job, outcome in zip(jobs, outcomes):
+            result = self._result(job.pdf_path, start_time - job.queued_at, outcome)
+            if result["status"] != POST_PROCESS_SUCCEEDED:
+                logger.warning(f"Post-processing of {job.pdf_path} {result['status']}: {result['error']}")
+            if not job.future.done():
+                job.future.set_result(result)
+
+    @staticmethod
+    async def _run_alone(runner, pdf_path: str) -> dict:
+        start_time = time.monotonic()
+        try:
+            return (await runner.run([pdf_path]))[0]
+        except BatchAborted as e:
+            return _outcome(e.status, e.error, duration=time.monotonic() - start_time)
+
+    def _result(self, pdf_path: str, queued_seconds: float, outcome: dict) -> dict:
+        metrics.POST_PROCESS_SECONDS.labels(self.mode, outcome["status"]).observe(outcome["duration_seconds"])
+        return {
+            "path": pdf_path,
+            "mode": self.mode,
+            "status": outcome["status"],
+            "queued_seconds": round(queued_seconds, 3),
+            "duration_seconds": round(outcome["duration_seconds"], 3),
+            "error": outcome["error"],
+            "output": outcome["output"]
+        }
+
+
+post_processor = PostProcessor(
+    slots=config.POST_PROCESS_WORKERS,
+    timeout=config.POST_PROCESS_TIMEOUT_SECONDS,
+    mode=config.POST_PROCESS_MODE
+)
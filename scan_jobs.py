@@ -0,0 +1,191 @@
+import os
+import config
+import asyncio
+import logging
+import cas_store
+
+from typing import List, Optional
+from datetime import datetime
+from leases import Lease
+from db_handler import db_handler
+from output_sync import OUTPUT_SYNC_CLEAN
+from utils import clean_output_folders, run_blocking
+from files_processing import process_directory
+from work_units import run_partitioned_scan
+from scan_report import ScanReport, STATUS_FAILED, STATUS_RUNNING
+
+logger = logging.getLogger(__name__)
+
+
+class ScanAlreadyRunning(Exception):
+    pass
+
+
+class ScanJobManager:
+    """Runs one scan at a time as a background task and keeps its report for progress queries.
+
+    The "scan" lease in the database makes that one scan across every worker
+    process and node; the watcher of every worker takes it too for each
+    batch of changes it applies. Scans checkpoint as they go (SCAN_CHECKPOINT_INTERVAL).
+    On shutdown the running scan is checkpointed and left "running" in the
+    database, so resume_interrupted() picks it up at the next start, also
+    after a crash. With SCAN_PARTITION_DEPTH set, the scan is split into work
+    units that every worker claims, and this worker coordinates them.
+    If the lease is taken over by another worker, the scan or batch running
+    under it is cancelled.
+    """
+
+    def __init__(self):
+        self._report: Optional[ScanReport] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lease = Lease("scan", on_lost=self._cancel_held)
+        # Reports of the batch of watched changes applied under the lease
+        self._change_reports: List[ScanReport] = []
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def current(self) -> Optional[ScanReport]:
+        return self._report if self.running else None
+
+    async def start(self, directory: str, deep_verify: bool = False) -> ScanReport:
+        """Start scanning directory in the background; the report's scan_id identifies the job"""
+        if self.running:
+            raise ScanAlreadyRunning(f"Scan {self._report.scan_id} is already in progress")
+        if not os.path.exists(directory):
+            raise FileNotFoundError(f"Directory not found: {directory}")
+        if not await self._lease.acquire():
+            raise ScanAlreadyRunning("A scan or a batch of watched changes is in progress")
+        options = {"deep_verify": deep_verify, "sync_outputs": True}
+        if config.SCAN_PARTITION_DEPTH > 0:
+            options["partition_depth"] = config.SCAN_PARTITION_DEPTH
+        report = ScanReport(directory, "scan", options)
+        self._launch(report)
+        return report
+
+    async def resume_interrupted(self) -> Optional[ScanReport]:
+        """Resume the latest scan left running by a restart; older ones and watch batches are marked failed.
+
+        Only the worker that gets the scan lease does this; while another
+        worker holds it, its scan is not interrupted.
+        """
+        if not await self._lease.acquire():
+            return None
+        report = await self._resumable_report()
+        if report is None:
+            await self._lease.release()
+            return None
+        self._launch(report)
+        return report
+
+    async def _resumable_report(self) -> Optional[ScanReport]:
+        headers = await db_handler.find_scans_with_status(STATUS_RUNNING)
+        resumable = [header for header in headers if header.get("trigger", "scan") == "scan"]
+        latest = resumable[-1] if resumable else None
+        for header in headers:
+            if header is not latest:
+                await db_handler.update_scan_header(header["_id"], {
+                    "status": STATUS_FAILED,
+                    "finished_at": datetime.utcnow(),
+                    "error": "Interrupted by a restart"
+                })
+        if latest is None:
+            return None
+        if not os.path.exists(latest["directory"]):
+            logger.error(f"Not resuming scan {latest['_id']}: directory {latest['directory']} is gone")
+            await db_handler.update_scan_header(latest["_id"], {
+                "status": STATUS_FAILED,
+                "finished_at": datetime.utcnow(),
+                "error": "Directory not found on resume"
+            })
+            return None
+        if (latest.get("options") or {}).get("partition_depth"):
+            # Its finished work units are the checkpoint; the rest are claimed again
+            return ScanReport.from_header(latest)
+        return await ScanReport.resume(latest)
+
+    def _launch(self, report: ScanReport) -> None:
+        self._report = report
+        self._task = asyncio.create_task(self._run(report))
+
+    async def _run(self, report: ScanReport) -> None:
+        try:
+            # Clean output directory, unless the scan reconciles it incrementally
+            if config.OUTPUT_SYNC_MODE == OUTPUT_SYNC_CLEAN and not report.resumed:
+                # Blobs stay referenced by their file records and are garbage-collected by reference count
+                await run_blocking(clean_output_folders, config.OUTPUT_DIR, (cas_store.CAS_DIR_NAME,))
+            options = report.options
+            if options.get("partition_depth"):
+                await run_partitioned_scan(report)
+            else:
+                await process_directory(
+                    report.directory, deep_verify=options.get("deep_verify", False),
+                    sync_outputs=options.get("sync_outputs", True), report=report
+                )
+            logger.info(f"Scan {report.scan_id} {report.status}. Results saved to database.")
+        except asyncio.CancelledError:
+            logger.info(f"Scan {report.scan_id} interrupted by shutdown; it will resume at the next start")
+            raise
+        except Exception as e:
+            logger.error(f"Error during background scan: {e}", exc_info=True)
+        finally:
+            await self._lease.release()
+
+    def _cancel_held(self) -> None:
+        """Another worker took the scan lease and may start its own scan: stop ours"""
+        if self.running:
+            logger.error(f"Cancelling scan {self._report.scan_id}, which lost the scan lease")
+            self._report.cancel()
+        for report in self._change_reports:
+            report.cancel()
+
+    async def hold_for_changes(self) -> bool:
+        """Take the scan lease to apply a batch of watched changes; False while a scan runs in any worker"""
+        self._change_reports = []
+        return await self._lease.acquire()
+
+    def track_changes(self, report: ScanReport) -> None:
+        """Cancel report, of the batch of watched changes being applied, if the scan lease is lost"""
+        self._change_reports.append(report)
+        if self._lease.lost:
+            report.cancel()
+
+    async def release_for_changes(self) -> bool:
+        """Give the scan lease back; False if it was lost while the batch was applied"""
+        self._change_reports = []
+        completed = not self._lease.lost
+        await self._lease.release()
+        return completed
+
+    def find(self, scan_id: str) -> Optional[ScanReport]:
+        """The report of the scan with this id if it is the one this process runs or last ran"""
+        if self._report is not None and str(self._report.scan_id) == scan_id:
+            return self._report
+        return None
+
+    async def cancel(self, scan_id: str) -> bool:
+        """Ask a running scan to stop; False if no scan with this id is running.
+
+        A scan run by another worker picks the request up from its header at
+        its next checkpoint, or its next look at its work units.
+        """
+        report = self.current
+        if report is not None and str(report.scan_id) == scan_id:
+            report.cancel()
+            return True
+        header = await db_handler.find_scan_header(scan_id)
+        if header is None or header.get("status") != STATUS_RUNNING or header.get("trigger", "scan") != "scan":
+            return False
+        await db_handler.update_scan_header(header["_id"], {"cancel_requested": True})
+        return True
+
+    async def stop(self) -> None:
+        """Interrupt the running scan for shutdown, after it has saved a checkpoint"""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+scan_jobs = ScanJobManager()
@@ -0,0 +1,316 @@
+import config
+import asyncio
+import logging
+import metrics
+
+from time import perf_counter
+from typing import Callable, List, Optional
+from datetime import datetime
+from bson import ObjectId
+from db_handler import db_handler
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ("processed_files", "skipped_files", "deleted_files", "errors", "ocr_jobs", "post_processing", "copies")
+
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+# Trigger of the report of one work unit of a partitioned scan
+TRIGGER_UNIT = "unit"
+
+# Entries of the n-th work unit of a scan are numbered from n * UNIT_SEQ_STRIDE
+UNIT_SEQ_STRIDE = 2 ** 32
+
+# Sections that close a file's handling; a resumed scan skips files with one of these
+TERMINAL_SECTIONS = ("processed_files", "skipped_files", "errors")
+
+# Sections recording one step of a file's handling; dropped on resume unless the file was finished
+PARTIAL_SECTIONS = ("ocr_jobs", "post_processing", "copies")
+
+
+class ScanReport:
+    """A scan report streamed to MongoDB while the scan runs.
+
+    The header document in RESULTS_COLLECTION holds the scan's metadata, a
+    running count per section and the summaries (directory index, output
+    sync, dedup). Entries are buffered and inserted in batches of
+    REPORT_BATCH_SIZE into ``{RESULTS_COLLECTION}_entries`` under the scan's
+    id, so memory use does not grow with the number of files. Observers see
+    every entry as it is added, for statistics that need more than counts.
+    The time spent in each stage is saved under ``summary.stages``, the
+    process's peak RSS during the scan under ``summary.peak_rss_bytes``, and
+    with SCAN_PROFILE_INTERVAL set a sampled profile under ``summary.profile``.
+
+    Entries are numbered in the order they are added (``seq``). A checkpoint
+    flushes the write batcher, then the entries, and records the last number
+    in the header: everything up to it is durable, so a scan interrupted by a
+    restart can be resumed from it.
+    """
+
+    def __init__(self, directory: str, trigger: str = "scan", options: Optional[dict] = None):
+        self.scan_id = ObjectId()
+        self.directory = directory
+        self.trigger = trigger
+        self.options = options or {}
+        self.timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.counts = {section: 0 for section in SECTIONS}
+        self.summary = {}
+        self.write_errors = 0
+        self.status = STATUS_RUNNING
+        self.cancelled = False
+        # Progress: files found by the walker, tracked files expected below the directory
+        self.files_discovered = 0
+        self.files_expected: Optional[int] = None
+        self.walk_finished = False
+        # Files finished before the checkpoint this scan was resumed from
+        self.completed_paths = set()
+        self.resumed = False
+        self._resumed_done = 0
+        self._seq = 0
+        self._buffer: List[dict] = []
+        self._observers: List[Callable[[str, dict], None]] = []
+        self._flush_lock = asyncio.Lock()
+        self._started = None
+        self._stage_totals = None
+        self._profiler = None
+
+    def subscribe(self, observer: Callable[[str, dict], None]) -> None:
+        self._observers.append(observer)
+
+    async def start(self) -> None:
+        """Create the header document"""
+        self._started = perf_counter()
+        self._stage_totals = metrics.stage_totals()
+        if self.trigger != TRIGGER_UNIT:
+            # Work units run within their coordinating scan's measurement
+            metrics.reset_peak_rss()
+        metrics.SCANS_RUNNING.inc()
+        if config.SCAN_PROFILE_INTERVAL > 0:
+            self._profiler = metrics.StackSampler(config.SCAN_PROFILE_INTERVAL)
+            self._profiler.start()
+        if self.resumed:
+            await self._save_header({
+                "status": STATUS_RUNNING,
+                "resumed_at": datetime.utcnow(),
+                "counts": dict(self.counts)
+            })
+            return
+        await self._create_header()
+
+    async def _create_header(self) -> None:
+        await db_handler.create_scan_header({
+            "_id": self.scan_id,
+            "timestamp": self.timestamp,
+            "directory": self.directory,
+            "trigger": self.trigger,
+            "options": self.options,
+            "status": STATUS_RUNNING,
+            "started_at": datetime.utcnow(),
+            "counts": self.counts
+        })
+
+    async def _save_header(self, fields: dict) -> None:
+        await db_handler.update_scan_header(self.scan_id, fields)
+
+    @classmethod
+    def from_header(cls, header: dict) -> "ScanReport":
+        """The report of a scan already in the database, to carry on with it"""
+        report = cls(header["directory"], header.get("trigger", "scan"), header.get("options"))
+        report.scan_id = header["_id"]
+        report.timestamp = header["timestamp"]
+        report.summary = header.get("summary") or {}
+        report.resumed = True
+        return report
+
+    @classmethod
+    async def resume(cls, header: dict) -> "ScanReport":
+        """Pick up an interrupted scan from its last checkpoint.
+
+        Entries recorded after the checkpoint are deleted, as are the copy,
+        OCR and post-processing entries of files that were not finished by
+        then; files with a terminal entry are left out when the scan runs
+        again. Deletions recorded before the checkpoint are kept.
+        """
+        report = cls.from_header(header)
+        last_seq = (header.get("checkpoint") or {}).get("seq", 0)
+
+        unfinished = {}
+        async for entry in db_handler.iter_scan_entries(report.scan_id):
+            if entry.get("seq", 0) > last_seq:
+                continue
+            section, path = entry["section"], entry.get("path")
+            report.counts[section] += 1
+            if section in TERMINAL_SECTIONS:
+                report.completed_paths.add(path)
+            elif section in PARTIAL_SECTIONS:
+                unfinished.setdefault(path, []).append((section, entry["_id"]))
+
+        stale_ids = []
+        for path, entries in unfinished.items():
+            if path in report.completed_paths:
+                continue
+            for section, entry_id in entries:
+                report.counts[section] -= 1
+                stale_ids.append(entry_id)
+        await db_handler.delete_scan_entries(report.scan_id, last_seq, stale_ids)
+
+        report._seq = last_seq
+        report._resumed_done = report.files_done
+        logger.info(f"Resuming scan {report.scan_id} from entry {last_seq}: "
+                    f"{len(report.completed_paths)} files already done")
+        return report
+
+    def cancel(self) -> None:
+        """Ask the scan to stop; it finishes the files in flight and saves its report as cancelled"""
+        self.cancelled = True
+
+    async def poll_cancel(self) -> None:
+        """Pick up a cancellation requested through another worker process"""
+        header = await db_handler.find_scan_header(str(self.scan_id))
+        if header is not None and header.get("cancel_requested"):
+            self.cancel()
+
+    @property
+    def files_done(self) -> int:
+        return sum(self.counts[section] for section in TERMINAL_SECTIONS)
+
+    def progress(self) -> dict:
+        """Live counters, rate and ETA; the total is an estimate until the walk has finished"""
+        elapsed = perf_counter() - self._started if self._started is not None else 0.0
+        done = self.files_done
+        total = self.files_discovered
+        if not self.walk_finished and self.files_expected is not None:
+            total = max(total, self.files_expected)
+        rate = (done - self._resumed_done) / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.status == STATUS_RUNNING and rate > 0:
+            eta = round(max(total - done, 0) / rate, 1)
+        return {
+            "scan_id": self.scan_id,
+            "timestamp": self.timestamp,
+            "directory": self.directory,
+            "trigger": self.trigger,
+            "status": self.status,
+            "cancel_requested": self.cancelled,
+            "resumed": self.resumed,
+            "counts": dict(self.counts),
+            "files_done": done,
+            "files_discovered": self.files_discovered,
+            "files_total_estimate": total,
+            "walk_finished": self.walk_finished,
+            "elapsed_seconds": round(elapsed, 1),
+            "files_per_second": round(rate, 1),
+            "eta_seconds": eta
+        }
+
+    async def add(self, section: str, entry: dict) -> None:
+        """Record one entry, flushing once REPORT_BATCH_SIZE entries are buffered"""
+        self.counts[section] += 1
+        metrics.SCAN_ENTRIES.labels(section).inc()
+        for observer in self._observers:
+            observer(section, entry)
+        self._seq += 1
+        self._buffer.append({"scan_id": self.scan_id, "section": section, "seq": self._seq, **entry})
+        if len(self._buffer) >= config.REPORT_BATCH_SIZE:
+            await self.flush()
+
+    async def _insert(self, entries: List[dict]) -> bool:
+        try:
+            await db_handler.insert_scan_entries(entries)
+            return True
+        except Exception as e:
+            # Losing report lines must not abort the scan; the header records how many
+            self.write_errors += len(entries)
+            logger.error(f"Failed to save {len(entries)} report entries for scan {self.scan_id}: {e}")
+            return False
+
+    async def flush(self) -> None:
+        """Insert the buffered entries and update the header counters"""
+        async with self._flush_lock:
+            entries, self._buffer = self._buffer, []
+            if entries:
+                await self._insert(entries)
+            await self._save_header({
+                "counts": dict(self.counts),
+                "write_errors": self.write_errors,
+                "updated_at": datetime.utcnow()
+            })
+
+    async def checkpoint(self, batcher) -> None:
+        """Make every entry added so far durable and record the last one's number in the header"""
+        async with self._flush_lock:
+            entries, self._buffer = self._buffer, []
+            last_seq = self._seq
+            # File records first: an entry is only trusted on resume once what it reports is saved
+            await batcher.flush()
+            saved = await self._insert(entries) if entries else True
+            fields = {"counts": dict(self.counts), "write_errors": self.write_errors, "updated_at": datetime.utcnow()}
+            if saved:
+                fields["checkpoint"] = {"seq": last_seq, "at": datetime.utcnow()}
+            await self._save_header(fields)
+
+    def abandon(self) -> None:
+        """Stop the scan's metrics and profiler without saving it, leaving it to be resumed"""
+        if self._started is not None:
+            metrics.SCANS_RUNNING.dec()
+            self._started = None
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+
+    async def finish(self, status: str = STATUS_COMPLETED) -> None:
+        self.status = status
+        if self._started is not None:
+            metrics.SCANS_RUNNING.dec()
+            metrics.SCANS.labels(self.trigger, status).inc()
+            metrics.SCAN_SECONDS.labels(self.trigger).observe(perf_counter() - self._started)
+            self.summary["stages"] = metrics.stage_summary(self._stage_totals)
+            self.summary["peak_rss_bytes"] = metrics.peak_rss_bytes()
+        if self._profiler is not None:
+            self.summary["profile"] = self._profiler.stop()
+        await self.flush()
+        await self._save_header({
+            "status": status,
+            "finished_at": datetime.utcnow(),
+            "summary": self.summary
+        })
+        logger.info(f"Saved scan report {self.scan_id}: {self.counts}")
+
+
+class UnitReport(ScanReport):
+    """Report of one work unit of a partitioned scan: a subtree, or the files directly in a directory.
+
+    Entries go to the scan's report tagged with the unit's id, so they can be
+    dropped if the unit has to be claimed again. Counts are saved on the work
+    unit, where the coordinating scan adds them up; an update that finds the
+    unit held by another worker means the lease was lost, and cancels the unit.
+    """
+
+    def __init__(self, unit: dict, owner: str):
+        super().__init__(unit["path"], TRIGGER_UNIT)
+        self.scan_id = unit["scan_id"]
+        self.unit_id = unit["_id"]
+        self.owner = owner
+        self.recursive = unit["recursive"]
+        self.lease_lost = False
+        self._seq = unit["seq_base"]
+
+    async def add(self, section: str, entry: dict) -> None:
+        await super().add(section, {"unit": self.unit_id, **entry})
+
+    async def _create_header(self) -> None:
+        pass
+
+    async def _save_header(self, fields: dict) -> None:
+        saved = await db_handler.update_work_unit(self.unit_id, self.owner, {
+            "counts": dict(self.counts),
+            "files_discovered": self.files_discovered,
+            "write_errors": self.write_errors
+        })
+        if not saved and not self.lease_lost:
+            self.lease_lost = True
+            logger.warning(f"Work unit {self.unit_id} ({self.directory}) was taken over by another worker")
+            self.cancel()
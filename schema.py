@@ -0,0 +1,217 @@
+import config
+import logging
+import db_handler
+
+from bson import ObjectId
+from datetime import datetime
+from typing import Callable, List, NamedTuple
+from pymongo import ASCENDING, DESCENDING, DeleteMany, IndexModel
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_DOCUMENT_ID = "tracking"
+
+# Plan stages that read through an index (the EXPRESS_ ones are MongoDB 8's fast paths)
+INDEX_STAGES = {"IXSCAN", "IDHACK", "EXPRESS_IXSCAN", "EXPRESS_IDHACK"}
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable
+
+
+class HotQuery(NamedTuple):
+    name: str
+    collection: str
+    filter: dict
+    sort: list
+
+
+class QueryPlanError(Exception):
+    """A hot query is not answered by an index scan"""
+
+
+def _files(db):
+    return db[f"{config.COLLECTION_NAME}_files"]
+
+
+def _record_rank(record: dict):
+    """Sort key of duplicate records: live records first, then the most recently written"""
+    written = record.get("last_updated") or record.get("processed_time") or datetime.min
+    return (record.get("status") == config.STATUS_PROCESSED, written)
+
+
+async def _dedupe_file_paths(db: AsyncIOMotorDatabase) -> None:
+    """Keep one record per file_path, as older versions inserted a new record on every reprocess"""
+    files = _files(db)
+    cursor = files.aggregate([
+        {"$group": {
+            "_id": "$file_path",
+            "count": {"$sum": 1},
+            "ids": {"$push": "$_id"}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+    operations = []
+    removed = 0
+    async for group in cursor:
+        records = await files.find(
+            {"_id": {"$in": group["ids"]}}, {"status": 1, "last_updated": 1, "processed_time": 1}
+        ).to_list(length=None)
+        records.sort(key=_record_rank, reverse=True)
+        operations.append(DeleteMany({"_id": {"$in": [record["_id"] for record in records[1:]]}}))
+        removed += len(records) - 1
+        if len(operations) >= config.BULK_WRITE_BATCH_SIZE:
+            await files.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await files.bulk_write(operations, ordered=False)
+    logger.info(f"Removed {removed} duplicate file records")
+
+
+# Applied in order, each once; append new steps with the next version number
+MIGRATIONS: List[Migration] = [
+    Migration(1, "dedupe_file_paths", _dedupe_file_paths),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def index_models() -> dict:
+    """Indexes of every collection, by collection name"""
+    files = f"{config.COLLECTION_NAME}_files"
+    return {
+        files: [
+            IndexModel([("file_path", ASCENDING)], name="file_path_unique", unique=True),
+            IndexModel([("status", ASCENDING), ("file_path", ASCENDING)], name="status_file_path"),
+            IndexModel([("directory", ASCENDING)], name="directory"),
+            IndexModel([("output_path", ASCENDING)], name="output_path", sparse=True),
+        ],
+        f"{config.COLLECTION_NAME}_dirs": [
+            IndexModel([("path", ASCENDING)], name="path_unique", unique=True),
+        ],
+        f"{config.COLLECTION_NAME}_blobs": [
+            IndexModel([("refs", ASCENDING)], name="refs"),
+        ],
+        f"{config.COLLECTION_NAME}_ocr_cache": [
+            IndexModel([("last_access", ASCENDING)], name="last_access"),
+        ],
+        config.RESULTS_COLLECTION: [
+            IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+        ],
+        f"{config.RESULTS_COLLECTION}_entries": [
+            IndexModel([("scan_id", ASCENDING), ("_id", ASCENDING)], name="scan_id"),
+            IndexModel([("scan_id", ASCENDING), ("section", ASCENDING), ("_id", ASCENDING)], name="scan_id_section"),
+        ],
+        f"{config.COLLECTION_NAME}_work_units": [
+            IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)], name="status_lease"),
+            IndexModel([("scan_id", ASCENDING)], name="scan_id"),
+        ],
+    }
+
+
+def hot_queries() -> List[HotQuery]:
+    """The queries scans and the API run on large collections, each of which must use an index"""
+    files = f"{config.COLLECTION_NAME}_files"
+    root = config.SOURCE_DATA_LAKE_DIR or "/"
+    return [
+        HotQuery("file_by_path", files, {"file_path": root}, []),
+        HotQuery("files_by_status", files, {"status": config.STATUS_PROCESSED}, []),
+        HotQuery("files_below_root", files, db_handler.path_prefix_filter("file_path", root), []),
+        HotQuery("files_below_root_sorted", files,
+                 {"$and": [db_handler.path_prefix_filter("file_path", root), {"file_path": {"$gt": root}}]},
+                 [("file_path", ASCENDING)]),
+        HotQuery("processed_files_below_root", files,
+                 {"status": config.STATUS_PROCESSED, **db_handler.path_prefix_filter("file_path", root)}, []),
+        HotQuery("files_by_directory", files, {"directory": root}, []),
+        HotQuery("output_records", files, {"output_path": {"$exists": True}}, []),
+        HotQuery("directory_snapshots_below_root", f"{config.COLLECTION_NAME}_dirs",
+                 db_handler.path_prefix_filter("path", root), []),
+        HotQuery("unreferenced_blobs", f"{config.COLLECTION_NAME}_blobs", {"refs": {"$lte": 0}}, []),
+        HotQuery("ocr_cache_lru", f"{config.COLLECTION_NAME}_ocr_cache", {}, [("last_access", ASCENDING)]),
+        HotQuery("scan_history", config.RESULTS_COLLECTION, {}, [("_id", DESCENDING)]),
+        HotQuery("scan_by_timestamp", config.RESULTS_COLLECTION, {"timestamp": "20000101_000000"},
+                 [("_id", DESCENDING)]),
+        HotQuery("scan_entries_by_section", f"{config.RESULTS_COLLECTION}_entries",
+                 {"scan_id": ObjectId(), "section": "processed_files"}, [("_id", ASCENDING)]),
+    ]
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create missing indexes; existing ones with the same definition are left alone"""
+    for collection, models in index_models().items():
+        await db[collection].create_indexes(models)
+
+
+async def migrate(db: AsyncIOMotorDatabase) -> int:
+    """Apply the migrations newer than the stored schema version and return the version reached"""
+    schema = db[f"{config.COLLECTION_NAME}_schema"]
+    state = await schema.find_one({"_id": SCHEMA_DOCUMENT_ID}) or {}
+    version = state.get("version", 0)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        logger.info(f"Applying schema migration {migration.version}: {migration.name}")
+        await migration.apply(db)
+        version = migration.version
+        await schema.update_one(
+            {"_id": SCHEMA_DOCUMENT_ID},
+            {"$set": {"version": version},
+             "$push": {"applied": {"version": version, "name": migration.name, "applied_at": datetime.utcnow()}}},
+            upsert=True
+        )
+    return version
+
+
+async def bootstrap(db: AsyncIOMotorDatabase) -> None:
+    """Bring the database to SCHEMA_VERSION and create the indexes. Safe to run on every startup.
+
+    Migrations run first, so the unique file_path index is only built once
+    duplicate records are gone.
+    """
+    version = await migrate(db)
+    await ensure_indexes(db)
+    logger.info(f"Database schema at version {version}, indexes ensured")
+
+
+def _plan_stages(plan) -> List[str]:
+    """Every stage name in an explain() plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+async def explain_hot_queries(db: AsyncIOMotorDatabase) -> List[dict]:
+    """Run explain() on every hot query and report the stages of its winning plan"""
+    results = []
+    for query in hot_queries():
+        cursor = db[query.collection].find(query.filter)
+        if query.sort:
+            cursor = cursor.sort(query.sort)
+        explanation = await cursor.explain()
+        stages = _plan_stages(explanation["queryPlanner"]["winningPlan"])
+        results.append({
+            "query": query.name,
+            "collection": query.collection,
+            "stages": stages,
+            "index_scan": "COLLSCAN" not in stages and any(stage in INDEX_STAGES for stage in stages)
+        })
+    return results
+
+
+def verify_query_plans(results: List[dict]) -> List[dict]:
+    """Raise QueryPlanError unless every explained hot query is an index scan"""
+    failing = [result["query"] for result in results if not result["index_scan"]]
+    if failing:
+        raise QueryPlanError(f"Queries not using an index: {', '.join(failing)}")
+    return results
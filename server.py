@@ -1,29 +1,34 @@
 import os
 import time
-import json
 import psutil
 import config
 import uvicorn
 import logging
 import db_handler
+import schema
+import metrics
+import bson_json
 
 
-from bson import json_util
+from bson import ObjectId
+from typing import Literal, Optional
 from datetime import datetime
 from pydantic import BaseModel
 from db_handler import db_handler
-from utils import clean_output_folders
+from watcher import watch_service
+from ocr_scheduler import ocr_scheduler
+from post_processing import post_processor
 from contextlib import asynccontextmanager
-from files_processing import process_directory
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from scan_jobs import scan_jobs, ScanAlreadyRunning
+from work_units import work_unit_worker
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from files_processing import process_pdf_file, process_other_file
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-app_state = {"is_scan_running": False}
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifecycle event handler for FastAPI application"""
@@ -33,11 +38,29 @@ async def lifespan(app: FastAPI):
         logger.info("Testing database connection...")
         connection_test = await db_handler.test_connection()
         logger.info(f"Database connection test result: {connection_test}")
+        if config.SCHEMA_BOOTSTRAP:
+            await db_handler.bootstrap()
+        if config.VERIFY_QUERY_PLANS:
+            schema.verify_query_plans(await db_handler.explain_hot_queries())
+        if config.SCAN_PARTITION_DEPTH > 0:
+            work_unit_worker.start()
+        if config.SCAN_RESUME_ON_START:
+            await scan_jobs.resume_interrupted()
+        if config.WATCH_ENABLED:
+            try:
+                await watch_service.start(config.SOURCE_DATA_LAKE_DIR)
+            except OSError as e:
+                logger.error(f"Could not start watching {config.SOURCE_DATA_LAKE_DIR}: {e}")
         yield
     except Exception as e:
         logger.error(f"Failed to initialize database connection: {e}")
         raise RuntimeError("Database connection failed")
     finally:
+        await scan_jobs.stop()
+        await work_unit_worker.stop()
+        await watch_service.stop()
+        await ocr_scheduler.close()
+        await post_processor.close()
         logger.info("Closing database connection...")
         await db_handler.close()
 
@@ -46,10 +69,11 @@ app = FastAPI(title="File Tracker API", lifespan=lifespan)
 
 class ScanRequest(BaseModel):
     directory: str | None = None
+    deep_verify: bool = False # List every directory and rebuild the directory snapshots
 
 @app.post("/scan", status_code=202)
-async def trigger_scan(scan_request: ScanRequest, background_tasks: BackgroundTasks):
-    if app_state["is_scan_running"]:
+async def trigger_scan(scan_request: ScanRequest):
+    if scan_jobs.running:
         raise HTTPException(status_code=409, detail="A scan is already in progress.")
 
     try:
@@ -57,84 +81,142 @@ async def trigger_scan(scan_request: ScanRequest, background_tasks: BackgroundTa
     except Exception as e:
         logger.error(f"Database connection check failed: {e}")
         raise HTTPException(status_code=503, detail="Database connection not available")
-        
-    async def run_scan_and_update_state():
-        try:
-            app_state["is_scan_running"] = True
-            logger.info("Starting background file scan...")
-            
-            input_dir = scan_request.directory or config.SOURCE_DATA_LAKE_DIR
-            if not os.path.exists(input_dir):
-                logger.info(f"Directory not found: {input_dir}")
-                logger.info("Scan process : ", os.getcwd())
-                raise Exception(f"Directory not found: {input_dir}")
-
-            # Clean output directory 
-            clean_output_folders(config.OUTPUT_DIR)
-
-            # Process directory and generate report
-            report = await process_directory(input_dir)
-            
-            # Save report to database instead of file
-            await db_handler.save_scan_results(report)
-            
-            logger.info("Scan completed. Results saved to database.")
-            
-        except Exception as e:
-            logger.error(f"Error during background scan: {e}", exc_info=True)
-        finally:
-            app_state["is_scan_running"] = False
-
-    background_tasks.add_task(run_scan_and_update_state)
-    return {"message": "File scan process initiated in the background."}
+
+    input_dir = scan_request.directory or config.SOURCE_DATA_LAKE_DIR
+    try:
+        logger.info("Starting background file scan...")
+        report = await scan_jobs.start(input_dir, deep_verify=scan_request.deep_verify)
+    except ScanAlreadyRunning:
+        raise HTTPException(status_code=409, detail="A scan is already in progress.")
+    except FileNotFoundError as e:
+        logger.info(str(e))
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"message": "File scan process initiated in the background.", "scan_id": str(report.scan_id)}
+
+
+@app.get("/scans/{scan_id}")
+async def get_scan_progress(scan_id: str):
+    """Live progress of a scan run by this process, else its saved header (counts and last checkpoint)"""
+    report = scan_jobs.find(scan_id)
+    if report is not None:
+        return _json_response(report.progress())
+    if not ObjectId.is_valid(scan_id):
+        raise HTTPException(status_code=400, detail="scan_id must be a scan's _id")
+    return await _scan_response(scan_id, "summary", None)
+
+
+@app.post("/scans/{scan_id}/cancel", status_code=202)
+async def cancel_scan(scan_id: str):
+    """Stop a running scan after the files in flight; it is saved as cancelled"""
+    if not ObjectId.is_valid(scan_id):
+        raise HTTPException(status_code=400, detail="scan_id must be a scan's _id")
+    if not await scan_jobs.cancel(scan_id):
+        raise HTTPException(status_code=409, detail="Scan is not running.")
+    return {"message": "Scan cancellation requested.", "scan_id": scan_id}
+
+
+def _json_response(document) -> Response:
+    return Response(content=bson_json.dumps(document), media_type="application/json")
+
+
+def _ndjson_response(documents, first=None) -> StreamingResponse:
+    return StreamingResponse(bson_json.iter_ndjson(documents, first), media_type=bson_json.NDJSON_MEDIA_TYPE)
+
+
+def _page_size(limit: Optional[int]) -> int:
+    return max(1, min(limit or config.SCAN_HISTORY_PAGE_SIZE, config.SCAN_HISTORY_MAX_PAGE_SIZE))
+
+
+async def _scan_response(scan: Optional[str], fields: str, section: Optional[str]):
+    """A scan's header, or with fields=full the header followed by its report entries as NDJSON"""
+    try:
+        header = await db_handler.find_scan_header(scan, full=fields == "full")
+    except Exception as e:
+        logger.error(f"Error retrieving scan results: {e}")
+        raise HTTPException(status_code=500, detail="Error retrieving scan results")
+    if not header:
+        raise HTTPException(status_code=404, detail="Scan results not found")
+    if fields != "full":
+        return _json_response(header)
+    return _ndjson_response(db_handler.iter_scan_entries(header["_id"], section), first=header)
 
 
 @app.get("/scan-history")
-@app.get("/scan-history/{timestamp}")
-async def get_scan_results(timestamp: str = None):
+async def get_scan_history(after: Optional[str] = None, limit: Optional[int] = None,
+                           fields: Literal["summary", "full"] = "summary",
+                           format: Literal["json", "ndjson"] = "json"):
+    """Scan headers, newest first, one page at a time.
+
+    Pass ``next_after`` from a page as ``after`` to get the next one. With
+    fields=full, documents from before report streaming include their results.
+    """
+    page_size = _page_size(limit)
     try:
-        collection = db_handler._db[config.RESULTS_COLLECTION]
-        if timestamp:
-            result = await collection.find_one({"timestamp": timestamp})
-            if not result:
-                raise HTTPException(status_code=404, detail="Scan results not found")
-            return json.loads(json_util.dumps(result))
-        else:
-            # Return all scan results, sorted by timestamp descending
-            cursor = collection.find().sort("timestamp", -1)
-            results = await cursor.to_list(length=None)
-            return json.loads(json_util.dumps(results))
+        cursor = db_handler.iter_scan_headers(after, page_size, full=fields == "full")
+        if format == "ndjson":
+            return _ndjson_response(cursor)
+        scans = await cursor.to_list(length=page_size)
     except Exception as e:
         logger.error(f"Error retrieving scan results: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving scan results")
+    next_after = str(scans[-1]["_id"]) if len(scans) == page_size else None
+    return _json_response({"scans": scans, "next_after": next_after})
+
+
+@app.get("/scan-history/{scan}")
+async def get_scan_results(scan: str, fields: Literal["summary", "full"] = "summary", section: Optional[str] = None):
+    """One scan by id or timestamp"""
+    return await _scan_response(scan, fields, section)
+
+
+@app.get("/scan-history/{scan}/entries")
+async def get_scan_entries(scan: str, section: Optional[str] = None, after: Optional[str] = None,
+                           limit: Optional[int] = None, format: Literal["json", "ndjson"] = "json"):
+    """A scan's report entries in the order they were recorded, one page at a time"""
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail="after must be the _id of a report entry")
+    page_size = _page_size(limit)
+    try:
+        header = await db_handler.find_scan_header(scan)
+        if not header:
+            raise HTTPException(status_code=404, detail="Scan results not found")
+        cursor = db_handler.iter_scan_entries(
+            header["_id"], section, ObjectId(after) if after is not None else None, page_size
+        )
+        if format == "ndjson":
+            return _ndjson_response(cursor)
+        entries = await cursor.to_list(length=page_size)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error retrieving scan entries: {e}")
+        raise HTTPException(status_code=500, detail="Error retrieving scan entries")
+    next_after = str(entries[-1]["_id"]) if len(entries) == page_size else None
+    return _json_response({"entries": entries, "next_after": next_after})
 
 
 @app.get("/last-scan")
-async def get_last_scan():
+async def get_last_scan(fields: Literal["summary", "full"] = "summary", section: Optional[str] = None):
     """Return details of the most recent scan"""
+    return await _scan_response(None, fields, section)
+
+
+@app.get("/admin/query-plans")
+async def get_query_plans():
+    """explain() every hot query; 500 unless all of them are index scans"""
     try:
-        collection = db_handler._db[config.RESULTS_COLLECTION]
-        # Get the most recent document by sorting on timestamp in descending order
-        last_scan = await collection.find_one(
-            filter={},
-            sort=[("timestamp", -1)]
-        )
-        
-        if not last_scan:
-            raise HTTPException(
-                status_code=404,
-                detail="No scan results found in database"
-            )
-        
-        json_compatible_scan = json.loads(json_util.dumps(last_scan))
-        return json_compatible_scan
-        
+        results = await db_handler.explain_hot_queries()
     except Exception as e:
-        logger.error(f"Error retrieving last scan results: {e}")
-        raise HTTPException(
-            status_code=500,
-            detail="Error retrieving last scan results"
-        )
+        logger.error(f"Error explaining queries: {e}")
+        raise HTTPException(status_code=500, detail="Error explaining queries")
+    ok = all(result["index_scan"] for result in results)
+    return JSONResponse({"ok": ok, "queries": results}, status_code=200 if ok else 500)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Scan, stage and database metrics in the Prometheus text format"""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("/health")
@@ -142,7 +224,8 @@ async def health_check():
     return {
             "status": "running",
             "version": "1.0.0",
-            "is_scan_running": app_state["is_scan_running"]
+            "is_scan_running": scan_jobs.running,
+            "is_watching": watch_service.running
         }
         
 if __name__ == "__main__":
@@ -0,0 +1,808 @@
+import os
+import config
+import sqlite3
+import asyncio
+import logging
+
+from datetime import datetime, timedelta
+from bson import ObjectId, json_util
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from db_handler import WriteBatcher
+from storage import UNIT_CLAIMED, UNIT_PENDING, DirectorySnapshot, FileRecord, StorageBackend, add_to_index
+
+logger = logging.getLogger(__name__)
+
+# Work unit fields kept in their own columns, for claiming; everything else goes to "document"
+UNIT_COLUMNS = ("scan_id", "status", "owner", "lease_expires_at", "attempts")
+
+# Record fields kept in their own columns; everything else goes to the JSON "extra" column
+FILE_COLUMNS = (
+    "file_path", "directory", "status", "output_path", "size", "modified", "mtime_ns", "inode", "hash",
+    "blob_digest"
+)
+FILE_INDEX_COLUMNS = "file_path, size, modified, status, hash, mtime_ns, inode, output_path"
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_path TEXT PRIMARY KEY,
+    directory TEXT,
+    status TEXT,
+    output_path TEXT,
+    size INTEGER,
+    modified REAL,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    hash TEXT,
+    blob_digest TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (status, file_path);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_output_path ON files (output_path) WHERE output_path IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    file_count INTEGER,
+    subdirectories TEXT,
+    files_digest TEXT,
+    digest TEXT,
+    complete INTEGER,
+    scanned_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    refs INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS blobs_refs ON blobs (refs);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    file_path TEXT PRIMARY KEY,
+    digest TEXT,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ocr_cache (
+    digest TEXT PRIMARY KEY,
+    size INTEGER,
+    last_access TEXT,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ocr_cache_last_access ON ocr_cache (last_access);
+
+CREATE TABLE IF NOT EXISTS scans (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scans_timestamp ON scans (timestamp);
+CREATE TABLE IF NOT EXISTS scan_entries (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    scan_id TEXT NOT NULL,
+    section TEXT,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scan_entries_scan ON scan_entries (scan_id, seq);
+CREATE INDEX IF NOT EXISTS scan_entries_section ON scan_entries (scan_id, section, seq);
+
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS work_units (
+    id TEXT PRIMARY KEY,
+    scan_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_expires_at TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS work_units_claim ON work_units (status, lease_expires_at);
+CREATE INDEX IF NOT EXISTS work_units_scan ON work_units (scan_id);
+"""
+
+
+def _dumps(document) -> str:
+    return json_util.dumps(document)
+
+
+def _loads(text: str):
+    return json_util.loads(text)
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def prefix_clause(column: str, root: str) -> Tuple[str, list]:
+    """SQL matching root itself and every path below it, as one range an index on column can serve"""
+    root = root.rstrip(os.sep)
+    # The separator's successor bounds the range of paths starting with root + separator
+    upper = root + chr(ord(os.sep) + 1)
+    if not root:
+        return f"({column} >= ? AND {column} < ?)", [os.sep, upper]
+    # Siblings sorting between root and root + separator ("/a-b" for "/a") are in the range but filtered out
+    return f"({column} >= ? AND {column} < ? AND ({column} = ? OR {column} >= ?))", [root, upper, root, root + os.sep]
+
+
+def _split_record(file_data: dict) -> Tuple[dict, dict]:
+    """(column values, extra fields) of a file record"""
+    columns = {key: value for key, value in file_data.items() if key in FILE_COLUMNS}
+    extra = {key: value for key, value in file_data.items() if key not in FILE_COLUMNS and key != "_id"}
+    return columns, extra
+
+
+def _unit_document(row: sqlite3.Row) -> dict:
+    document = _loads(row["document"])
+    document.update({column: row[column] for column in UNIT_COLUMNS})
+    document["_id"] = ObjectId(row["id"])
+    document["scan_id"] = ObjectId(row["scan_id"])
+    document["lease_expires_at"] = datetime.fromisoformat(row["lease_expires_at"])
+    return document
+
+
+def _file_document(row: sqlite3.Row) -> dict:
+    document = {key: row[key] for key in FILE_COLUMNS if row[key] is not None}
+    document.update(_loads(row["extra"]))
+    return document
+
+
+class SQLiteCursor:
+    """Rows of one query fetched in batches on the database thread, usable like a Motor cursor"""
+
+    def __init__(self, handler: "SQLiteDatabaseHandler", sql: str, params: list, convert: Callable):
+        self._handler = handler
+        self._sql = sql
+        self._params = params
+        self._convert = convert
+
+    async def __aiter__(self):
+        cursor = await self._handler._run(lambda connection: connection.execute(self._sql, self._params))
+        try:
+            while True:
+                rows = await self._handler._run(lambda _: cursor.fetchmany(config.INDEX_LOAD_BATCH_SIZE))
+                if not rows:
+                    return
+                for row in rows:
+                    yield self._convert(row)
+        finally:
+            # An abandoned iteration may only be finalized after the database was closed
+            if self._handler._connection is not None:
+                await self._handler._run(lambda _: cursor.close())
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        documents = []
+        rows = self.__aiter__()
+        try:
+            async for document in rows:
+                documents.append(document)
+                if length is not None and len(documents) >= length:
+                    break
+        finally:
+            await rows.aclose()
+        return documents
+
+
+class SQLiteWriteBatcher(WriteBatcher):
+    """WriteBatcher that applies each batch to SQLite in a single transaction"""
+
+    async def insert(self, file_data: dict) -> None:
+        await self.upsert(file_data)
+
+    async def upsert(self, file_data: dict) -> None:
+        file_data["processed_time"] = datetime.utcnow()
+        await self._add(("upsert", file_data), file_data["file_path"])
+
+    async def update_status(self, file_path: str, status: str, metadata: dict = None) -> None:
+        update_data = {
+            "status": status,
+            "last_updated": datetime.utcnow()
+        }
+        if metadata:
+            update_data.update(metadata)
+        await self._add(("update", file_path, update_data), file_path)
+
+    async def update_metadata(self, file_path: str, metadata: dict) -> None:
+        await self._add(("update", file_path, metadata), file_path)
+
+    async def _write(self, operations: list, paths: List[str]) -> None:
+        handler = self._collection
+        try:
+            await handler._run(handler._apply_file_writes, operations)
+            logger.info(f"Flushed {len(operations)} file writes")
+            return
+        except sqlite3.Error as e:
+            logger.error(f"Batch of {len(operations)} file writes failed ({e}), retrying one by one")
+
+        # Like an unordered bulk_write: apply what can be applied and report the rest
+        for operation, path in zip(operations, paths):
+            try:
+                await handler._run(handler._apply_file_writes, [operation])
+            except sqlite3.Error as e:
+                self.errors.append({
+                    "path": path,
+                    "error": f"Database write failed: {str(e)}"
+                })
+
+
+class SQLiteDatabaseHandler(StorageBackend):
+    """StorageBackend on an embedded SQLite database, for single-node collectors and tests.
+
+    One connection in WAL mode is used from a single worker thread, so every
+    statement runs off the event loop and writes never contend with each
+    other. Batched writes run in one transaction per batch.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config.SQLITE_PATH
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def _run(self, function: Callable, *args):
+        """Run function(connection, *args) on the database thread"""
+        if self._connection is None:
+            raise RuntimeError("Database not initialized. Call initialize() first.")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, self._connection, *args)
+
+    @staticmethod
+    def _transaction(connection: sqlite3.Connection, function: Callable, *args):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(connection, *args)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    async def _run_in_transaction(self, function: Callable, *args):
+        return await self._run(self._transaction, function, *args)
+
+    async def initialize(self) -> None:
+        """Open the database file and create the tables and indexes"""
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+            self._connection = await asyncio.get_running_loop().run_in_executor(self._executor, self._connect)
+            logger.info(f"Successfully opened SQLite database {self.path}")
+        except Exception as e:
+            logger.error(f"Failed to initialize SQLite: {e}")
+            raise
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        connection.executescript(SCHEMA)
+        connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        return connection
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._run(lambda connection: connection.close())
+            self._connection = None
+            self._executor.shutdown()
+            logger.info("SQLite database closed")
+
+    async def test_connection(self) -> bool:
+        try:
+            await self._run(lambda connection: connection.execute("SELECT 1").fetchone())
+            return True
+        except Exception as e:
+            logger.error(f"Database ping failed: {e}")
+            return False
+
+    async def bootstrap(self) -> None:
+        """Tables and indexes are created by initialize(); the file has no duplicate paths to migrate"""
+        logger.info(f"SQLite schema at version {SCHEMA_VERSION}")
+
+    def _hot_queries(self) -> List[Tuple[str, str, str, list]]:
+        root = config.SOURCE_DATA_LAKE_DIR or os.sep
+        below, below_params = prefix_clause("file_path", root)
+        dirs_below, dirs_params = prefix_clause("path", root)
+        return [
+            ("file_by_path", "files", "SELECT * FROM files WHERE file_path = ?", [root]),
+            ("files_by_status", "files", "SELECT * FROM files WHERE status = ?", [config.STATUS_PROCESSED]),
+            ("files_below_root", "files", f"SELECT {FILE_INDEX_COLUMNS} FROM files WHERE {below}", below_params),
+            ("files_below_root_sorted", "files",
+             f"SELECT {FILE_INDEX_COLUMNS} FROM files WHERE {below} AND file_path > ? ORDER BY file_path LIMIT ?",
+             [*below_params, root, config.INDEX_LOAD_BATCH_SIZE]),
+            ("processed_files_below_root", "files",
+             f"SELECT file_path FROM files WHERE status = ? AND {below}", [config.STATUS_PROCESSED, *below_params]),
+            ("files_by_directory", "files", "SELECT * FROM files WHERE directory = ?", [root]),
+            ("output_records", "files", "SELECT * FROM files WHERE output_path IS NOT NULL", []),
+            ("directory_snapshots_below_root", "dirs", f"SELECT * FROM dirs WHERE {dirs_below}", dirs_params),
+            ("unreferenced_blobs", "blobs", "SELECT * FROM blobs WHERE refs <= 0", []),
+            ("ocr_cache_lru", "ocr_cache", "SELECT digest FROM ocr_cache ORDER BY last_access", []),
+            ("scan_history", "scans", "SELECT document FROM scans ORDER BY id DESC", []),
+            ("scan_by_timestamp", "scans",
+             "SELECT document FROM scans WHERE timestamp = ? ORDER BY id DESC", ["20000101_000000"]),
+            ("scan_entries_by_section", "scan_entries",
+             "SELECT document FROM scan_entries WHERE scan_id = ? AND section = ? ORDER BY seq",
+             [str(ObjectId()), "processed_files"]),
+        ]
+
+    async def explain_hot_queries(self) -> List[dict]:
+        """EXPLAIN QUERY PLAN every hot query; a bare "SCAN <table>" is a full table scan"""
+        def explain(connection):
+            results = []
+            for name, table, sql, params in self._hot_queries():
+                stages = [row["detail"] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+                table_scan = any(
+                    stage.startswith(f"SCAN {table}") and "USING" not in stage for stage in stages
+                )
+                results.append({"query": name, "collection": table, "stages": stages, "index_scan": not table_scan})
+            return results
+        return await self._run(explain)
+
+    # Scan reports
+
+    async def create_scan_header(self, header: dict) -> None:
+        await self._run(
+            lambda connection: connection.execute(
+                "INSERT INTO scans (id, timestamp, document) VALUES (?, ?, ?)",
+                [str(header["_id"]), header.get("timestamp"), _dumps(header)]
+            )
+        )
+
+    async def update_scan_header(self, scan_id, fields: dict) -> None:
+        def update(connection):
+            row = connection.execute("SELECT document FROM scans WHERE id = ?", [str(scan_id)]).fetchone()
+            if row is None:
+                return
+            document = _loads(row["document"])
+            document.update(fields)
+            connection.execute("UPDATE scans SET document = ? WHERE id = ?", [_dumps(document), str(scan_id)])
+        await self._run_in_transaction(update)
+
+    async def insert_scan_entries(self, entries: List[dict]) -> None:
+        rows = []
+        for entry in entries:
+            entry.setdefault("_id", ObjectId())
+            rows.append((str(entry["_id"]), str(entry["scan_id"]), entry.get("section"), _dumps(entry)))
+        await self._run_in_transaction(
+            lambda connection: connection.executemany(
+                "INSERT INTO scan_entries (id, scan_id, section, document) VALUES (?, ?, ?, ?)", rows
+            )
+        )
+
+    def iter_scan_entries(self, scan_id, section: Optional[str] = None, after: Optional[ObjectId] = None,
+                          limit: int = 0) -> SQLiteCursor:
+        """A scan's report entries in insertion order; ``after`` is the _id of the last entry of the previous page"""
+        sql = "SELECT document FROM scan_entries WHERE scan_id = ?"
+        params = [str(scan_id)]
+        if section is not None:
+            sql += " AND section = ?"
+            params.append(section)
+        if after is not None:
+            sql += " AND seq > (SELECT seq FROM scan_entries WHERE id = ?)"
+            params.append(str(after))
+        sql += " ORDER BY seq"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        def convert(row):
+            document = _loads(row["document"])
+            document.pop("scan_id", None)
+            return document
+        return SQLiteCursor(self, sql, params, convert)
+
+    def iter_scan_headers(self, after: Optional[str] = None, limit: int = 0, full: bool = False) -> SQLiteCursor:
+        """Scan headers, newest first; ``after`` is the id or timestamp of the last scan of the previous page"""
+        sql = "SELECT document FROM scans"
+        params = []
+        if after is not None:
+            sql += " WHERE id < ?" if ObjectId.is_valid(after) else " WHERE timestamp < ?"
+            params.append(after)
+        sql += " ORDER BY id DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return SQLiteCursor(self, sql, params, lambda row: self._scan_header(row, full))
+
+    @staticmethod
+    def _scan_header(row: sqlite3.Row, full: bool) -> dict:
+        document = _loads(row["document"])
+        if not full:
+            document.pop("results", None)
+        return document
+
+    async def find_scan_header(self, scan: Optional[str] = None, full: bool = False) -> Optional[dict]:
+        sql = "SELECT document FROM scans"
+        params = []
+        if scan is not None:
+            sql += " WHERE id = ?" if ObjectId.is_valid(scan) else " WHERE timestamp = ?"
+            params.append(scan)
+        sql += " ORDER BY id DESC LIMIT 1"
+        row = await self._run(lambda connection: connection.execute(sql, params).fetchone())
+        return self._scan_header(row, full) if row is not None else None
+
+    async def find_scans_with_status(self, status: str) -> List[dict]:
+        def find(connection):
+            rows = connection.execute(
+                "SELECT document FROM scans WHERE json_extract(document, '$.status') = ? ORDER BY id", [status]
+            ).fetchall()
+            return [self._scan_header(row, False) for row in rows]
+        return await self._run(find)
+
+    async def delete_scan_entries(self, scan_id, after_seq: int, entry_ids: Iterable = ()) -> None:
+        """The entry's seq is the one in its document, not the table's insertion order"""
+        ids = [str(entry_id) for entry_id in entry_ids]
+
+        def delete(connection):
+            connection.execute(
+                "DELETE FROM scan_entries WHERE scan_id = ? AND json_extract(document, '$.seq') > ?",
+                [str(scan_id), after_seq]
+            )
+            connection.executemany("DELETE FROM scan_entries WHERE id = ?", [(entry_id,) for entry_id in ids])
+        await self._run_in_transaction(delete)
+
+    async def delete_unit_entries(self, scan_id, unit_id) -> None:
+        await self._run_in_transaction(
+            lambda connection: connection.execute(
+                "DELETE FROM scan_entries WHERE scan_id = ? AND json_extract(document, '$.unit.\"$oid\"') = ?",
+                [str(scan_id), str(unit_id)]
+            )
+        )
+
+    # Scan coordination
+
+    async def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        now = datetime.utcnow()
+        expires_at = (now + timedelta(seconds=seconds)).isoformat()
+        cursor = await self._run_in_transaction(
+            lambda connection: connection.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                [name, owner, expires_at, now.isoformat()]
+            )
+        )
+        return cursor.rowcount == 1
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        await self._run_in_transaction(
+            lambda connection: connection.execute("DELETE FROM leases WHERE name = ? AND owner = ?", [name, owner])
+        )
+
+    async def insert_work_units(self, units: List[dict]) -> None:
+        rows = []
+        for unit in units:
+            unit.setdefault("_id", ObjectId())
+            document = {key: value for key, value in unit.items() if key not in UNIT_COLUMNS and key != "_id"}
+            rows.append((
+                str(unit["_id"]), str(unit["scan_id"]), unit["status"], unit.get("owner"),
+                unit["lease_expires_at"].isoformat(), unit.get("attempts", 0), _dumps(document)
+            ))
+        await self._run_in_transaction(
+            lambda connection: connection.executemany(
+                "INSERT INTO work_units (id, scan_id, status, owner, lease_expires_at, attempts, document) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        )
+
+    async def claim_work_unit(self, owner: str, seconds: float, max_attempts: int) -> Optional[dict]:
+        def claim(connection):
+            now = datetime.utcnow()
+            row = connection.execute(
+                "SELECT id FROM work_units WHERE status IN (?, ?) AND lease_expires_at < ? AND attempts < ? "
+                "ORDER BY id LIMIT 1",
+                [UNIT_PENDING, UNIT_CLAIMED, now.isoformat(), max_attempts]
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE work_units SET status = ?, owner = ?, lease_expires_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                [UNIT_CLAIMED, owner, (now + timedelta(seconds=seconds)).isoformat(), row["id"]]
+            )
+            return _unit_document(connection.execute("SELECT * FROM work_units WHERE id = ?", [row["id"]]).fetchone())
+        return await self._run_in_transaction(claim)
+
+    async def update_work_unit(self, unit_id, owner: Optional[str], fields: dict) -> bool:
+        def update(connection):
+            row = connection.execute(
+                "SELECT * FROM work_units WHERE id = ? AND owner IS ?", [str(unit_id), owner]
+            ).fetchone()
+            if row is None:
+                return False
+            unit = _unit_document(row)
+            unit.update(fields)
+            document = {key: value for key, value in unit.items() if key not in UNIT_COLUMNS and key != "_id"}
+            connection.execute(
+                "UPDATE work_units SET status = ?, owner = ?, lease_expires_at = ?, attempts = ?, document = ? "
+                "WHERE id = ?",
+                [unit["status"], unit["owner"], unit["lease_expires_at"].isoformat(), unit["attempts"],
+                 _dumps(document), str(unit_id)]
+            )
+            return True
+        return await self._run_in_transaction(update)
+
+    async def find_work_units(self, scan_id) -> List[dict]:
+        def find(connection):
+            rows = connection.execute("SELECT * FROM work_units WHERE scan_id = ? ORDER BY id", [str(scan_id)])
+            units = [_unit_document(row) for row in rows]
+            for unit in units:
+                unit.pop("missing_outputs", None)
+            return units
+        return await self._run(find)
+
+    async def delete_work_units(self, scan_id) -> None:
+        await self._run_in_transaction(
+            lambda connection: connection.execute("DELETE FROM work_units WHERE scan_id = ?", [str(scan_id)])
+        )
+
+    # File records
+
+    @staticmethod
+    def _apply_file_writes(connection: sqlite3.Connection, operations: list) -> None:
+        """Apply queued ("upsert", record) and ("update", path, fields) operations in one transaction"""
+        def apply(connection):
+            for operation in operations:
+                if operation[0] == "upsert":
+                    SQLiteDatabaseHandler._upsert_file(connection, operation[1])
+                else:
+                    SQLiteDatabaseHandler._update_file(connection, operation[1], operation[2])
+        SQLiteDatabaseHandler._transaction(connection, apply)
+
+    @staticmethod
+    def _upsert_file(connection: sqlite3.Connection, file_data: dict) -> None:
+        """Insert a record, or set the given fields of the record with the same path (like $set with upsert)"""
+        columns, extra = _split_record(file_data)
+        names = list(columns)
+        assignments = [f"{name} = excluded.{name}" for name in names if name != "file_path"]
+        assignments.append("extra = json_patch(files.extra, excluded.extra)")
+        connection.execute(
+            f"INSERT INTO files ({', '.join(names)}, extra) VALUES ({', '.join('?' * (len(names) + 1))}) "
+            f"ON CONFLICT (file_path) DO UPDATE SET {', '.join(assignments)}",
+            [columns[name] for name in names] + [_dumps(extra)]
+        )
+
+    @staticmethod
+    def _update_file(connection: sqlite3.Connection, file_path: str, fields: dict) -> None:
+        columns, extra = _split_record(fields)
+        columns.pop("file_path", None)
+        assignments = [f"{name} = ?" for name in columns]
+        params = list(columns.values())
+        if extra:
+            assignments.append("extra = json_patch(extra, ?)")
+            params.append(_dumps(extra))
+        connection.execute(f"UPDATE files SET {', '.join(assignments)} WHERE file_path = ?", params + [file_path])
+
+    async def get_processed_file(self, file_path: str) -> Optional[dict]:
+        row = await self._run(
+            lambda connection: connection.execute("SELECT * FROM files WHERE file_path = ?", [file_path]).fetchone()
+        )
+        return _file_document(row) if row is not None else None
+
+    async def get_all_processed_files(self) -> List[dict]:
+        return await SQLiteCursor(
+            self, "SELECT * FROM files WHERE status = ?", [config.STATUS_PROCESSED], _file_document
+        ).to_list()
+
+    async def load_file_index(self, root: Optional[str] = None, recursive: bool = True) -> Dict[str, FileRecord]:
+        """Load the state of every tracked file (below root, if given)"""
+        index: Dict[str, FileRecord] = {}
+        sql = f"SELECT {FILE_INDEX_COLUMNS} FROM files"
+        params = []
+        if root is not None and not recursive:
+            sql += " WHERE directory = ?"
+            params = [root.rstrip(os.sep)]
+        elif root is not None:
+            clause, params = prefix_clause("file_path", root)
+            sql += f" WHERE {clause}"
+        async for doc in SQLiteCursor(self, sql, params, dict):
+            add_to_index(index, doc)
+        logger.info(f"Loaded file index with {len(index)} records")
+        return index
+
+    async def get_files_by_paths(self, file_paths: Iterable[str]) -> Dict[str, FileRecord]:
+        index: Dict[str, FileRecord] = {}
+        paths = list(file_paths)
+        for start in range(0, len(paths), config.PATH_LOOKUP_CHUNK_SIZE):
+            chunk = paths[start:start + config.PATH_LOOKUP_CHUNK_SIZE]
+            sql = f"SELECT {FILE_INDEX_COLUMNS} FROM files WHERE file_path IN ({', '.join('?' * len(chunk))})"
+            async for doc in SQLiteCursor(self, sql, chunk, dict):
+                add_to_index(index, doc)
+        return index
+
+    def iter_file_index(self, root: str, after: Optional[str] = None, limit: int = 0) -> SQLiteCursor:
+        """Cursor over the index fields of the tracked files below root, sorted by file_path"""
+        clause, params = prefix_clause("file_path", root)
+        if after is not None:
+            clause += " AND file_path > ?"
+            params.append(after)
+        sql = f"SELECT {FILE_INDEX_COLUMNS} FROM files WHERE {clause} ORDER BY file_path"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return SQLiteCursor(self, sql, params, dict)
+
+    def iter_output_records(self) -> SQLiteCursor:
+        return SQLiteCursor(
+            self,
+            "SELECT file_path, output_path, status, size, mtime_ns, blob_digest, "
+            "json_extract(extra, '$.output_size') AS output_size FROM files "
+            "WHERE output_path IS NOT NULL",
+            [],
+            lambda row: {key: row[key] for key in row.keys() if row[key] is not None}
+        )
+
+    async def get_processed_file_paths(self, root: Optional[str] = None) -> set:
+        sql = "SELECT file_path FROM files WHERE status = ?"
+        params = [config.STATUS_PROCESSED]
+        if root is not None:
+            clause, clause_params = prefix_clause("file_path", root)
+            sql += f" AND {clause}"
+            params += clause_params
+        return {path async for path in SQLiteCursor(self, sql, params, lambda row: row["file_path"])}
+
+    async def insert_processed_file(self, file_data: dict):
+        """Insert a processed file record, or update the record with the same path"""
+        file_data["processed_time"] = datetime.utcnow()
+        await self._run(self._apply_file_writes, [("upsert", file_data)])
+        logger.info(f"Successfully saved document for {file_data['file_path']}")
+
+    async def update_file_status(self, file_path: str, status: str, metadata: dict = None):
+        update_data = {
+            "status": status,
+            "last_updated": datetime.utcnow()
+        }
+        if metadata:
+            update_data.update(metadata)
+        await self._run(self._apply_file_writes, [("update", file_path, update_data)])
+
+    def write_batcher(self) -> SQLiteWriteBatcher:
+        return SQLiteWriteBatcher(self, config.BULK_WRITE_BATCH_SIZE, config.BULK_WRITE_FLUSH_INTERVAL)
+
+    async def delete_file_record(self, file_path: str):
+        await self._run(lambda connection: connection.execute("DELETE FROM files WHERE file_path = ?", [file_path]))
+
+    async def get_file_history(self, file_path: str) -> list:
+        # Paths are unique, so the history is the current record
+        record = await self.get_processed_file(file_path)
+        return [record] if record is not None else []
+
+    # OCR cache
+
+    async def get_ocr_cache_entry(self, digest: str) -> Optional[dict]:
+        """Get a cached OCR result and mark it as recently used"""
+        def lookup(connection):
+            row = connection.execute("SELECT document FROM ocr_cache WHERE digest = ?", [digest]).fetchone()
+            if row is None:
+                return None
+            entry = _loads(row["document"])
+            updated = {**entry, "last_access": datetime.utcnow(), "hits": entry.get("hits", 0) + 1}
+            connection.execute(
+                "UPDATE ocr_cache SET last_access = ?, document = ? WHERE digest = ?",
+                [updated["last_access"].isoformat(), _dumps(updated), digest]
+            )
+            return entry
+        return await self._run_in_transaction(lookup)
+
+    async def save_ocr_cache_entry(self, digest: str, entry: dict) -> None:
+        """Create or update a cached OCR result"""
+        entry["last_access"] = datetime.utcnow()
+
+        def save(connection):
+            row = connection.execute("SELECT document FROM ocr_cache WHERE digest = ?", [digest]).fetchone()
+            document = _loads(row["document"]) if row is not None else {
+                "_id": digest, "created": datetime.utcnow(), "hits": 0
+            }
+            document.update(entry)
+            connection.execute(
+                "INSERT INTO ocr_cache (digest, size, last_access, document) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (digest) DO UPDATE SET size = excluded.size, last_access = excluded.last_access, "
+                "document = excluded.document",
+                [digest, document.get("size"), document["last_access"].isoformat(), _dumps(document)]
+            )
+        await self._run_in_transaction(save)
+
+    async def delete_ocr_cache_entry(self, digest: str) -> None:
+        await self._run(lambda connection: connection.execute("DELETE FROM ocr_cache WHERE digest = ?", [digest]))
+
+    async def get_ocr_cache_size(self) -> int:
+        row = await self._run(
+            lambda connection: connection.execute("SELECT COALESCE(SUM(size), 0) AS total FROM ocr_cache").fetchone()
+        )
+        return row["total"]
+
+    def iter_ocr_cache_lru(self) -> SQLiteCursor:
+        """Cached OCR results, least recently used first"""
+        def convert(row):
+            document = _loads(row["document"])
+            return {"_id": row["digest"], "output_location": document.get("output_location"), "size": row["size"]}
+        return SQLiteCursor(self, "SELECT digest, size, document FROM ocr_cache ORDER BY last_access", [], convert)
+
+    # Directory snapshots
+
+    async def load_directory_snapshots(self, root: str) -> Dict[str, DirectorySnapshot]:
+        clause, params = prefix_clause("path", root)
+        snapshots: Dict[str, DirectorySnapshot] = {}
+        async for row in SQLiteCursor(self, f"SELECT * FROM dirs WHERE {clause}", params, lambda row: row):
+            snapshots[row["path"]] = DirectorySnapshot(
+                row["mtime_ns"], row["file_count"] or 0, _loads(row["subdirectories"] or "[]"), row["files_digest"],
+                row["digest"], bool(row["complete"])
+            )
+        logger.info(f"Loaded {len(snapshots)} directory snapshots below {root}")
+        return snapshots
+
+    async def save_directory_snapshots(self, snapshots: List[dict]) -> None:
+        scanned_at = _now()
+        rows = [
+            (snapshot["path"], snapshot["mtime_ns"], snapshot.get("file_count", 0),
+             _dumps(snapshot.get("subdirectories", [])), snapshot["files_digest"], snapshot["digest"],
+             int(snapshot.get("complete", False)), scanned_at)
+            for snapshot in snapshots
+        ]
+        await self._run_in_transaction(
+            lambda connection: connection.executemany(
+                "INSERT OR REPLACE INTO dirs (path, mtime_ns, file_count, subdirectories, files_digest, digest, "
+                "complete, scanned_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        )
+
+    async def delete_directory_snapshots(self, paths: Iterable[str]) -> None:
+        rows = [(path,) for path in paths]
+        await self._run_in_transaction(
+            lambda connection: connection.executemany("DELETE FROM dirs WHERE path = ?", rows)
+        )
+
+    # Blob references
+
+    async def set_blob_reference(self, file_path: str, digest: str, blob: dict) -> None:
+        """Point file_path at a blob, moving its reference count over from the blob it used before"""
+        def update(connection):
+            row = connection.execute("SELECT digest FROM blob_refs WHERE file_path = ?", [file_path]).fetchone()
+            previous_digest = row["digest"] if row is not None else None
+            connection.execute(
+                "INSERT INTO blob_refs (file_path, digest, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (file_path) DO UPDATE SET digest = excluded.digest, updated_at = excluded.updated_at",
+                [file_path, digest, _now()]
+            )
+            if previous_digest == digest:
+                return
+            connection.execute(
+                "INSERT INTO blobs (digest, path, size, refs, created_at) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (digest) DO UPDATE SET refs = refs + 1",
+                [digest, blob.get("path"), blob.get("size"), _now()]
+            )
+            if previous_digest is not None:
+                connection.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", [previous_digest])
+        await self._run_in_transaction(update)
+
+    async def release_blob_references(self, file_paths: Iterable[str]) -> None:
+        """Drop the blob references of removed source files"""
+        rows = [(path,) for path in file_paths]
+
+        def release(connection):
+            for row in rows:
+                reference = connection.execute("SELECT digest FROM blob_refs WHERE file_path = ?", row).fetchone()
+                if reference is None:
+                    continue
+                connection.execute("DELETE FROM blob_refs WHERE file_path = ?", row)
+                connection.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", [reference["digest"]])
+        await self._run_in_transaction(release)
+
+    async def get_unreferenced_blobs(self) -> List[dict]:
+        return await SQLiteCursor(
+            self, "SELECT digest, path, size FROM blobs WHERE refs <= 0", [],
+            lambda row: {"_id": row["digest"], "path": row["path"], "size": row["size"]}
+        ).to_list()
+
+    async def delete_unreferenced_blobs(self, digests: List[str]) -> None:
+        rows = [(digest,) for digest in digests]
+        await self._run_in_transaction(
+            lambda connection: connection.executemany("DELETE FROM blobs WHERE digest = ? AND refs <= 0", rows)
+        )
@@ -0,0 +1,266 @@
+import config
+import inspect
+import metrics
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+# Values of STORAGE_BACKEND
+STORAGE_MONGO = "mongo"   # MongoDB through Motor (db_handler.DatabaseHandler)
+STORAGE_SQLITE = "sqlite" # Embedded SQLite file (sqlite_handler.SQLiteDatabaseHandler)
+
+# Work unit states of a partitioned scan
+UNIT_PENDING = "pending"
+UNIT_CLAIMED = "claimed"
+UNIT_DONE = "done"
+UNIT_FAILED = "failed"
+UNIT_CANCELLED = "cancelled"
+UNIT_FINISHED = (UNIT_DONE, UNIT_FAILED, UNIT_CANCELLED)
+
+# Lease expiry of a unit nobody holds, so it is claimable at once
+UNCLAIMED = datetime(1970, 1, 1)
+
+
+class FileRecord(NamedTuple):
+    """Compact view of a tracked file, as held in the per-scan index"""
+    size: Optional[int]
+    modified: Optional[float]
+    status: Optional[str]
+    hash: Optional[str]
+    mtime_ns: Optional[int]
+    inode: Optional[int]
+    output_path: Optional[str] = None
+
+
+def add_to_index(index: Dict[str, FileRecord], doc: dict) -> None:
+    """Add a projected document to the index, preferring live records over deleted duplicates"""
+    record = FileRecord(
+        doc.get("size"), doc.get("modified"), doc.get("status"), doc.get("hash"),
+        doc.get("mtime_ns"), doc.get("inode"), doc.get("output_path")
+    )
+    existing = index.get(doc["file_path"])
+    if existing is None or existing.status != config.STATUS_PROCESSED:
+        index[doc["file_path"]] = record
+
+
+class DirectorySnapshot(NamedTuple):
+    """Summary of a directory as seen by the last scan that listed it"""
+    mtime_ns: int
+    file_count: int
+    subdirectories: List[str]
+    files_digest: str
+    digest: str
+    complete: bool
+
+
+class StorageBackend(ABC):
+    """What the scanner, the watcher and the API need from a database.
+
+    Records are plain dicts shaped like the MongoDB documents, whatever the
+    backend. Methods named iter_* return cursors that support ``async for``
+    and ``to_list(length)``.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Record the latency of every database operation, labelled with its method name
+        for name in StorageBackend.__abstractmethods__:
+            function = cls.__dict__.get(name)
+            if inspect.iscoroutinefunction(function):
+                setattr(cls, name, metrics.timed_db_operation(name, function))
+
+    @abstractmethod
+    async def initialize(self) -> None:
+        ...
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+    @abstractmethod
+    async def test_connection(self) -> bool:
+        ...
+
+    @abstractmethod
+    async def bootstrap(self) -> None:
+        """Apply schema migrations and create the indexes"""
+
+    @abstractmethod
+    async def explain_hot_queries(self) -> List[dict]:
+        """Query plan of every hot query, as {query, collection, stages, index_scan}"""
+
+    # Scan reports
+
+    @abstractmethod
+    async def create_scan_header(self, header: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def update_scan_header(self, scan_id, fields: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def insert_scan_entries(self, entries: List[dict]) -> None:
+        ...
+
+    @abstractmethod
+    def iter_scan_entries(self, scan_id, section: Optional[str] = None, after=None, limit: int = 0):
+        ...
+
+    @abstractmethod
+    def iter_scan_headers(self, after: Optional[str] = None, limit: int = 0, full: bool = False):
+        ...
+
+    @abstractmethod
+    async def find_scan_header(self, scan: Optional[str] = None, full: bool = False) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def find_scans_with_status(self, status: str) -> List[dict]:
+        """Summary headers of the scans in the given status, oldest first"""
+
+    @abstractmethod
+    async def delete_scan_entries(self, scan_id, after_seq: int, entry_ids: Iterable = ()) -> None:
+        """Delete a scan's entries numbered above ``after_seq`` and those with the given _ids"""
+
+    @abstractmethod
+    async def delete_unit_entries(self, scan_id, unit_id) -> None:
+        """Delete the entries a work unit added to its scan's report"""
+
+    # Scan coordination
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        """Take or renew the named lease for owner; False while another owner holds it unexpired"""
+
+    @abstractmethod
+    async def release_lease(self, name: str, owner: str) -> None:
+        ...
+
+    @abstractmethod
+    async def insert_work_units(self, units: List[dict]) -> None:
+        ...
+
+    @abstractmethod
+    async def claim_work_unit(self, owner: str, seconds: float, max_attempts: int) -> Optional[dict]:
+        """Claim the oldest pending unit, or one whose lease expired, unless it was tried max_attempts times"""
+
+    @abstractmethod
+    async def update_work_unit(self, unit_id, owner: Optional[str], fields: dict) -> bool:
+        """Set fields of a unit still held by owner (None: unclaimed); False if it is not"""
+
+    @abstractmethod
+    async def find_work_units(self, scan_id) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def delete_work_units(self, scan_id) -> None:
+        ...
+
+    # File records
+
+    @abstractmethod
+    async def get_processed_file(self, file_path: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def get_all_processed_files(self) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def load_file_index(self, root: Optional[str] = None, recursive: bool = True) -> Dict[str, FileRecord]:
+        """Every tracked file below root; without ``recursive`` only those directly in root"""
+
+    @abstractmethod
+    async def get_files_by_paths(self, file_paths: Iterable[str]) -> Dict[str, FileRecord]:
+        ...
+
+    @abstractmethod
+    def iter_file_index(self, root: str, after: Optional[str] = None, limit: int = 0):
+        """Cursor over the index fields of the tracked files below root, sorted by file_path.
+
+        ``after`` is the file_path of the last record of the previous page.
+        """
+
+    @abstractmethod
+    def iter_output_records(self):
+        ...
+
+    @abstractmethod
+    async def get_processed_file_paths(self, root: Optional[str] = None) -> set:
+        ...
+
+    @abstractmethod
+    async def insert_processed_file(self, file_data: dict):
+        ...
+
+    @abstractmethod
+    async def update_file_status(self, file_path: str, status: str, metadata: dict = None):
+        ...
+
+    @abstractmethod
+    def write_batcher(self):
+        """A write-behind batcher with insert/upsert/update_status/update_metadata, flush and close"""
+
+    @abstractmethod
+    async def delete_file_record(self, file_path: str):
+        ...
+
+    @abstractmethod
+    async def get_file_history(self, file_path: str) -> list:
+        ...
+
+    # OCR cache
+
+    @abstractmethod
+    async def get_ocr_cache_entry(self, digest: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def save_ocr_cache_entry(self, digest: str, entry: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_ocr_cache_entry(self, digest: str) -> None:
+        ...
+
+    @abstractmethod
+    async def get_ocr_cache_size(self) -> int:
+        ...
+
+    @abstractmethod
+    def iter_ocr_cache_lru(self):
+        ...
+
+    # Directory snapshots
+
+    @abstractmethod
+    async def load_directory_snapshots(self, root: str) -> Dict[str, DirectorySnapshot]:
+        ...
+
+    @abstractmethod
+    async def save_directory_snapshots(self, snapshots: List[dict]) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_directory_snapshots(self, paths: Iterable[str]) -> None:
+        ...
+
+    # Blob references
+
+    @abstractmethod
+    async def set_blob_reference(self, file_path: str, digest: str, blob: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def release_blob_references(self, file_paths: Iterable[str]) -> None:
+        ...
+
+    @abstractmethod
+    async def get_unreferenced_blobs(self) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def delete_unreferenced_blobs(self, digests: List[str]) -> None:
+        ...
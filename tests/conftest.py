@@ -0,0 +1,55 @@
+"""Fixtures for the tests that scan a real directory tree.
+
+They run on the SQLite backend, each test on its own database file, with
+SOURCE_DATA_LAKE_DIR and OUTPUT_DIR in a temporary directory.
+"""
+import config
+import pytest
+import asyncio
+
+from storage import STORAGE_SQLITE
+
+# The module-level db_handler is built from this when db_handler is first imported
+config.STORAGE_BACKEND = STORAGE_SQLITE
+
+from db_handler import db_handler
+from utils import release_output_paths
+
+
+class Lake:
+    def __init__(self, root):
+        self.source = root / "lake"
+        self.output = root / "output"
+        self.source.mkdir()
+        self.output.mkdir()
+
+    def write(self, relative_path: str, content: str = "data") -> str:
+        path = self.source / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        return str(path)
+
+    def outputs(self) -> set:
+        return {entry.name for entry in self.output.iterdir() if entry.is_file()}
+
+    def run(self, function, *args):
+        """Run the coroutine function on an open database, in a new event loop"""
+        async def run():
+            await db_handler.initialize()
+            try:
+                return await function(*args)
+            finally:
+                await db_handler.close()
+        return asyncio.run(run())
+
+
+@pytest.fixture
+def lake(tmp_path, monkeypatch):
+    lake = Lake(tmp_path)
+    monkeypatch.setattr(config, "SOURCE_DATA_LAKE_DIR", str(lake.source))
+    monkeypatch.setattr(config, "OUTPUT_DIR", str(lake.output))
+    monkeypatch.setattr(config, "SCAN_CHECKPOINT_INTERVAL", 0)
+    monkeypatch.setattr(db_handler, "path", str(tmp_path / "tracker.db"))
+    release_output_paths()
+    yield lake
+    release_output_paths()
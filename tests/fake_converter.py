@@ -0,0 +1,36 @@
+"""Stand-in for the docling converter, loaded by the OCR worker through
+OCR_CONVERTER_FACTORY=tests.fake_converter:factory. Its markdown names the
+worker process that converted the PDF; PDFs named ``slow*`` hang, ``crash*``
+kill the worker and ``broken*`` raise.
+"""
+import os
+import time
+
+
+class _Document:
+    def __init__(self, text: str):
+        self._text = text
+
+    def export_to_markdown(self) -> str:
+        return self._text
+
+
+class _Result:
+    def __init__(self, document: _Document):
+        self.document = document
+
+
+class FakeConverter:
+    def convert(self, pdf_path: str) -> _Result:
+        name = os.path.basename(pdf_path)
+        if name.startswith("slow"):
+            time.sleep(60)
+        elif name.startswith("crash"):
+            os._exit(1)
+        elif name.startswith("broken"):
+            raise ValueError("not a PDF")
+        return _Result(_Document(f"pid {os.getpid()}\n"))
+
+
+def factory() -> FakeConverter:
+    return FakeConverter()
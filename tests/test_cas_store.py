@@ -0,0 +1,59 @@
+"""Deduplicated outputs in the content-addressed blob store (OUTPUT_STORE=cas)"""
+import os
+import config
+import pytest
+import cas_store
+
+from files_processing import process_directory
+from utils import clean_output_folders
+
+
+@pytest.fixture
+def cas_lake(lake, monkeypatch):
+    monkeypatch.setattr(config, "OUTPUT_STORE", cas_store.STORE_CAS)
+    monkeypatch.setattr(config, "CAS_LINK_MODE", cas_store.LINK_HARDLINK)
+    return lake
+
+
+def _blobs(lake) -> list:
+    return [os.path.join(directory, name) for directory, _, names in os.walk(lake.output / cas_store.CAS_DIR_NAME)
+            for name in names]
+
+
+def test_changed_file_is_relinked_in_place(cas_lake):
+    source = cas_lake.write("docs/a.txt", "first version")
+
+    async def run():
+        await process_directory(str(cas_lake.source))
+        with open(source, "w") as f:
+            f.write("second, longer version")
+        return await process_directory(str(cas_lake.source))
+
+    report = cas_lake.run(run)
+    assert report.counts["processed_files"] == 1, report.counts
+    assert cas_lake.outputs() == {"docs_a.txt"}
+    output = cas_lake.output / "docs_a.txt"
+    assert output.read_text() == "second, longer version"
+    # The superseded blob lost its last link and was collected
+    blobs = _blobs(cas_lake)
+    assert len(blobs) == 1 and os.path.samefile(blobs[0], output), blobs
+    assert report.summary["dedup"]["blobs_collected"] == 1, report.summary
+
+
+def test_identical_files_share_a_blob(cas_lake):
+    cas_lake.write("a.txt", "same")
+    cas_lake.write("b.txt", "same")
+
+    report = cas_lake.run(process_directory, str(cas_lake.source))
+    assert cas_lake.outputs() == {"a.txt", "b.txt"}
+    assert os.path.samefile(cas_lake.output / "a.txt", cas_lake.output / "b.txt")
+    assert report.summary["dedup"]["blobs_stored"] == 1 and report.summary["dedup"]["blobs_reused"] == 1, report.summary
+
+
+def test_clean_output_folders_keeps_the_blob_store(cas_lake):
+    cas_lake.write("a.txt", "kept")
+    cas_lake.run(process_directory, str(cas_lake.source))
+
+    clean_output_folders(str(cas_lake.output), (cas_store.CAS_DIR_NAME,))
+    assert cas_lake.outputs() == set()
+    assert len(_blobs(cas_lake)) == 1
@@ -0,0 +1,74 @@
+"""The copy engine behind non-PDF outputs: every method, and falling back from unsupported ones"""
+import os
+import errno
+import config
+import pytest
+import copy_engine
+
+from copy_engine import METHOD_COPY, METHOD_COPY_FILE_RANGE, METHOD_HARDLINK, METHOD_REFLINK, METHOD_SENDFILE, copy_file
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.setattr(copy_engine, "_unsupported", set())
+    path = tmp_path / "source.bin"
+    path.write_bytes(os.urandom(100_000))
+    os.utime(path, ns=(1_000_000_000, 1_500_000_000))
+    return path
+
+
+@pytest.mark.parametrize("method", [METHOD_COPY_FILE_RANGE, METHOD_SENDFILE, METHOD_COPY, METHOD_HARDLINK])
+def test_method_copies_content_and_timestamps(source, tmp_path, monkeypatch, method):
+    monkeypatch.setattr(config, "COPY_METHODS", [method])
+    monkeypatch.setattr(config, "COPY_CHUNK_SIZE", 4096)
+    destination = tmp_path / "out.bin"
+
+    result = copy_file(str(source), str(destination))
+    assert result.method == method and result.size == 100_000, result
+    assert destination.read_bytes() == source.read_bytes()
+    assert os.stat(destination).st_mtime_ns == 1_500_000_000
+
+
+@pytest.mark.parametrize("method", [METHOD_COPY_FILE_RANGE, METHOD_SENDFILE])
+def test_source_grown_since_stat_is_copied_to_its_end(source, tmp_path, monkeypatch, method):
+    monkeypatch.setattr(config, "COPY_METHODS", [method])
+    monkeypatch.setattr(config, "COPY_CHUNK_SIZE", 4096)
+    destination = tmp_path / "out.bin"
+
+    result = copy_file(str(source), str(destination), size=10_000)
+    assert result.size == 100_000 and destination.read_bytes() == source.read_bytes(), result
+
+
+def test_unsupported_method_falls_back_and_is_not_tried_again(source, tmp_path, monkeypatch):
+    attempts = []
+
+    def unsupported(source, destination, size):
+        attempts.append(destination)
+        open(destination, "wb").close()
+        raise OSError(errno.EOPNOTSUPP, "not supported")
+    monkeypatch.setitem(copy_engine._METHODS, METHOD_REFLINK, unsupported)
+    monkeypatch.setattr(config, "COPY_METHODS", [METHOD_REFLINK, METHOD_COPY_FILE_RANGE])
+
+    first = copy_file(str(source), str(tmp_path / "first.bin"))
+    second = copy_file(str(source), str(tmp_path / "second.bin"))
+    assert first.method == second.method == METHOD_COPY_FILE_RANGE
+    assert len(attempts) == 1
+    assert (tmp_path / "first.bin").read_bytes() == source.read_bytes()
+
+
+def test_other_errors_are_raised_and_leave_no_partial_output(source, tmp_path, monkeypatch):
+    def failing(source, destination, size):
+        open(destination, "wb").close()
+        raise OSError(errno.EIO, "I/O error")
+    monkeypatch.setitem(copy_engine._METHODS, METHOD_COPY_FILE_RANGE, failing)
+    monkeypatch.setattr(config, "COPY_METHODS", [METHOD_COPY_FILE_RANGE, METHOD_COPY])
+
+    with pytest.raises(OSError):
+        copy_file(str(source), str(tmp_path / "out.bin"))
+    assert not (tmp_path / "out.bin").exists()
+
+
+def test_unknown_method_is_rejected(source, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "COPY_METHODS", ["teleport"])
+    with pytest.raises(ValueError):
+        copy_file(str(source), str(tmp_path / "out.bin"))
@@ -0,0 +1,160 @@
+import os
+import asyncio
+import config
+import pytest
+import ocr_scheduler
+
+from ocr_workers import WarmOcrRunner
+from ocr_scheduler import OcrScheduler, SubprocessOcrRunner, OCR_FAILED, OCR_SUCCEEDED, OCR_TIMED_OUT
+
+
+@pytest.fixture
+def pdfs(tmp_path, monkeypatch):
+    """Make PDFs in a source directory, with OCR output going to its own directory"""
+    monkeypatch.setattr(config, "OCR_CONVERTER_FACTORY", "tests.fake_converter:factory")
+    monkeypatch.setattr(config, "OCR_OUTPUT_DIR", str(tmp_path / "ocr"))
+    source = tmp_path / "source"
+    source.mkdir()
+
+    def make(*names):
+        paths = []
+        for name in names:
+            path = source / f"{name}.pdf"
+            path.write_bytes(b"%PDF-1.4 fake")
+            paths.append(str(path))
+        return paths
+    return make
+
+
+def converted_by(pdf_path, output_dir=None):
+    """Pid of the worker process that wrote the PDF's markdown"""
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    with open(os.path.join(output_dir or config.OCR_OUTPUT_DIR, f"{stem}.md")) as f:
+        return int(f.read().split()[1])
+
+
+def run_all(runner, *batches):
+    """Run each batch of (pdf_path, output_dir) jobs on runner, then close it"""
+    async def run():
+        try:
+            return [await runner.run(batch) for batch in batches]
+        finally:
+            await runner.close()
+    return asyncio.run(run())
+
+
+def test_outcomes_have_the_subprocess_runner_shape(pdfs, monkeypatch):
+    first, second, broken = pdfs("first", "second", "broken")
+    # No docling CLI here, so the subprocess runner fails to start it; the shape is what matters
+    monkeypatch.setattr(SubprocessOcrRunner, "build_command",
+                        staticmethod(lambda pdf_path, output_dir=None: ["/nonexistent/docling", pdf_path]))
+    [warm] = run_all(WarmOcrRunner(timeout=30), [(first, None), (second, None), (broken, None)])
+    [subprocess] = run_all(SubprocessOcrRunner(timeout=30), [(first, None)])
+
+    assert [outcome[0] for outcome in warm] == [OCR_SUCCEEDED, OCR_SUCCEEDED, OCR_FAILED]
+    assert warm[0][1:3] == (0, None)
+    assert warm[2][1] is None and "not a PDF" in warm[2][2]
+    assert subprocess[0][0] == OCR_FAILED
+    for status, returncode, error, duration in warm + subprocess:
+        assert isinstance(status, str) and isinstance(duration, float)
+    assert converted_by(first) == converted_by(second)
+
+
+def test_output_goes_to_each_jobs_directory(pdfs, tmp_path):
+    first, second = pdfs("first", "second")
+    job_dir = str(tmp_path / "job")
+    [outcomes] = run_all(WarmOcrRunner(timeout=30), [(first, job_dir), (second, None)])
+    assert [outcome[0] for outcome in outcomes] == [OCR_SUCCEEDED, OCR_SUCCEEDED]
+    assert converted_by(first, job_dir) == converted_by(second)
+
+
+def test_scheduler_batches_up_to_batch_size(pdfs, monkeypatch):
+    monkeypatch.setattr(config, "OCR_MODE", ocr_scheduler.OCR_MODE_WORKER_POOL)
+    monkeypatch.setattr(config, "OCR_BATCH_SIZE", 3)
+    batches = []
+    run = WarmOcrRunner.run
+
+    async def recording_run(self, jobs):
+        batches.append(len(jobs))
+        return await run(self, jobs)
+    monkeypatch.setattr(WarmOcrRunner, "run", recording_run)
+    paths = pdfs(*(f"doc{index}" for index in range(7)))
+
+    async def submit_all():
+        scheduler = OcrScheduler(slots=1, timeout=30, max_retries=0, order=ocr_scheduler.ORDER_FIFO)
+        try:
+            return await asyncio.gather(*(scheduler.submit(path, 1) for path in paths))
+        finally:
+            await scheduler.close()
+    results = asyncio.run(submit_all())
+
+    assert [result["status"] for result in results] == [OCR_SUCCEEDED] * 7
+    assert [result["path"] for result in results] == paths
+    assert batches == [3, 3, 1]
+    assert len({converted_by(path) for path in paths}) == 1
+
+
+def test_cancelled_submit_is_not_run(pdfs, monkeypatch):
+    monkeypatch.setattr(config, "OCR_MODE", ocr_scheduler.OCR_MODE_WORKER_POOL)
+    monkeypatch.setattr(config, "OCR_BATCH_SIZE", 1)
+    converted = []
+    cancelled_submit = {}
+    run = WarmOcrRunner.run
+
+    async def recording_run(self, jobs):
+        converted.extend(pdf_path for pdf_path, _ in jobs)
+        # Keep the slot busy until the queued submit is cancelled
+        await cancelled_submit["done"].wait()
+        return await run(self, jobs)
+    monkeypatch.setattr(WarmOcrRunner, "run", recording_run)
+    first, dropped, last = pdfs("first", "dropped", "last")
+
+    async def submit_and_cancel():
+        scheduler = OcrScheduler(slots=1, timeout=30, max_retries=0, order=ocr_scheduler.ORDER_FIFO)
+        try:
+            cancelled_submit["done"] = asyncio.Event()
+            running = asyncio.create_task(scheduler.submit(first, 1))
+            cancelled = asyncio.create_task(scheduler.submit(dropped, 1))
+            await asyncio.sleep(0.1)
+            cancelled.cancel()
+            await asyncio.sleep(0)
+            cancelled_submit["done"].set()
+            results = await asyncio.gather(running, scheduler.submit(last, 1))
+            return results, await asyncio.gather(cancelled, return_exceptions=True)
+        finally:
+            await scheduler.close()
+    results, [cancelled] = asyncio.run(submit_and_cancel())
+
+    assert [result["status"] for result in results] == [OCR_SUCCEEDED, OCR_SUCCEEDED]
+    assert isinstance(cancelled, asyncio.CancelledError)
+    assert converted == [first, last]
+    assert not os.path.exists(os.path.join(config.OCR_OUTPUT_DIR, "dropped.md"))
+
+
+def test_worker_is_recycled_after_max_documents(pdfs, monkeypatch):
+    monkeypatch.setattr(config, "OCR_WORKER_MAX_DOCUMENTS", 2)
+    first, second, third = pdfs("first", "second", "third")
+    runner = WarmOcrRunner(timeout=30)
+    run_all(runner, [(first, None)], [(second, None)], [(third, None)])
+    assert converted_by(first) == converted_by(second)
+    assert converted_by(third) != converted_by(second)
+
+
+def test_timeout_kills_the_worker_and_times_out_the_batch(pdfs):
+    slow, other, after = pdfs("slow", "other", "after")
+    runner = WarmOcrRunner(timeout=3)
+    timed_out, [recovered] = run_all(runner, [(slow, None), (other, None)], [(after, None)])
+    assert [outcome[0] for outcome in timed_out] == [OCR_TIMED_OUT, OCR_TIMED_OUT]
+    assert all(outcome[1] is None and "killed" in outcome[2] for outcome in timed_out)
+    assert recovered[0] == OCR_SUCCEEDED
+
+
+def test_dead_worker_fails_the_batch_and_is_replaced(pdfs):
+    first, crash, other, after = pdfs("first", "crash", "other", "after")
+    runner = WarmOcrRunner(timeout=30)
+    [succeeded], died, [recovered] = run_all(runner, [(first, None)], [(crash, None), (other, None)], [(after, None)])
+    assert succeeded[0] == OCR_SUCCEEDED
+    assert [outcome[0] for outcome in died] == [OCR_FAILED, OCR_FAILED]
+    assert all("died" in outcome[2] for outcome in died)
+    assert recovered[0] == OCR_SUCCEEDED
+    assert converted_by(after) != converted_by(first)
@@ -0,0 +1,39 @@
+"""Allocation and release of output names (utils.OutputNameIndex)"""
+import os
+import config
+import utils
+
+from files_processing import process_directory
+from output_sync import OUTPUT_SYNC_INCREMENTAL
+from utils import OutputNameIndex, remove_files
+
+
+def test_sequential_names_count_up_and_reuse_removed_ones(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "output_names", OutputNameIndex())
+    (tmp_path / "report.txt").write_text("already there")
+    allocate = lambda: utils.output_names.allocate(str(tmp_path), "report", ".txt")
+    first, second, third = allocate(), allocate(), allocate()
+    assert [os.path.basename(path) for path in (first, second, third)] == ["report_1.txt", "report_2.txt", "report_3.txt"]
+
+    for path in (first, second):
+        open(path, "w").close()
+    assert remove_files([first, str(tmp_path / "never_written.txt")]) == 1
+    assert allocate() == first
+    assert allocate() == os.path.join(tmp_path, "report_4.txt")
+
+
+def test_reconciled_orphans_free_their_names(lake, monkeypatch):
+    monkeypatch.setattr(config, "OUTPUT_SYNC_MODE", OUTPUT_SYNC_INCREMENTAL)
+    lake.write("a/notes.txt", "one")
+    lake.write("b/notes.txt", "two")
+    lake.run(process_directory, str(lake.source))
+    os.remove(lake.source / "a" / "notes.txt")
+
+    async def run():
+        await process_directory(str(lake.source))
+        await process_directory(str(lake.source), sync_outputs=True)
+        return utils.output_names.allocate(str(lake.output), "a_notes", ".txt")
+
+    # The deleted file's output was removed as an orphan, so its name is free again
+    assert os.path.basename(lake.run(run)) == "a_notes.txt"
+    assert lake.outputs() == {"b_notes.txt"}
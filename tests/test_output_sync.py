@@ -0,0 +1,70 @@
+"""Incremental reconciliation of OUTPUT_DIR (OUTPUT_SYNC_MODE=incremental) and in-place replacement of outputs"""
+import os
+import config
+import pytest
+
+from db_handler import db_handler
+from files_processing import process_directory
+from output_sync import OUTPUT_SYNC_INCREMENTAL, reconcile_outputs
+
+
+@pytest.fixture
+def synced_lake(lake, monkeypatch):
+    monkeypatch.setattr(config, "OUTPUT_SYNC_MODE", OUTPUT_SYNC_INCREMENTAL)
+    return lake
+
+
+def test_reconcile_removes_orphans_and_restores_missing_outputs(synced_lake):
+    synced_lake.write("a.txt", "alpha")
+    synced_lake.write("b.txt", "beta")
+    synced_lake.run(process_directory, str(synced_lake.source))
+
+    (synced_lake.output / "a.txt").unlink()
+    (synced_lake.output / "stray.txt").write_text("no source")
+    (synced_lake.output / "b.txt").write_text("edited by hand")
+    (synced_lake.output / "keep.json").write_text("{}")
+
+    report = synced_lake.run(process_directory, str(synced_lake.source), False, True)
+    summary = report.summary["output_sync"]
+    assert (summary["orphans_removed"], summary["stale_removed"], summary["outputs_to_restore"]) == (1, 1, 2), summary
+    assert synced_lake.outputs() == {"a.txt", "b.txt", "keep.json"}
+    assert (synced_lake.output / "b.txt").read_text() == "beta"
+    assert report.counts["processed_files"] == 2, report.counts
+
+
+def test_reconcile_keeps_outputs_of_failed_and_drops_those_of_deleted_records(synced_lake):
+    failed = synced_lake.write("failed.pdf")
+    gone = synced_lake.output / "gone.txt"
+    for name in ("failed.md", "gone.txt"):
+        (synced_lake.output / name).write_text("output")
+
+    async def run():
+        await db_handler.insert_processed_file({
+            "file_path": failed, "output_path": str(synced_lake.output / "failed.md"),
+            "status": config.STATUS_FAILED, "size": 4, "output_size": 6
+        })
+        await db_handler.insert_processed_file({
+            "file_path": str(synced_lake.source / "gone.txt"), "output_path": str(gone),
+            "status": config.STATUS_DELETED, "size": 6
+        })
+        return await reconcile_outputs(str(synced_lake.output))
+
+    missing, summary = synced_lake.run(run)
+    assert synced_lake.outputs() == {"failed.md"}
+    assert summary["orphans_removed"] == 1 and not missing, (summary, missing)
+
+
+def test_changed_file_replaces_its_output_in_place(synced_lake):
+    source = synced_lake.write("docs/a.txt", "first")
+
+    async def run():
+        await process_directory(str(synced_lake.source))
+        with open(source, "w") as f:
+            f.write("second version")
+        return await process_directory(str(synced_lake.source), sync_outputs=True)
+
+    report = synced_lake.run(run)
+    assert report.counts["processed_files"] == 1, report.counts
+    assert synced_lake.outputs() == {"docs_a.txt"}
+    assert (synced_lake.output / "docs_a.txt").read_text() == "second version"
+    assert not [name for name in os.listdir(synced_lake.output) if name.endswith(".tmp")]
@@ -0,0 +1,41 @@
+"""Resuming a scan from its last checkpoint"""
+import os
+
+from db_handler import db_handler
+from files_processing import _mark_deleted, process_directory
+from scan_report import ScanReport
+
+
+async def _entries(scan_id) -> list:
+    return [(entry["section"], os.path.basename(entry["path"])) async for entry in db_handler.iter_scan_entries(scan_id)]
+
+
+def test_resume_keeps_deletions_before_the_checkpoint(lake):
+    kept = lake.write("kept.txt")
+    gone = lake.write("gone.txt")
+    copied = lake.write("sub/copied.txt")
+
+    async def run():
+        await process_directory(str(lake.source))
+        os.remove(gone)
+
+        # A scan that marked a deletion, was copying a file at its checkpoint and then stopped
+        interrupted = ScanReport(str(lake.source))
+        await interrupted.start()
+        async with db_handler.write_batcher() as batcher:
+            await _mark_deleted([gone], batcher, interrupted)
+            await interrupted.add("copies", {"path": copied, "method": "copy"})
+            await interrupted.checkpoint(batcher)
+            await interrupted.add("skipped_files", {"path": kept})
+        interrupted.abandon()
+
+        report = await ScanReport.resume(await db_handler.find_scan_header(str(interrupted.scan_id)))
+        assert report.counts["deleted_files"] == 1 and report.counts["copies"] == 0, report.counts
+        assert await _entries(report.scan_id) == [("deleted_files", "gone.txt")]
+
+        await process_directory(str(lake.source), report=report)
+        header = await db_handler.find_scan_header(str(report.scan_id))
+        assert header["counts"]["deleted_files"] == 1 and header["counts"]["skipped_files"] == 2, header["counts"]
+        assert (await db_handler.get_processed_file(gone))["status"] == "deleted"
+
+    lake.run(run)
@@ -0,0 +1,292 @@
+"""Conformance tests every StorageBackend must pass.
+
+Each check runs on a fresh database of every backend: SQLite in a
+temporary file, and MongoDB in a throwaway database on MONGO_URI, skipped
+when no server answers there.
+"""
+import os
+import config
+import pytest
+import asyncio
+import functools
+
+from datetime import datetime
+from bson import ObjectId
+from storage import STORAGE_MONGO, STORAGE_SQLITE, UNCLAIMED, UNIT_CLAIMED, UNIT_DONE, UNIT_PENDING, StorageBackend
+
+# Seconds to wait for MONGO_URI before skipping the MongoDB backend
+MONGO_PROBE_TIMEOUT_MS = 1000
+
+CHECKS = []
+
+
+def check(function):
+    CHECKS.append(function)
+    return function
+
+
+def _record(path: str, **fields) -> dict:
+    return {
+        "directory": os.path.dirname(path),
+        "file_path": path,
+        "output_path": f"/out/{os.path.basename(path)}",
+        "status": config.STATUS_PROCESSED,
+        "size": 10,
+        "modified": 1.5,
+        "mtime_ns": 1500000000,
+        "inode": 7,
+        **fields
+    }
+
+
+@check
+async def file_records_upsert_by_path(db: StorageBackend):
+    await db.insert_processed_file(_record("/lake/a.txt", copy_method="copy"))
+    await db.insert_processed_file(_record("/lake/a.txt", size=11))
+    record = await db.get_processed_file("/lake/a.txt")
+    assert record["size"] == 11 and record["copy_method"] == "copy", record
+    assert isinstance(record["processed_time"], datetime), record
+    assert len(await db.get_all_processed_files()) == 1
+    assert len(await db.get_file_history("/lake/a.txt")) == 1
+
+
+@check
+async def write_batcher_semantics(db: StorageBackend):
+    async with db.write_batcher() as batcher:
+        await batcher.upsert(_record("/lake/b.txt", hash="h1"))
+        await batcher.upsert(_record("/lake/c.txt"))
+    async with db.write_batcher() as batcher:
+        await batcher.update_status("/lake/b.txt", config.STATUS_DELETED)
+        await batcher.update_metadata("/lake/c.txt", {"mtime_ns": 99, "inode": 8})
+        # Upserts only set the fields they carry
+        await batcher.upsert({"file_path": "/lake/c.txt", "size": 12})
+    assert not batcher.errors, batcher.errors
+    b = await db.get_processed_file("/lake/b.txt")
+    c = await db.get_processed_file("/lake/c.txt")
+    assert b["status"] == config.STATUS_DELETED and b["hash"] == "h1" and "last_updated" in b, b
+    assert (c["mtime_ns"], c["inode"], c["size"], c["status"]) == (99, 8, 12, config.STATUS_PROCESSED), c
+
+
+@check
+async def file_index_is_scoped_to_root(db: StorageBackend):
+    async with db.write_batcher() as batcher:
+        for path in ("/lake/x/1.txt", "/lake/x/sub/2.txt", "/lake/xy/3.txt", "/other/4.txt"):
+            await batcher.upsert(_record(path))
+        await batcher.upsert(_record("/other/5.pdf", output_path="/ocr/5.md", output_size=3))
+        await batcher.update_status("/lake/x/sub/2.txt", config.STATUS_DELETED)
+
+    index = await db.load_file_index("/lake/x")
+    assert set(index) == {"/lake/x/1.txt", "/lake/x/sub/2.txt"}, set(index)
+    assert index["/lake/x/1.txt"].size == 10 and index["/lake/x/1.txt"].inode == 7
+    assert set(await db.load_file_index("/")) == set(await db.load_file_index())
+    assert set(await db.load_file_index("/lake/x/", recursive=False)) == {"/lake/x/1.txt"}
+    assert await db.get_processed_file_paths("/lake/x/") == {"/lake/x/1.txt"}
+    assert "/other/4.txt" in await db.get_processed_file_paths()
+
+    first_page = await db.iter_file_index("/lake", limit=2).to_list(None)
+    assert [doc["file_path"] for doc in first_page] == ["/lake/x/1.txt", "/lake/x/sub/2.txt"], first_page
+    assert first_page[1]["status"] == config.STATUS_DELETED, first_page
+    rest = await db.iter_file_index("/lake", after=first_page[-1]["file_path"]).to_list(None)
+    assert [doc["file_path"] for doc in rest] == ["/lake/xy/3.txt"], rest
+
+    found = await db.get_files_by_paths(["/lake/x/1.txt", "/other/4.txt", "/missing"])
+    assert set(found) == {"/lake/x/1.txt", "/other/4.txt"}, set(found)
+
+    outputs = {record["file_path"]: record async for record in db.iter_output_records()}
+    assert set(outputs) >= {"/lake/x/1.txt", "/other/4.txt", "/other/5.pdf"}
+    assert all(record["output_path"] for record in outputs.values())
+    assert outputs["/other/5.pdf"]["output_size"] == 3 and "output_size" not in outputs["/other/4.txt"]
+
+
+@check
+async def directory_snapshots_round_trip(db: StorageBackend):
+    documents = [
+        {"path": path, "mtime_ns": 5, "file_count": 2, "subdirectories": ["sub"], "files_digest": "f",
+         "digest": "d", "complete": True}
+        for path in ("/lake", "/lake/sub", "/lakes")
+    ]
+    await db.save_directory_snapshots(documents)
+    await db.save_directory_snapshots([{**documents[1], "mtime_ns": 6, "complete": False}])
+    snapshots = await db.load_directory_snapshots("/lake")
+    assert set(snapshots) == {"/lake", "/lake/sub"}, set(snapshots)
+    assert snapshots["/lake/sub"].mtime_ns == 6 and snapshots["/lake/sub"].complete is False
+    assert snapshots["/lake"].subdirectories == ["sub"]
+    await db.delete_directory_snapshots(["/lake/sub"])
+    assert set(await db.load_directory_snapshots("/lake")) == {"/lake"}
+
+
+@check
+async def blob_reference_counts(db: StorageBackend):
+    await db.set_blob_reference("/lake/1", "aa", {"path": "/out/.cas/aa", "size": 3})
+    await db.set_blob_reference("/lake/2", "aa", {"path": "/out/.cas/aa", "size": 3})
+    await db.set_blob_reference("/lake/2", "aa", {"path": "/out/.cas/aa", "size": 3})
+    await db.set_blob_reference("/lake/1", "bb", {"path": "/out/.cas/bb", "size": 4})
+    assert await db.get_unreferenced_blobs() == []
+    await db.release_blob_references(["/lake/2", "/lake/unknown"])
+    assert [blob["_id"] for blob in await db.get_unreferenced_blobs()] == ["aa"]
+    await db.delete_unreferenced_blobs(["aa", "bb"])
+    await db.release_blob_references(["/lake/1"])
+    unreferenced = await db.get_unreferenced_blobs()
+    assert [(blob["_id"], blob["path"], blob["size"]) for blob in unreferenced] == [("bb", "/out/.cas/bb", 4)]
+
+
+@check
+async def ocr_cache_lru(db: StorageBackend):
+    await db.save_ocr_cache_entry("d1", {"output_location": "/cache/d1", "size": 100})
+    await asyncio.sleep(0.01)
+    await db.save_ocr_cache_entry("d2", {"output_location": "/cache/d2", "size": 50})
+    await asyncio.sleep(0.01)
+    entry = await db.get_ocr_cache_entry("d1")
+    assert entry["output_location"] == "/cache/d1" and entry["hits"] == 0, entry
+    await db.save_ocr_cache_entry("d1", {"post_process_success": True})
+    assert (await db.get_ocr_cache_entry("d1"))["hits"] == 1
+    assert await db.get_ocr_cache_size() == 150
+    assert [entry["_id"] async for entry in db.iter_ocr_cache_lru()] == ["d2", "d1"]
+    await db.delete_ocr_cache_entry("d2")
+    assert await db.get_ocr_cache_entry("d2") is None
+    assert await db.get_ocr_cache_size() == 100
+
+
+@check
+async def scan_reports(db: StorageBackend):
+    scan_ids = []
+    for timestamp in ("20250101_000000", "20250102_000000", "20250103_000000"):
+        scan_id = ObjectId()
+        scan_ids.append(scan_id)
+        await db.create_scan_header({"_id": scan_id, "timestamp": timestamp, "status": "running",
+                                     "counts": {"processed_files": 0}})
+    await db.update_scan_header(scan_ids[2], {"status": "completed", "counts": {"processed_files": 3}})
+    await db.insert_scan_entries([
+        {"scan_id": scan_ids[2], "section": section, "path": f"/lake/{i}", "seq": i + 1}
+        for i, section in enumerate(["processed_files", "errors", "processed_files", "processed_files"])
+    ])
+
+    latest = await db.find_scan_header()
+    assert latest["_id"] == scan_ids[2] and latest["status"] == "completed", latest
+    assert latest["counts"] == {"processed_files": 3}
+    assert (await db.find_scan_header("20250101_000000"))["_id"] == scan_ids[0]
+    assert (await db.find_scan_header(str(scan_ids[1])))["timestamp"] == "20250102_000000"
+    assert await db.find_scan_header(str(ObjectId())) is None
+
+    page = await db.iter_scan_headers(limit=2).to_list(length=2)
+    assert [header["_id"] for header in page] == [scan_ids[2], scan_ids[1]]
+    rest = await db.iter_scan_headers(after=str(page[-1]["_id"]), limit=2).to_list(length=2)
+    assert [header["_id"] for header in rest] == [scan_ids[0]]
+    assert len(await db.iter_scan_headers(after="20250103_000000").to_list(length=10)) == 2
+
+    processed = await db.iter_scan_entries(scan_ids[2], "processed_files").to_list(length=None)
+    assert [entry["path"] for entry in processed] == ["/lake/0", "/lake/2", "/lake/3"], processed
+    assert "scan_id" not in processed[0] and isinstance(processed[0]["_id"], ObjectId)
+    second_page = await db.iter_scan_entries(scan_ids[2], after=processed[0]["_id"], limit=2).to_list(length=2)
+    assert [entry["path"] for entry in second_page] == ["/lake/1", "/lake/2"], second_page
+
+    running = await db.find_scans_with_status("running")
+    assert [header["_id"] for header in running] == scan_ids[:2], running
+    await db.delete_scan_entries(scan_ids[2], 3, [processed[0]["_id"]])
+    kept = await db.iter_scan_entries(scan_ids[2]).to_list(length=None)
+    assert [entry["path"] for entry in kept] == ["/lake/1", "/lake/2"], kept
+    unit_id = ObjectId()
+    await db.insert_scan_entries([{"scan_id": scan_ids[2], "section": "errors", "path": "/lake/9", "unit": unit_id}])
+    await db.delete_unit_entries(scan_ids[2], unit_id)
+    assert len(await db.iter_scan_entries(scan_ids[2]).to_list(length=None)) == 2
+
+
+@check
+async def leases_expire(db: StorageBackend):
+    assert await db.acquire_lease("scan", "worker-1", 60)
+    assert await db.acquire_lease("scan", "worker-1", 60), "the holder renews its lease"
+    assert not await db.acquire_lease("scan", "worker-2", 60)
+    assert await db.acquire_lease("scan", "worker-1", -1)
+    assert await db.acquire_lease("scan", "worker-2", 60), "an expired lease can be taken over"
+    await db.release_lease("scan", "worker-1")
+    assert not await db.acquire_lease("scan", "worker-1", 60), "only the holder releases"
+    await db.release_lease("scan", "worker-2")
+    assert await db.acquire_lease("scan", "worker-1", 60)
+
+
+@check
+async def work_units_are_claimed_once(db: StorageBackend):
+    scan_id = ObjectId()
+    await db.insert_work_units([
+        {"scan_id": scan_id, "path": f"/lake/{i}", "recursive": True, "status": UNIT_PENDING, "owner": None,
+         "lease_expires_at": UNCLAIMED, "attempts": 0, "missing_outputs": [f"/lake/{i}/a"]}
+        for i in range(2)
+    ])
+    first = await db.claim_work_unit("worker-1", 60, 3)
+    assert first["path"] == "/lake/0" and first["status"] == UNIT_CLAIMED and first["attempts"] == 1, first
+    assert first["owner"] == "worker-1" and first["missing_outputs"] == ["/lake/0/a"], first
+    second = await db.claim_work_unit("worker-2", -1, 3)
+    assert second["path"] == "/lake/1", second
+    assert not await db.update_work_unit(first["_id"], "worker-2", {"status": UNIT_DONE})
+
+    # The second lease has expired, so the unit is claimed again, until it was tried max_attempts times
+    again = await db.claim_work_unit("worker-1", 60, 3)
+    assert again["_id"] == second["_id"] and again["attempts"] == 2, again
+    assert await db.claim_work_unit("worker-2", 60, 3) is None
+    assert await db.update_work_unit(first["_id"], "worker-1", {"status": UNIT_DONE, "counts": {"errors": 1}})
+
+    units = await db.find_work_units(scan_id)
+    assert [(unit["status"], unit["owner"]) for unit in units] == [(UNIT_DONE, "worker-1"), (UNIT_CLAIMED, "worker-1")]
+    assert units[0]["counts"] == {"errors": 1} and "missing_outputs" not in units[0], units[0]
+    await db.delete_work_units(scan_id)
+    assert await db.find_work_units(scan_id) == []
+
+
+@check
+async def hot_queries_use_indexes(db: StorageBackend):
+    await db.bootstrap()
+    results = await db.explain_hot_queries()
+    failing = [result for result in results if not result["index_scan"]]
+    assert results and not failing, failing
+
+
+async def _open(backend: str, workdir: str) -> StorageBackend:
+    if backend == STORAGE_MONGO:
+        from db_handler import DatabaseHandler
+        db = DatabaseHandler(db_name=f"{config.DB_NAME}_conformance_{os.getpid()}")
+    elif backend == STORAGE_SQLITE:
+        from sqlite_handler import SQLiteDatabaseHandler
+        db = SQLiteDatabaseHandler(os.path.join(workdir, "conformance.db"))
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+    await db.initialize()
+    return db
+
+
+async def _discard(backend: str, db: StorageBackend) -> None:
+    if backend == STORAGE_MONGO:
+        await db.database.client.drop_database(db.database.name)
+    await db.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _mongo_unreachable() -> str:
+    """Why MONGO_URI cannot be used, or an empty string if a server answers there"""
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    client = MongoClient(config.MONGO_URI, serverSelectionTimeoutMS=MONGO_PROBE_TIMEOUT_MS)
+    try:
+        client.admin.command("ping")
+        return ""
+    except PyMongoError as e:
+        return f"MongoDB unreachable at {config.MONGO_URI}: {e}"
+    finally:
+        client.close()
+
+
+@pytest.fixture(params=[STORAGE_SQLITE, STORAGE_MONGO])
+def backend(request):
+    if request.param == STORAGE_MONGO and _mongo_unreachable():
+        pytest.skip(_mongo_unreachable())
+    return request.param
+
+
+@pytest.mark.parametrize("check", CHECKS, ids=lambda function: function.__name__)
+def test_backend_conforms(backend, check, tmp_path):
+    async def run():
+        db = await _open(backend, str(tmp_path))
+        try:
+            await check(db)
+        finally:
+            await _discard(backend, db)
+    asyncio.run(run())
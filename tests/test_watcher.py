@@ -0,0 +1,73 @@
+"""Watch mode: inotify queues per top-level directory and the changes they report"""
+import sys
+import config
+import asyncio
+import pytest
+
+from db_handler import db_handler
+from watcher import IN_Q_OVERFLOW, WatchService
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+
+
+@pytest.fixture
+def watched(lake, monkeypatch):
+    monkeypatch.setattr(config, "WATCH_RESCAN_ON_START", False)
+    monkeypatch.setattr(config, "WATCH_DEBOUNCE_SECONDS", 0.05)
+    for path in ("top.txt", "a/1.txt", "a/deep/2.txt", "b/3.txt"):
+        lake.write(path)
+    return lake
+
+
+async def _until(condition, timeout=10):
+    for _ in range(int(timeout / 0.05)):
+        if await condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("condition not met in time")
+
+
+def test_overflow_rescans_only_the_directory_of_its_queue(watched):
+    root = str(watched.source)
+
+    async def run():
+        service = WatchService()
+        await service.start(root)
+        try:
+            queues = {directory for _, directory in service._queues.values()}
+            assert queues == {root, f"{root}/a", f"{root}/b"}, queues
+            queue_of_a = service._queue_of[f"{root}/a"]
+            queue_of_a.read_events = lambda: [(-1, IN_Q_OVERFLOW, 0, "")]
+            service._on_readable(queue_of_a)
+            assert service._new_directories == {f"{root}/a"}
+            await _until(lambda: _status(f"{root}/a/deep/2.txt"))
+            assert await _status(f"{root}/b/3.txt") is None
+        finally:
+            await service.stop()
+        assert not service._queues
+
+    watched.run(run)
+
+
+def test_top_level_directories_beyond_the_limit_share_the_root_queue(watched, monkeypatch):
+    monkeypatch.setattr(config, "WATCH_MAX_QUEUES", 2)
+    root = str(watched.source)
+
+    async def run():
+        service = WatchService()
+        await service.start(root)
+        try:
+            assert len(service._queues) == 2
+            shared = [top for top in ("a", "b") if service._queue_of[f"{root}/{top}"] is service._queue_of[root]]
+            assert len(shared) == 1, shared
+            (watched.source / shared[0] / "new.txt").write_text("new")
+            await _until(lambda: _status(f"{root}/{shared[0]}/new.txt"))
+        finally:
+            await service.stop()
+
+    watched.run(run)
+
+
+async def _status(path):
+    record = await db_handler.get_processed_file(path)
+    return record and record["status"]
@@ -0,0 +1,74 @@
+"""Partitioned scans: planning work units and running them on a worker"""
+import os
+import utils
+import config
+import asyncio
+import pytest
+
+from datetime import datetime, timedelta
+from db_handler import db_handler
+from scan_report import ScanReport, STATUS_COMPLETED, UNIT_SEQ_STRIDE
+from storage import UNIT_CLAIMED
+from work_units import WorkUnitWorker, covering_unit, plan_work_units, run_partitioned_scan
+
+
+@pytest.fixture
+def tree(lake, monkeypatch):
+    monkeypatch.setattr(config, "WORK_UNIT_POLL_INTERVAL", 0.05)
+    for path in ("top.txt", "x/a.txt", "x/y/b.txt", "z/c.txt"):
+        lake.write(path)
+    return lake
+
+
+def test_plan_work_units_splits_at_depth(tree):
+    root = str(tree.source)
+    assert plan_work_units(root, 1) == [(root, False), (os.path.join(root, "x"), True), (os.path.join(root, "z"), True)]
+    assert plan_work_units(root, 0) == [(root, True)]
+    assert covering_unit(os.path.join(root, "x", "y", "b.txt"), root, 1) == os.path.join(root, "x")
+    assert covering_unit(os.path.join(root, "top.txt"), root, 1) == root
+
+
+async def _partitioned_scan(root: str, report: ScanReport = None) -> ScanReport:
+    worker = WorkUnitWorker()
+    worker.start()
+    try:
+        return await asyncio.wait_for(
+            run_partitioned_scan(report or ScanReport(root, options={"partition_depth": 1, "sync_outputs": False})), 30
+        )
+    finally:
+        await worker.stop()
+
+
+def test_units_name_outputs_by_path_without_changing_the_setting(tree, monkeypatch):
+    monkeypatch.setattr(config, "OUTPUT_NAMING", utils.NAMING_SEQUENTIAL)
+
+    report = tree.run(_partitioned_scan, str(tree.source))
+    assert report.status == STATUS_COMPLETED
+    assert report.counts["processed_files"] == 4, report.counts
+    assert report.summary["work_units"]["total"] == 3, report.summary
+    assert config.OUTPUT_NAMING == utils.NAMING_SEQUENTIAL
+    # path_hash names: <name>_<16 hex digits>.txt
+    assert len(tree.outputs()) == 4 and all(len(name.rsplit("_", 1)[-1]) == 20 for name in tree.outputs()), tree.outputs()
+
+
+def test_resumed_scan_plans_units_again_if_they_were_not_saved(tree):
+    root = str(tree.source)
+
+    async def run():
+        interrupted = ScanReport(root, options={"partition_depth": 1, "sync_outputs": False})
+        await interrupted.start()
+        # Interrupted while inserting its units: one got in, claimed by a worker that died with it
+        await db_handler.insert_work_units([{
+            "scan_id": interrupted.scan_id, "path": root, "recursive": False, "status": UNIT_CLAIMED,
+            "owner": "gone", "lease_expires_at": datetime.utcnow() + timedelta(hours=1), "attempts": 1,
+            "seq_base": UNIT_SEQ_STRIDE, "missing_outputs": []
+        }])
+        interrupted.abandon()
+        report = ScanReport.from_header(await db_handler.find_scan_header(str(interrupted.scan_id)))
+        return await _partitioned_scan(root, report)
+
+    report = tree.run(run)
+    assert report.status == STATUS_COMPLETED
+    assert report.summary["work_units"]["total"] == 3, report.summary
+    assert report.counts["processed_files"] == 4 and report.counts["deleted_files"] == 0, report.counts
+
@@ -0,0 +1,88 @@
+"""Write-behind batching of file record writes (db_handler.WriteBatcher)"""
+import os
+import config
+import asyncio
+
+from types import SimpleNamespace
+from pymongo.errors import BulkWriteError
+from db_handler import WriteBatcher, db_handler
+from files_processing import process_directory
+
+
+class FakeCollection:
+    """Records the bulk_write calls of a WriteBatcher, failing the items at fail_indexes"""
+
+    def __init__(self, fail_indexes=()):
+        self.batches = []
+        self.fail_indexes = fail_indexes
+
+    async def bulk_write(self, operations, ordered=True):
+        self.batches.append((len(operations), ordered))
+        if self.fail_indexes:
+            raise BulkWriteError({"writeErrors": [{"index": index, "errmsg": "duplicate key"}
+                                                  for index in self.fail_indexes]})
+        return SimpleNamespace(inserted_count=0, modified_count=0, upserted_count=len(operations))
+
+
+def _record(name: str) -> dict:
+    return {"file_path": f"/lake/{name}", "status": config.STATUS_PROCESSED, "size": 1}
+
+
+def test_flushes_full_batches_unordered_and_the_rest_on_close():
+    collection = FakeCollection()
+
+    async def run():
+        async with WriteBatcher(collection, batch_size=3, flush_interval=60) as batcher:
+            for index in range(7):
+                await batcher.upsert(_record(f"{index}.txt"))
+            assert collection.batches == [(3, False), (3, False)]
+        return batcher
+
+    batcher = asyncio.run(run())
+    assert collection.batches == [(3, False), (3, False), (1, False)]
+    assert batcher.round_trips == 3 and not batcher.errors
+
+
+def test_flushes_after_the_interval_without_a_full_batch():
+    collection = FakeCollection()
+
+    async def run():
+        async with WriteBatcher(collection, batch_size=100, flush_interval=0.05) as batcher:
+            await batcher.update_status("/lake/a.txt", config.STATUS_DELETED)
+            await asyncio.sleep(0.3)
+            assert collection.batches == [(1, False)]
+
+    asyncio.run(run())
+
+
+def test_failed_items_are_reported_by_path():
+    collection = FakeCollection(fail_indexes=[1])
+
+    async def run():
+        async with WriteBatcher(collection, batch_size=10, flush_interval=60) as batcher:
+            for name in ("a.txt", "b.txt", "c.txt"):
+                await batcher.upsert(_record(name))
+        return batcher
+
+    batcher = asyncio.run(run())
+    assert [error["path"] for error in batcher.errors] == ["/lake/b.txt"]
+    assert "duplicate key" in batcher.errors[0]["error"]
+
+
+def test_scan_writes_every_record_through_small_batches(lake, monkeypatch):
+    monkeypatch.setattr(config, "BULK_WRITE_BATCH_SIZE", 2)
+    paths = [lake.write(f"dir{index % 2}/file{index}.txt", str(index)) for index in range(5)]
+
+    async def run():
+        await process_directory(str(lake.source))
+        os.remove(paths[0])
+        await process_directory(str(lake.source))
+        # A file that comes back updates its record instead of adding another
+        lake.write("dir0/file0.txt", "back")
+        report = await process_directory(str(lake.source))
+        return report, await db_handler.get_all_processed_files()
+
+    report, records = lake.run(run)
+    assert report.counts["processed_files"] == 1 and not report.counts["errors"], report.counts
+    assert sorted(record["file_path"] for record in records) == sorted(paths)
+    assert {record["status"] for record in records} == {config.STATUS_PROCESSED}
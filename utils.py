@@ -2,15 +2,90 @@ import os
 import re
 import shutil
 import config
+import hashlib
+import asyncio
 import logging
+import metrics
+import threading
 import db_handler
+import fingerprint
 
-from typing import Dict
+from typing import Dict, Iterable, List
 from datetime import datetime
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+_fs_executor = None
+_fs_executor_lock = threading.Lock()
+
+# Values of OUTPUT_NAMING
+NAMING_SEQUENTIAL = "sequential"     # name.ext, then name_1.ext, name_2.ext, ...
+NAMING_PATH_HASH = "path_hash"       # name_<hash of the relative source path>.ext
+NAMING_CONTENT_HASH = "content_hash" # name_<hash of the file content>.ext
+
+
+def get_fs_executor() -> ThreadPoolExecutor:
+    """Thread pool for blocking filesystem work, sized by FS_WORKER_THREADS"""
+    global _fs_executor
+    with _fs_executor_lock:
+        if _fs_executor is None:
+            _fs_executor = ThreadPoolExecutor(
+                max_workers=max(2, config.FS_WORKER_THREADS),
+                thread_name_prefix="fs-worker"
+            )
+    return _fs_executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the filesystem thread pool without stalling the event loop"""
+    submitted = perf_counter()
+
+    def call():
+        metrics.FS_WAIT_SECONDS.observe(perf_counter() - submitted)
+        return func(*args, **kwargs)
+
+    return await asyncio.get_running_loop().run_in_executor(get_fs_executor(), call)
+
+
+def remove_files(file_paths: List[str]) -> int:
+    """Unlink a batch of files, ignoring those already gone. Blocking, returns how many were removed.
+
+    The names of the files are released from the output name index.
+    """
+    removed = 0
+    gone = []
+    for file_path in file_paths:
+        try:
+            os.unlink(file_path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove {file_path}: {e}")
+            continue
+        gone.append(file_path)
+    output_names.release(gone)
+    return removed
+
+
+async def remove_files_in_batches(file_paths: List[str], batch_size: int) -> int:
+    """Unlink files in parallel batches on the filesystem thread pool"""
+    batch_size = max(1, batch_size)
+    counts = await asyncio.gather(*(
+        run_blocking(remove_files, file_paths[start:start + batch_size])
+        for start in range(0, len(file_paths), batch_size)
+    ))
+    return sum(counts)
+
+
+def is_path_below(path: str, root: str) -> bool:
+    """True if path is root itself or anywhere below it"""
+    root = root.rstrip(os.sep)
+    return path == root or path.startswith(root + os.sep)
+
 
 def sanitize_path_component(component):
     component = component.replace(os.path.sep, '_')
@@ -20,7 +95,97 @@ def sanitize_path_component(component):
     return sanitized if sanitized else "invalid_component"
 
 
-def generate_unique_output_path(original_file_path, target_base_dir):
+class OutputNameIndex:
+    """In-memory index of the output names in use, so allocating a free name never probes the disk.
+
+    Each output directory is listed once, the first time a name is allocated
+    in it (or seeded by the caller), and every name handed out afterwards is
+    recorded with the source it was handed to. For each base name the next
+    counter to try is remembered, so thousands of files with the same name
+    are not each checked against all earlier ones. Allocation is atomic
+    across threads. Names of removed outputs are released, and every scan
+    starts from a fresh listing, so the index follows what is on disk.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._taken = {}          # output directory -> {name in use: source it was handed to, None if listed}
+        self._next_counter = {}   # (output directory, base name) -> next counter to try
+
+    def _names_in(self, directory: str) -> dict:
+        names = self._taken.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as iterator:
+                    names = dict.fromkeys(entry.name for entry in iterator)
+            except FileNotFoundError:
+                names = {}
+            self._taken[directory] = names
+        return names
+
+    def seed(self, directory: str, names: Iterable[str]) -> None:
+        """Replace what is known about directory, e.g. with a listing the caller already made"""
+        with self._lock:
+            self._taken[directory] = dict.fromkeys(names)
+            self._next_counter = {key: value for key, value in self._next_counter.items() if key[0] != directory}
+
+    def release(self, paths: Iterable[str]) -> None:
+        """Forget the names of outputs that were removed, so they are handed out again"""
+        with self._lock:
+            directories = set()
+            for path in paths:
+                directory, filename = os.path.split(path)
+                names = self._taken.get(directory)
+                if names is not None and filename in names:
+                    del names[filename]
+                    directories.add(directory)
+            if directories:
+                # A freed name_<n> may lie below the counter remembered for its base name
+                self._next_counter = {key: value for key, value in self._next_counter.items()
+                                      if key[0] not in directories}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._taken.clear()
+            self._next_counter.clear()
+
+    def reuse(self, path: str, source: str) -> bool:
+        """Keep path for source, whose record points at it; False if it was handed to another source meanwhile"""
+        directory, filename = os.path.split(path)
+        with self._lock:
+            names = self._names_in(directory)
+            if names.get(filename, source) not in (None, source):
+                return False
+            names[filename] = source
+        return True
+
+    def allocate(self, directory: str, stem: str, ext: str, source: str = None) -> str:
+        """Reserve and return a free path for stem + ext in directory, adding _<counter> when taken"""
+        with self._lock:
+            names = self._names_in(directory)
+            filename = f"{stem}{ext}"
+            if filename in names:
+                counter = self._next_counter.get((directory, stem), 1)
+                while f"{stem}_{counter}{ext}" in names:
+                    counter += 1
+                filename = f"{stem}_{counter}{ext}"
+                self._next_counter[(directory, stem)] = counter + 1
+            names[filename] = source
+        return os.path.join(directory, filename)
+
+
+output_names = OutputNameIndex()
+
+
+def generate_unique_output_path(original_file_path, target_base_dir, ext=None, naming=None):
+    """Pick a free output path in target_base_dir for a source file, named after its relative path.
+
+    With OUTPUT_NAMING=path_hash or content_hash the name also carries a
+    digest of the relative path or of the content, so it is stable across
+    scans; ``naming`` overrides OUTPUT_NAMING. ``ext`` replaces the source's
+    extension, e.g. ".md" for OCR output. Blocking when hashing content.
+    """
+    naming = naming or config.OUTPUT_NAMING
     source_base_dir = config.SOURCE_DATA_LAKE_DIR
 
     try:
@@ -30,42 +195,40 @@ def generate_unique_output_path(original_file_path, target_base_dir):
         relative_path = os.path.basename(original_file_path)
 
     relative_dir, filename = os.path.split(relative_path)
-    name, ext = os.path.splitext(filename)
+    name, source_ext = os.path.splitext(filename)
+    if ext is None:
+        ext = source_ext
 
     if relative_dir:
-        sanitized_dir_prefix = sanitize_path_component(relative_dir)
-        base_filename = f"{sanitized_dir_prefix}_{name}{ext}"
+        stem = f"{sanitize_path_component(relative_dir)}_{name}"
     else:
-        base_filename = filename
+        stem = name
 
-    # Check for existing files and add counter if needed
-    output_path = os.path.join(target_base_dir, base_filename)
-    counter = 1
-    while os.path.exists(output_path):
-        new_filename = f"{name}_{counter}{ext}"
-        if relative_dir:
-            new_filename = f"{sanitized_dir_prefix}_{new_filename}"
-        output_path = os.path.join(target_base_dir, new_filename)
-        counter += 1
+    if naming == NAMING_PATH_HASH:
+        stem = f"{stem}_{hashlib.blake2b(relative_path.encode(errors='surrogateescape'), digest_size=8).hexdigest()}"
+    elif naming == NAMING_CONTENT_HASH:
+        stem = f"{stem}_{get_file_hash(original_file_path, 'blake2b')[:16]}"
 
-    return output_path
+    return output_names.allocate(target_base_dir, stem, ext, original_file_path)
 
-def get_file_hash(file_path: str) -> str:
+def get_file_hash(file_path: str, algorithm: str = None) -> str:
     """Calculate file hash for change detection"""
-    hasher = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        buf = f.read(65536)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = f.read(65536)
-    return hasher.hexdigest()
+    return fingerprint.hash_stream(file_path, algorithm or config.HASH_ALGORITHM)
+
+
+def release_output_paths() -> None:
+    """Forget the output names handed out so far; output directories are listed again on next use"""
+    output_names.reset()
 
 
-def clean_output_folders(output_dir: str) -> None:
-    """Remove all contents of the output directory before starting a new scan"""
+def clean_output_folders(output_dir: str, keep: Iterable[str] = ()) -> None:
+    """Remove all contents of the output directory before starting a new scan, except JSON files and the names in keep"""
     try:
+        release_output_paths()
         if os.path.exists(output_dir):
             for item in os.listdir(output_dir):
+                if item in keep:
+                    continue
                 item_path = os.path.join(output_dir, item)
                 if os.path.isfile(item_path):
                     if not item.lower().endswith('.json'):
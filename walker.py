@@ -0,0 +1,146 @@
+import os
+import config
+import asyncio
+import logging
+import metrics
+import threading
+
+from time import perf_counter
+from collections import deque
+from typing import AsyncIterator, List, NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_walk_executor = None
+_walk_executor_lock = threading.Lock()
+
+
+class WalkEntry(NamedTuple):
+    """A file found by the walker, with the metadata of its single stat"""
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+class DirectoryListing(NamedTuple):
+    """One directory visited by the walker.
+
+    ``pruned`` listings were not read: the directory's mtime matched its
+    snapshot, so ``files`` is empty and ``subdirectories`` comes from the
+    snapshot. ``mtime_ns`` is only set when snapshots are in use and the
+    directory could be read.
+    """
+    path: str
+    mtime_ns: Optional[int]
+    files: List[WalkEntry]
+    subdirectories: List[str]
+    pruned: bool
+
+
+def _get_walk_executor() -> ThreadPoolExecutor:
+    global _walk_executor
+    with _walk_executor_lock:
+        if _walk_executor is None:
+            _walk_executor = ThreadPoolExecutor(
+                max_workers=max(1, config.WALKER_THREADS),
+                thread_name_prefix="walker"
+            )
+    return _walk_executor
+
+
+def scan_directory(directory: str, snapshots: Optional[dict] = None, prune: bool = False):
+    """List one directory and record how long it took. Blocking, see _list_directory."""
+    start = perf_counter()
+    listing, errors = _list_directory(directory, snapshots, prune)
+    metrics.WALK_SECONDS.labels("true" if listing.pruned else "false").observe(perf_counter() - start)
+    return listing, errors
+
+
+def _list_directory(directory: str, snapshots: Optional[dict], prune: bool):
+    """List one directory. Blocking.
+
+    Returns (listing, errors). Like os.walk, symlinked directories are not
+    descended into and files whose names start with IGNORED_PREFIXES are left
+    out. With ``snapshots`` the directory's mtime is recorded first, and with
+    ``prune`` a directory whose mtime matches a complete snapshot is not read.
+    """
+    files: List[WalkEntry] = []
+    subdirectories: List[str] = []
+    errors: List[dict] = []
+    mtime_ns = None
+    try:
+        if snapshots is not None:
+            # Stat before listing, so a change made during the listing shows up next time
+            mtime_ns = os.stat(directory).st_mtime_ns
+            snapshot = snapshots.get(directory)
+            if prune and snapshot is not None and snapshot.complete and snapshot.mtime_ns == mtime_ns:
+                subdirectories = [os.path.join(directory, name) for name in snapshot.subdirectories]
+                return DirectoryListing(directory, mtime_ns, files, subdirectories, True), errors
+
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirectories.append(entry.path)
+                        continue
+                    if entry.name.startswith(config.IGNORED_PREFIXES):
+                        continue
+                    st = entry.stat()
+                    files.append(WalkEntry(entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+                except OSError as e:
+                    errors.append({"path": entry.path, "error": f"Could not stat file: {e}"})
+    except OSError as e:
+        logger.warning(f"Could not list directory {directory}: {e}")
+        mtime_ns = None # Never snapshot a directory that could not be read
+        errors.append({"path": directory, "error": f"Could not list directory: {e}"})
+    return DirectoryListing(directory, mtime_ns, files, subdirectories, False), errors
+
+
+async def walk_directories(root: str, errors: Optional[list] = None, snapshots: Optional[dict] = None,
+                           prune: bool = False) -> AsyncIterator[DirectoryListing]:
+    """Walk root on the walker thread pool, yielding each directory as soon as it is listed.
+
+    At most WALKER_MAX_IN_FLIGHT directories are listed at once, and no new
+    listing starts while the consumer is busy with the last one, so a slow
+    consumer throttles the walk. Listing and stat errors are appended to
+    ``errors`` when given. See scan_directory for ``snapshots`` and ``prune``.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_walk_executor()
+    max_in_flight = max(1, config.WALKER_MAX_IN_FLIGHT)
+    to_scan = deque([root])
+    in_flight = set()
+
+    try:
+        while to_scan or in_flight:
+            while to_scan and len(in_flight) < max_in_flight:
+                # Depth first keeps the backlog of directories small on wide trees
+                in_flight.add(loop.run_in_executor(executor, scan_directory, to_scan.pop(), snapshots, prune))
+
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                listing, dir_errors = future.result()
+                to_scan.extend(listing.subdirectories)
+                if errors is not None:
+                    errors.extend(dir_errors)
+                yield listing
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+async def walk(root: str, errors: Optional[list] = None) -> AsyncIterator[List[WalkEntry]]:
+    """Walk root like walk_directories(), yielding the files of each directory that has any"""
+    async for listing in walk_directories(root, errors):
+        if listing.files:
+            yield listing.files
+
+
+async def walk_entries(root: str, errors: Optional[list] = None) -> AsyncIterator[WalkEntry]:
+    """Same as walk(), one entry at a time"""
+    async for files in walk(root, errors):
+        for entry in files:
+            yield entry
@@ -0,0 +1,343 @@
+import os
+import errno
+import ctypes
+import struct
+import config
+import asyncio
+import logging
+import ctypes.util
+
+from typing import List, Tuple
+from utils import is_path_below
+from scan_jobs import scan_jobs
+from scan_report import ScanReport
+from files_processing import changes_root, process_changes, process_directory
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+_EVENT_HEADER = struct.Struct("iIII")
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API, reading events from a non-blocking fd"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        # Fails harmlessly when the kernel already dropped the watch
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> List[tuple]:
+        """Drain the queued events as (wd, mask, cookie, name) tuples"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_BUFFER_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class WatchService:
+    """Processes changes under the source tree as inotify reports them, instead of waiting for /scan.
+
+    Every directory below the root gets a watch. Events are coalesced into a
+    set of changed files, created directories and removed directories, and
+    applied once no event arrived for WATCH_DEBOUNCE_SECONDS (or at the latest
+    WATCH_MAX_DELAY_SECONDS after the first one). Changed files go through
+    process_changes(); new directories, which may already hold files, are
+    rescanned with process_directory().
+
+    Each top-level directory is watched through an inotify queue of its own,
+    up to WATCH_MAX_QUEUES of them, so an overflow only rescans the directory
+    whose queue overflowed; the root's queue holds the root itself and the
+    top-level directories beyond that limit, and its overflow rescans the
+    whole root. Rescans list every directory (``deep_verify``), as directory
+    snapshots do not show files changed in place; on startup the whole root
+    is rescanned that way.
+
+    Each batch is applied under the "scan" lease, so it never overlaps a scan
+    or the batch of another worker watching the same tree; while the lease is
+    held elsewhere the batch waits, merged with the events that follow.
+    """
+
+    def __init__(self):
+        self.root = None
+        self._queues = {}        # inotify fd -> (Inotify, directory rescanned when its queue overflows)
+        self._queue_of = {}      # root or top-level directory -> Inotify watching it
+        self._watches = {}       # (inotify fd, wd) -> directory
+        self._task = None
+        self._wake = None
+        self._changed_files = set()
+        self._new_directories = set()
+        self._removed_directories = set()
+        self._first_event = None
+        self._last_event = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self, root: str) -> None:
+        loop = asyncio.get_running_loop()
+        self.root = root.rstrip(os.sep) or os.sep
+        self._wake = asyncio.Event()
+        self._add_queue(self.root, Inotify())
+        self._register(*await loop.run_in_executor(None, self._watch_tree, self.root))
+        logger.info(f"Watching {len(self._watches)} directories below {self.root} "
+                    f"through {len(self._queues)} inotify queues")
+
+        if config.WATCH_RESCAN_ON_START:
+            # Catch up on whatever changed while nothing was watching
+            self._new_directories.add(self.root)
+            self._note_event(loop.time() - config.WATCH_DEBOUNCE_SECONDS)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for fd in list(self._queues):
+            self._close_queue(fd)
+        self._queue_of = {}
+        self._watches = {}
+        logger.info("Stopped watching the source tree")
+
+    def _add_queue(self, directory: str, inotify: Inotify) -> None:
+        self._queues[inotify.fd] = (inotify, directory)
+        self._queue_of[directory] = inotify
+        asyncio.get_running_loop().add_reader(inotify.fd, self._on_readable, inotify)
+
+    def _close_queue(self, fd: int) -> None:
+        inotify, _ = self._queues.pop(fd)
+        asyncio.get_running_loop().remove_reader(fd)
+        inotify.close()
+
+    def _queue_for(self, directory: str, created: dict) -> Inotify:
+        """The inotify queue of the top-level directory holding directory, a new one in created if it has none yet"""
+        relative = os.path.relpath(directory, self.root)
+        root_queue = self._queue_of[self.root]
+        if relative == os.curdir:
+            return root_queue
+        top = os.path.join(self.root, relative.split(os.sep, 1)[0])
+        inotify = self._queue_of.get(top) or created.get(top)
+        if inotify is None:
+            inotify = root_queue
+            if len(self._queues) + len(created) < config.WATCH_MAX_QUEUES:
+                try:
+                    inotify = Inotify()
+                except OSError as e:
+                    logger.warning(f"Could not create an inotify queue for {top}, watching it with the root's: {e}")
+            created[top] = inotify
+        return inotify
+
+    def _watch_tree(self, root: str) -> Tuple[List[tuple], dict]:
+        """Add a watch to root and every directory below it. Blocking.
+
+        Returns the (inotify, wd, path) of each watch, and the queues created
+        for new top-level directories (the root's where none could be).
+        """
+        watches = []
+        created = {}
+        for directory, _, _ in os.walk(root):
+            inotify = self._queue_for(directory, created)
+            try:
+                watches.append((inotify, inotify.add_watch(directory, WATCH_MASK), directory))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.error(f"Out of inotify watches at {directory}; raise fs.inotify.max_user_watches")
+                    break
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.warning(f"Could not watch {directory}: {e}")
+        return watches, created
+
+    def _register(self, watches: List[tuple], created: dict) -> None:
+        root_queue = self._queue_of[self.root]
+        for directory, inotify in created.items():
+            if inotify is root_queue:
+                self._queue_of[directory] = inotify
+            else:
+                self._add_queue(directory, inotify)
+        for inotify, wd, directory in watches:
+            self._watches[(inotify.fd, wd)] = directory
+
+    def _forget_tree(self, root: str) -> None:
+        """Drop the watches of a directory that was moved away or deleted, and its queue if it has one"""
+        for (fd, wd), directory in list(self._watches.items()):
+            if is_path_below(directory, root):
+                self._queues[fd][0].rm_watch(wd)
+                del self._watches[(fd, wd)]
+        inotify = self._queue_of.pop(root, None) if root != self.root else None
+        if inotify is not None and inotify is not self._queue_of[self.root]:
+            self._close_queue(inotify.fd)
+
+    def _note_event(self, now: float) -> None:
+        if self._first_event is None:
+            self._first_event = now
+        self._last_event = now
+        self._wake.set()
+
+    def _on_readable(self, inotify: Inotify) -> None:
+        now = asyncio.get_running_loop().time()
+        for wd, mask, _, name in inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflowed = self._queues[inotify.fd][1]
+                logger.warning(f"inotify queue of {overflowed} overflowed, rescanning it")
+                self._new_directories.add(overflowed)
+                self._note_event(now)
+                continue
+
+            key = (inotify.fd, wd)
+            directory = self._watches.get(key)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[key]
+                continue
+            if mask & IN_DELETE_SELF:
+                if directory == self.root:
+                    logger.warning(f"Watched root {self.root} was deleted")
+                continue
+            if not name:
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._new_directories.add(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget_tree(path)
+                    self._removed_directories.add(path)
+                else:
+                    continue
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+                if name.startswith(config.IGNORED_PREFIXES):
+                    continue
+                self._changed_files.add(path)
+            else:
+                continue
+            self._note_event(now)
+
+    async def _wait_until_quiet(self) -> None:
+        """Wait for WATCH_DEBOUNCE_SECONDS without events, but no longer than WATCH_MAX_DELAY_SECONDS overall"""
+        loop = asyncio.get_running_loop()
+        while True:
+            due = min(self._last_event + config.WATCH_DEBOUNCE_SECONDS,
+                      self._first_event + config.WATCH_MAX_DELAY_SECONDS)
+            delay = due - loop.time()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            await self._wait_until_quiet()
+            self._wake.clear()
+            changed_files, self._changed_files = self._changed_files, set()
+            new_directories, self._new_directories = self._new_directories, set()
+            removed_directories, self._removed_directories = self._removed_directories, set()
+            self._first_event = self._last_event = None
+            try:
+                held = await scan_jobs.hold_for_changes()
+            except Exception as e:
+                logger.error(f"Could not take the scan lease for watched changes: {e}")
+                held = False
+            if not held:
+                # A scan, or another worker's batch, is updating the tracked state: try again later
+                await self._retry_later(changed_files, new_directories, removed_directories)
+                continue
+            completed = False
+            try:
+                await self._apply(changed_files, new_directories, removed_directories)
+            except Exception as e:
+                logger.error(f"Error applying watched changes: {e}", exc_info=True)
+            finally:
+                completed = await scan_jobs.release_for_changes()
+            if not completed:
+                # The lease was lost and the batch cancelled: apply it again once the lease is free
+                await self._retry_later(changed_files, new_directories, removed_directories)
+
+    async def _retry_later(self, changed_files: set, new_directories: set, removed_directories: set) -> None:
+        """Put a batch back with the pending events and apply it after WATCH_LEASE_RETRY_SECONDS"""
+        self._changed_files |= changed_files
+        self._new_directories |= new_directories
+        self._removed_directories |= removed_directories
+        await asyncio.sleep(config.WATCH_LEASE_RETRY_SECONDS)
+        self._note_event(asyncio.get_running_loop().time() - config.WATCH_DEBOUNCE_SECONDS)
+
+    async def _apply(self, changed_files: set, new_directories: set, removed_directories: set) -> None:
+        loop = asyncio.get_running_loop()
+        # Rescan only the outermost new directories; their files need no separate handling
+        rescans = [
+            directory for directory in sorted(new_directories)
+            if not any(other != directory and is_path_below(directory, other) for other in new_directories)
+        ]
+        changed_files = [
+            path for path in changed_files
+            if not any(is_path_below(path, directory) for directory in rescans)
+        ]
+
+        # Created here so that losing the scan lease cancels them
+        reports = []
+        if changed_files or removed_directories:
+            report = ScanReport(changes_root(changed_files, removed_directories), "watch")
+            scan_jobs.track_changes(report)
+            reports.append(await process_changes(changed_files, sorted(removed_directories), report=report))
+        for directory in rescans:
+            # Watch first, so nothing created during the rescan is missed
+            self._register(*await loop.run_in_executor(None, self._watch_tree, directory))
+            # Snapshots would skip directories whose files changed in place while events were lost
+            report = ScanReport(directory, "watch", {"deep_verify": True, "sync_outputs": False})
+            scan_jobs.track_changes(report)
+            reports.append(await process_directory(directory, deep_verify=True, trigger="watch", report=report))
+
+        for report in reports:
+            counts = report.counts
+            logger.info(f"Applied watched changes: {counts['processed_files']} processed, "
+                        f"{counts['deleted_files']} deleted, {counts['errors']} errors")
+
+
+watch_service = WatchService()
@@ -0,0 +1,283 @@
+import os
+import utils
+import config
+import asyncio
+import logging
+import leases
+import output_sync
+
+from typing import List, Optional, Tuple
+from datetime import datetime
+from db_handler import db_handler
+from files_processing import finish_partitioned_scan, process_work_unit
+from scan_report import (
+    ScanReport, UnitReport, UNIT_SEQ_STRIDE, STATUS_CANCELLED, STATUS_COMPLETED, STATUS_FAILED, STATUS_RUNNING
+)
+from storage import UNCLAIMED, UNIT_CANCELLED, UNIT_CLAIMED, UNIT_DONE, UNIT_FAILED, UNIT_FINISHED, UNIT_PENDING
+
+logger = logging.getLogger(__name__)
+
+# Work unit status for each final status of its report
+_UNIT_STATUS = {STATUS_COMPLETED: UNIT_DONE, STATUS_CANCELLED: UNIT_CANCELLED}
+
+
+def _subdirectories(directory: str) -> List[str]:
+    """Subdirectories the walker would descend into. Blocking."""
+    try:
+        with os.scandir(directory) as iterator:
+            return sorted(entry.path for entry in iterator if entry.is_dir(follow_symlinks=False))
+    except OSError:
+        # The directory's own unit lists it again and reports the error
+        return []
+
+
+def plan_work_units(root: str, depth: int) -> List[Tuple[str, bool]]:
+    """Split root into (path, recursive) work units. Blocking.
+
+    Directories less than ``depth`` levels below root are units of their own
+    files only; those ``depth`` levels below are units of their whole subtree.
+    """
+    units = []
+    level = [root]
+    for _ in range(depth):
+        units.extend((directory, False) for directory in level)
+        level = [subdirectory for directory in level for subdirectory in _subdirectories(directory)]
+    units.extend((directory, True) for directory in level)
+    return units
+
+
+def covering_unit(file_path: str, root: str, depth: int) -> str:
+    """Path of the work unit a file below root belongs to"""
+    directory = os.path.dirname(file_path)
+    relative = os.path.relpath(directory, root)
+    parts = [] if relative == os.curdir else relative.split(os.sep)
+    if len(parts) < depth:
+        return directory
+    return os.path.join(root, *parts[:depth])
+
+
+def _add_up(report: ScanReport, units: List[dict]) -> None:
+    """Show the units' counts as the scan's progress"""
+    counts = {section: 0 for section in report.counts}
+    for unit in units:
+        for section, count in (unit.get("counts") or {}).items():
+            counts[section] = counts.get(section, 0) + count
+    report.counts = counts
+    report.files_discovered = sum(unit.get("files_discovered", 0) for unit in units)
+    report.walk_finished = all(unit["status"] in UNIT_FINISHED for unit in units)
+
+
+def _units_summary(units: List[dict]) -> dict:
+    workers = {}
+    for unit in units:
+        if unit.get("owner"):
+            workers[unit["owner"]] = workers.get(unit["owner"], 0) + 1
+    return {
+        "total": len(units),
+        **{status: sum(1 for unit in units if unit["status"] == status) for status in UNIT_FINISHED},
+        "workers": [{"worker": owner, "units": count} for owner, count in sorted(workers.items())]
+    }
+
+
+async def _wait_for_units(report: ScanReport) -> List[dict]:
+    """Poll the scan's units until all have finished, passing on a cancellation and giving up on abandoned units"""
+    cancel_requested = False
+    while True:
+        units = await db_handler.find_work_units(report.scan_id)
+        await report.poll_cancel()
+        if report.cancelled and not cancel_requested:
+            # Workers running a unit of this scan see the flag when they renew their lease
+            await db_handler.update_scan_header(report.scan_id, {"cancel_requested": True})
+            cancel_requested = True
+        now = datetime.utcnow()
+        for unit in units:
+            if unit["status"] == UNIT_PENDING and report.cancelled:
+                if await db_handler.update_work_unit(unit["_id"], None, {"status": UNIT_CANCELLED}):
+                    unit["status"] = UNIT_CANCELLED
+            elif (unit["status"] in (UNIT_PENDING, UNIT_CLAIMED) and unit["attempts"] >= config.WORK_UNIT_MAX_ATTEMPTS
+                  and unit["lease_expires_at"] < now):
+                error = f"Work unit given up after {unit['attempts']} attempts"
+                if await db_handler.update_work_unit(unit["_id"], unit["owner"], {"status": UNIT_FAILED, "error": error}):
+                    unit.update(status=UNIT_FAILED, error=error)
+                    logger.error(f"{error}: {unit['path']}")
+        _add_up(report, units)
+        await report.flush()
+        if all(unit["status"] in UNIT_FINISHED for unit in units):
+            return units
+        await asyncio.sleep(config.WORK_UNIT_POLL_INTERVAL)
+
+
+async def _plan_units(report: ScanReport, root: str, depth: int) -> None:
+    """Reconcile OUTPUT_DIR and insert the scan's work units, then mark them planned on the header"""
+    missing_outputs = frozenset()
+    if report.options.get("sync_outputs") and config.OUTPUT_SYNC_MODE == output_sync.OUTPUT_SYNC_INCREMENTAL:
+        missing_outputs, report.summary["output_sync"] = await output_sync.reconcile_outputs(config.OUTPUT_DIR)
+    missing_by_unit = {}
+    for file_path in missing_outputs:
+        missing_by_unit.setdefault(covering_unit(file_path, root, depth), []).append(file_path)
+    units = [
+        {
+            "scan_id": report.scan_id,
+            "path": path,
+            "recursive": recursive,
+            "status": UNIT_PENDING,
+            "owner": None,
+            "lease_expires_at": UNCLAIMED,
+            "attempts": 0,
+            "seq_base": (index + 1) * UNIT_SEQ_STRIDE,
+            "missing_outputs": missing_by_unit.get(path, [])
+        }
+        for index, (path, recursive) in enumerate(await utils.run_blocking(plan_work_units, root, depth))
+    ]
+    await db_handler.insert_work_units(units)
+    # Until this is saved, a resumed scan plans its units again
+    await db_handler.update_scan_header(report.scan_id, {"summary": report.summary, "units_planned": True})
+    logger.info(f"Scan {report.scan_id} split into {len(units)} work units")
+
+
+async def _units_planned(report: ScanReport) -> bool:
+    header = await db_handler.find_scan_header(str(report.scan_id))
+    return header is not None and bool(header.get("units_planned"))
+
+
+async def run_partitioned_scan(report: ScanReport) -> ScanReport:
+    """Coordinate a scan split into work units that every worker process, on every node, claims and runs.
+
+    Reconciles OUTPUT_DIR, plans the units and waits for them, adding up
+    their counts as the scan's progress; then finish_partitioned_scan marks
+    files deleted whose directory is gone. A resumed scan only waits, as its
+    units are already in the database, unless it was interrupted before they
+    were all inserted: then whatever was inserted is dropped and they are
+    planned again. A scan without units fails instead of finishing, as it
+    would find every tracked file uncovered and mark it deleted.
+    """
+    root = report.directory
+    depth = report.options["partition_depth"]
+    await report.start()
+    try:
+        planned = report.resumed and await _units_planned(report)
+        if report.resumed and not planned:
+            logger.warning(f"Scan {report.scan_id} was interrupted while planning its work units, planning them again")
+            await db_handler.delete_work_units(report.scan_id)
+            await db_handler.delete_scan_entries(report.scan_id, 0)
+        if not planned:
+            await _plan_units(report, root, depth)
+
+        units = await _wait_for_units(report)
+    except asyncio.CancelledError:
+        report.abandon()
+        raise
+
+    if not units:
+        logger.error(f"Scan {report.scan_id} has no work units, not finishing it")
+        await report.add("errors", {"path": root, "error": "Partitioned scan has no work units"})
+        await report.finish(STATUS_FAILED)
+        return report
+
+    unit_paths = {unit["path"] for unit in units}
+    report.summary["work_units"] = _units_summary(units)
+    await finish_partitioned_scan(report, units, lambda path: covering_unit(path, root, depth) in unit_paths)
+    await db_handler.delete_work_units(report.scan_id)
+    return report
+
+
+def unit_output_naming() -> str:
+    """OUTPUT_NAMING for the outputs of work units.
+
+    Sequential names come from each worker's own listing of OUTPUT_DIR, so two
+    workers could pick the same one; work units use path_hash names instead.
+    """
+    if config.OUTPUT_NAMING == utils.NAMING_SEQUENTIAL:
+        return utils.NAMING_PATH_HASH
+    return config.OUTPUT_NAMING
+
+
+class WorkUnitWorker:
+    """Claims work units of partitioned scans started by any worker, and runs them one at a time.
+
+    A claimed unit is leased for SCAN_LEASE_SECONDS and renewed while it
+    runs; if its worker dies, the lease runs out and another worker claims
+    it again, dropping the report entries of the attempt that died.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        if config.OUTPUT_NAMING == utils.NAMING_SEQUENTIAL:
+            logger.warning("Partitioned scans need distinct output names per source path, "
+                           "work units use OUTPUT_NAMING=path_hash")
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Worker {leases.OWNER} takes work units of partitioned scans")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                unit = await db_handler.claim_work_unit(
+                    leases.OWNER, config.SCAN_LEASE_SECONDS, config.WORK_UNIT_MAX_ATTEMPTS
+                )
+            except Exception as e:
+                logger.error(f"Could not claim a work unit: {e}")
+                unit = None
+            if unit is None:
+                await asyncio.sleep(config.WORK_UNIT_POLL_INTERVAL)
+                continue
+            await self._run_unit(unit)
+
+    async def _keep_alive(self, report: UnitReport) -> None:
+        """Renew the unit's lease, and cancel the unit when its scan is cancelled"""
+        while True:
+            await asyncio.sleep(config.SCAN_LEASE_SECONDS / 3)
+            try:
+                if not await db_handler.update_work_unit(report.unit_id, leases.OWNER,
+                                                         {"lease_expires_at": leases.deadline()}):
+                    report.lease_lost = True
+                    report.cancel()
+                    return
+                header = await db_handler.find_scan_header(str(report.scan_id))
+                if header is None or header.get("cancel_requested") or header.get("status") != STATUS_RUNNING:
+                    report.cancel()
+            except Exception as e:
+                logger.error(f"Could not renew work unit {report.unit_id}: {e}")
+
+    async def _run_unit(self, unit: dict) -> None:
+        report = UnitReport(unit, leases.OWNER)
+        logger.info(f"Claimed work unit {report.unit_id} ({report.directory}), attempt {unit['attempts']}")
+        keep_alive = asyncio.create_task(self._keep_alive(report))
+        try:
+            # Entries of an earlier attempt whose worker died
+            await db_handler.delete_unit_entries(report.scan_id, report.unit_id)
+            await process_work_unit(report, frozenset(unit.get("missing_outputs") or ()), unit_output_naming())
+        except asyncio.CancelledError:
+            # Shutting down: hand the unit back so another worker claims it at once
+            await db_handler.update_work_unit(report.unit_id, leases.OWNER, {
+                "status": UNIT_PENDING, "owner": None, "lease_expires_at": UNCLAIMED
+            })
+            raise
+        except Exception as e:
+            logger.error(f"Work unit {report.unit_id} ({report.directory}) failed: {e}", exc_info=True)
+        finally:
+            keep_alive.cancel()
+            await asyncio.gather(keep_alive, return_exceptions=True)
+
+        if report.lease_lost:
+            return
+        await db_handler.update_work_unit(report.unit_id, leases.OWNER, {
+            "status": _UNIT_STATUS.get(report.status, UNIT_FAILED),
+            "counts": dict(report.counts),
+            "files_discovered": report.files_discovered,
+            "finished_at": datetime.utcnow()
+        })
+
+
+work_unit_worker = WorkUnitWorker()